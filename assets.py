@@ -0,0 +1,63 @@
+import gzip
+import mimetypes
+import os
+from pathlib import Path
+from typing import Optional
+
+import tornado.web
+
+from utility import STATIC_DIR
+
+PRECOMPRESSED_SUFFIXES = {".css", ".js", ".json", ".svg", ".html", ".txt"}
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Uploaded images and their variants are named after their content hash.
+CONTENT_ADDRESSED_PREFIX = "images/"
+
+
+def precompress_static(root: Path = STATIC_DIR) -> int:
+    written = 0
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(directory) / filename
+            if path.suffix.lower() not in PRECOMPRESSED_SUFFIXES:
+                continue
+            compressed = path.with_name(path.name + ".gz")
+            if compressed.exists() and compressed.stat().st_mtime >= path.stat().st_mtime:
+                continue
+            compressed.write_bytes(gzip.compress(path.read_bytes(), compresslevel=9, mtime=0))
+            written += 1
+    return written
+
+
+def static_url(path: str) -> str:
+    return CachedStaticFileHandler.make_static_url({"static_path": STATIC_DIR}, path)
+
+
+class CachedStaticFileHandler(tornado.web.StaticFileHandler):
+    def validate_absolute_path(self, root: str, absolute_path: str) -> Optional[str]:
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        self._original_path = absolute_path
+        self._precompressed = False
+        if absolute_path is None or Path(absolute_path).suffix.lower() not in PRECOMPRESSED_SUFFIXES:
+            return absolute_path
+        if "gzip" in self.request.headers.get("Accept-Encoding", "") and os.path.isfile(absolute_path + ".gz"):
+            self._precompressed = True
+            return absolute_path + ".gz"
+        return absolute_path
+
+    def get_content_size(self) -> int:
+        if self._precompressed:
+            return os.path.getsize(self.absolute_path)
+        return super().get_content_size()
+
+    def get_content_type(self) -> str:
+        mime_type, _ = mimetypes.guess_type(self._original_path)
+        return mime_type or "application/octet-stream"
+
+    def set_extra_headers(self, path: str) -> None:
+        if self._precompressed:
+            self.set_header("Content-Encoding", "gzip")
+        if Path(path).suffix.lower() in PRECOMPRESSED_SUFFIXES:
+            self.set_header("Vary", "Accept-Encoding")
+        if "v" in self.request.arguments or path.startswith(CONTENT_ADDRESSED_PREFIX):
+            self.set_header("Cache-Control", IMMUTABLE_CACHE_CONTROL)
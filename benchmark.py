@@ -0,0 +1,713 @@
+import argparse
+import asyncio
+import bisect
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import tornado.escape
+import tornado.httpserver
+import tornado.netutil
+import tornado.options
+import tornado.websocket
+
+from character import ENTRY_KEYS, Character, WebpageData
+from commands import MAX_SPAWN_COUNT, apply_command
+from fanout import WIRE_ENCODERS, encode_message, fan_out
+from history import History
+from journal import Journal
+from rooms import RoomRegistry
+
+
+class NullClient:
+    wire_format = "json"
+
+    def __init__(self) -> None:
+        self.sent = 0
+
+    def send(self, message: Any) -> None:
+        self.sent += 1
+
+
+def make_encounter(size: int) -> WebpageData:
+    webpage_data = WebpageData()
+    for i in range(size):
+        character = Character("Goblin", 7, 7, "/static/goblin.png")
+        for ability in ("Nimble", "Scimitar", "Shortbow", "Darkvision"):
+            character.add_ability(ability)
+        webpage_data.add_character(character)
+    return webpage_data
+
+
+def timed(func: Callable[[], Any], repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_fanout(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    message = make_encounter(args.characters).get_snapshot()
+
+    def per_client_encode(clients: List[NullClient]) -> None:
+        for c in clients:
+            c.send(tornado.escape.json_encode(message))
+
+    results = []
+    for count in (1, 10, 50, 100, 250, 500):
+        clients = [NullClient() for _ in range(count)]
+        results.append({
+            "clients": count,
+            "encode_once_ms": timed(lambda: fan_out(clients, message), args.repeat) * 1000,
+            "per_client_ms": timed(lambda: per_client_encode(clients), args.repeat) * 1000,
+        })
+    return results
+
+
+def bench_roster(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for size in (10, 1000, 10000):
+        webpage_data = WebpageData()
+        characters = [Character("Goblin", 7, 7, "") for _ in range(size)]
+
+        start = time.perf_counter()
+        for character in characters:
+            webpage_data.add_character(character)
+        add_s = time.perf_counter() - start
+
+        names = webpage_data.get_character_names()
+        start = time.perf_counter()
+        for name in names:
+            webpage_data.get_character_by_name(name)
+        lookup_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for name in names:
+            webpage_data.remove_character_by_name(name)
+        remove_s = time.perf_counter() - start
+
+        results.append({
+            "characters": size,
+            "add_us": add_s / size * 1e6,
+            "lookup_us": lookup_s / size * 1e6,
+            "remove_us": remove_s / size * 1e6,
+        })
+    return results
+
+
+def mutation_mix(count: int, roster: int = 200, seed: int = 0) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    ops: List[Dict[str, Any]] = [{"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7} for _ in range(roster)]
+    names = ["Goblin"] + [f"Goblin{i}" for i in range(1, roster)]
+    while len(ops) < count:
+        name = rng.choice(names)
+        kind = rng.random()
+        if kind < 0.6:
+            ops.append({"op": "update", "name": name, "delta": rng.choice((-1, 1))})
+        elif kind < 0.8:
+            ops.append({"op": "updateInitiative", "name": name, "initiative": rng.randint(1, 20)})
+        elif kind < 0.9:
+            ops.append({"op": "addAbility", "name": name, "ability": rng.choice(("Rage", "Dodge", "Dash"))})
+        else:
+            ops.append({"op": "setAvailableAbilities", "name": name, "ability": "Rage"})
+    return ops
+
+
+def bench_recovery(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for snapshot_every in (args.mutations * 2, args.mutations // 2):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(Path(directory), snapshot_every=snapshot_every)
+            webpage_data = WebpageData()
+            journal.recover(webpage_data)
+            for op in mutation_mix(args.mutations):
+                apply_command(webpage_data, op)
+                journal.append(op, webpage_data)
+            journal.close()
+
+            recovered = WebpageData()
+            recovering = Journal(Path(directory))
+            start = time.perf_counter()
+            replayed = recovering.recover(recovered)
+            elapsed = time.perf_counter() - start
+            recovering.close()
+
+            assert recovered.get_roster() == webpage_data.get_roster()
+            results.append({
+                "mutations": args.mutations,
+                "snapshot_every": snapshot_every,
+                "replayed": replayed,
+                "recover_ms": elapsed * 1000,
+            })
+    return results
+
+
+def bench_rooms(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # One room's broadcast should cost the same however many other rooms share the server,
+    # and grow only with the number of screens in that room.
+    results = []
+    for room_size in (1, 10, 100, 500):
+        for room_count in (1, 10, 100, 1000):
+            registry = RoomRegistry()
+            for i in range(room_count):
+                room = registry.get(f"table{i}")
+                room.run_batch([{"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7}] * args.characters)
+                room.scheduler.flush()
+                for _ in range(room_size):
+                    room.add_client(NullClient())
+            room = registry.get("table0")
+            deltas = iter(range(args.repeat))
+
+            def mutate() -> None:
+                apply_command(room.webpage_data, {"op": "update", "name": "Goblin", "delta": next(deltas) % 2 * 2 - 1})
+                room.broadcast()
+
+            results.append({
+                "rooms": room_count,
+                "room_size": room_size,
+                "connections": room_count * room_size,
+                "room_broadcast_ms": timed(mutate, args.repeat) * 1000,
+            })
+    return results
+
+
+async def drive_room(port: int, room_id: str, duration: float, displays: int) -> Dict[str, int]:
+    url = f"ws://127.0.0.1:{port}/room/{room_id}/ws"
+    control = await tornado.websocket.websocket_connect(url)
+    screens = [await tornado.websocket.websocket_connect(url) for _ in range(displays)]
+    deliveries = 0
+
+    async def watch(screen: tornado.websocket.WebSocketClientConnection) -> None:
+        nonlocal deliveries
+        while await screen.read_message() is not None:
+            deliveries += 1
+
+    watchers = [asyncio.ensure_future(watch(screen)) for screen in screens]
+    control.write_message(json.dumps({"type": "command", "id": 0, "op": "add", "name": "Goblin", "hp": 7}))
+    acks = 0
+    in_flight = 0
+    next_id = 1
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline or in_flight:
+        # Keep a few commands outstanding, the way a busy control page would.
+        while in_flight < 8 and time.monotonic() < deadline:
+            control.write_message(json.dumps(
+                {"type": "command", "id": next_id, "op": "update", "name": "Goblin", "delta": next_id % 2 * 2 - 1}))
+            next_id += 1
+            in_flight += 1
+        message = json.loads(await control.read_message())
+        if message.get("ack"):
+            acks += 1
+            in_flight -= 1
+    for screen in screens:
+        screen.close()
+    control.close()
+    await asyncio.gather(*watchers)
+    return {"acks": acks, "deliveries": deliveries}
+
+
+def _drive_room(task: tuple) -> Dict[str, int]:
+    return asyncio.run(drive_room(*task))
+
+
+def _wait_for_port(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def bench_cluster(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    # Starts the server with a growing number of workers and drives it from separate
+    # load processes, one per room; the command rate should grow with the worker count
+    # up to the number of cores.
+    results = []
+    cores = os.cpu_count() or 1
+    for processes in sorted({1, 2, 4, cores}):
+        if processes > cores:
+            continue
+        with tempfile.TemporaryDirectory() as data_dir:
+            server = subprocess.Popen(
+                [sys.executable, "main.py", f"--port={args.port}", f"--processes={processes}",
+                 f"--data_dir={data_dir}", "--logging=none"],
+                cwd=Path(__file__).parent,
+            )
+            try:
+                _wait_for_port(args.port)
+                tasks = [(args.port, f"bench{i}", args.duration, args.displays) for i in range(args.rooms)]
+                with multiprocessing.Pool(args.rooms) as pool:
+                    counts = pool.map(_drive_room, tasks)
+            finally:
+                server.terminate()
+                server.wait()
+        results.append({
+            "processes": processes,
+            "rooms": args.rooms,
+            "displays_per_room": args.displays,
+            "commands_per_s": sum(c["acks"] for c in counts) / args.duration,
+            "deliveries_per_s": sum(c["deliveries"] for c in counts) / args.duration,
+        })
+    return results
+
+
+class ServerThread(threading.Thread):
+    # Runs the app on its own IOLoop so the CPU it burns can be told apart from the
+    # simulated clients sharing the process.
+    def __init__(self) -> None:
+        super().__init__(daemon=True)
+        self.port = 0
+        self.cpu_seconds = 0.0
+        self._ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._shutdown: Optional[asyncio.Event] = None
+
+    def run(self) -> None:
+        asyncio.run(self._serve())
+
+    async def _serve(self) -> None:
+        import main
+
+        tornado.options.options.production = True
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        self.port = sockets[0].getsockname()[1]
+        server = tornado.httpserver.HTTPServer(main.make_app())
+        server.add_sockets(sockets)
+        self._loop = asyncio.get_running_loop()
+        self._shutdown = asyncio.Event()
+        start = resource.getrusage(resource.RUSAGE_THREAD)
+        self._ready.set()
+        await self._shutdown.wait()
+        end = resource.getrusage(resource.RUSAGE_THREAD)
+        self.cpu_seconds = (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+        server.stop()
+
+    def start_serving(self) -> int:
+        self.start()
+        self._ready.wait()
+        return self.port
+
+    def stop_serving(self) -> None:
+        self._loop.call_soon_threadsafe(self._shutdown.set)
+        self.join()
+
+
+def pick_command(rng: random.Random, names: List[str], backgrounds: List[str]) -> Dict[str, Any]:
+    roll = rng.random()
+    if not names or roll < 0.05:
+        return {"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7}
+    name = rng.choice(names)
+    if roll < 0.55:
+        return {"op": "update", "name": name, "delta": rng.choice((-5, -2, -1, 1, 2))}
+    if roll < 0.7:
+        return {"op": "updateInitiative", "name": name, "initiative": rng.randint(1, 20)}
+    if roll < 0.78:
+        return {"op": "addAbility", "name": name, "ability": rng.choice(("Rage", "Dodge", "Dash"))}
+    if roll < 0.88:
+        return {"op": "setAvailableAbilities", "name": name, "ability": "Rage"}
+    if roll < 0.93:
+        return {"op": "remove", "name": name}
+    if roll < 0.97 and backgrounds:
+        return {"op": "setBg", "background": rng.choice(backgrounds)}
+    return {"op": "setWeather", "weather": rng.choice(("clear", "rain", "fog"))}
+
+
+async def run_display(url: str, arrivals: List[Tuple[int, float]]) -> None:
+    screen = await tornado.websocket.websocket_connect(url)
+    while (message := await screen.read_message()) is not None:
+        version = json.loads(message).get("version")
+        if version is not None:
+            arrivals.append((version, time.perf_counter()))
+
+
+async def run_control(url: str, seed: int, args: argparse.Namespace,
+                      mutations: List[Tuple[float, int]], errors: List[str]) -> None:
+    rng = random.Random(seed)
+    control = await tornado.websocket.websocket_connect(url)
+    snapshot = json.loads(await control.read_message())
+    backgrounds = snapshot.get("backgroundOptions", [])
+    names: List[str] = []
+    sent: Dict[int, Tuple[float, Dict[str, Any]]] = {}
+
+    async def read_acks() -> None:
+        while (message := await control.read_message()) is not None:
+            data = json.loads(message)
+            if "ack" not in data:
+                continue
+            started, op = sent.pop(data["ack"])
+            if data["status"] != "ok":
+                errors.append(data["error"])
+                continue
+            mutations.append((started, data["version"]))
+            if op["op"] == "add":
+                names.append(data["name"])
+
+    reader = asyncio.ensure_future(read_acks())
+    deadline = time.perf_counter() + args.duration
+    request_id = 0
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(rng.expovariate(args.rate))
+        op = pick_command(rng, names, backgrounds)
+        if op["op"] == "remove":
+            # Forget it now so no command already in flight targets it twice.
+            names.remove(op["name"])
+        request_id += 1
+        sent[request_id] = (time.perf_counter(), op)
+        control.write_message(json.dumps({"type": "command", "id": request_id} | op))
+    while sent:
+        await asyncio.sleep(0.01)
+    control.close()
+    await reader
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(p: float) -> float:
+        return ordered[int(round(p * (len(ordered) - 1)))]
+
+    return {
+        "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99),
+        "max": ordered[-1], "mean": sum(ordered) / len(ordered),
+    }
+
+
+def display_latencies(mutations: List[Tuple[float, int]], arrivals: List[Tuple[int, float]]) -> List[float]:
+    # A display has seen a mutation once any message at or past its version arrives.
+    versions = [version for version, _ in arrivals]
+    latencies = []
+    for started, version in mutations:
+        i = bisect.bisect_left(versions, version)
+        if i < len(arrivals):
+            latencies.append(arrivals[i][1] - started)
+    return latencies
+
+
+async def drive_load(port: int, args: argparse.Namespace) -> Dict[str, Any]:
+    url = f"ws://127.0.0.1:{port}/room/bench/ws"
+    arrivals: List[List[Tuple[int, float]]] = [[] for _ in range(args.displays)]
+    screens = [asyncio.ensure_future(run_display(url, a)) for a in arrivals]
+    mutations: List[Tuple[float, int]] = []
+    errors: List[str] = []
+    await asyncio.gather(*(run_control(url, seed, args, mutations, errors) for seed in range(args.controls)))
+    # Let the last coalesced broadcast land before judging who saw what.
+    await asyncio.sleep(0.5)
+    for screen in screens:
+        screen.cancel()
+
+    latencies = [latency for a in arrivals for latency in display_latencies(mutations, a)]
+    return {
+        "mutations": len(mutations),
+        "errors": len(errors),
+        "deliveries": sum(len(a) for a in arrivals),
+        "missed": len(mutations) * args.displays - len(latencies),
+        "latency_ms": {k: v * 1000 for k, v in percentiles(latencies).items()},
+    }
+
+
+def bench_load(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    server = ServerThread()
+    port = server.start_serving()
+    start = time.perf_counter()
+    try:
+        result = asyncio.run(drive_load(port, args))
+    finally:
+        elapsed = time.perf_counter() - start
+        server.stop_serving()
+
+    return [{
+        "displays": args.displays,
+        "controls": args.controls,
+        "rate_per_control": args.rate,
+        "duration_s": elapsed,
+    } | result | {
+        "server_cpu_s": server.cpu_seconds,
+        "server_cpu_pct": 100 * server.cpu_seconds / elapsed,
+        "rss_mb": _rss_mb(),
+        # ru_maxrss is in kilobytes on Linux.
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }]
+
+
+_LEGACY_KEYS = {short: name for name, short in ENTRY_KEYS.items()}
+
+
+def legacy_fields(fields: Dict[str, Any]) -> Dict[str, Any]:
+    # The entry format before short ids: full key names and abilities as two parallel
+    # comma-joined strings. Kept only as the baseline for bench_wire.
+    legacy = {}
+    for key, value in fields.items():
+        if key == "a":
+            legacy["abilities"] = ",".join(name for name, _ in value)
+            legacy["abilityAvailable"] = ",".join(str(available) for _, available in value)
+        else:
+            legacy[_LEGACY_KEYS[key]] = value
+    return legacy
+
+
+def legacy_message(message: Dict[str, Any]) -> Dict[str, Any]:
+    legacy = dict(message)
+    for key in ("characters", "changed"):
+        if key in message:
+            legacy[key] = {name: legacy_fields(fields) for name, fields in message[key].items()}
+    return legacy
+
+
+def deflate_stream(payloads: List[bytes], level: int, mem_level: int) -> Tuple[int, float]:
+    # permessage-deflate with context takeover: one compressor per socket, flushed
+    # after every message.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+    size = 0
+    start = time.perf_counter()
+    for payload in payloads:
+        size += len(compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4
+    return size, time.perf_counter() - start
+
+
+def bench_wire(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    snapshot = make_encounter(args.characters).get_snapshot()
+    webpage_data = WebpageData()
+    patches = []
+    for op in mutation_mix(args.mutations):
+        apply_command(webpage_data, op)
+        patch = webpage_data.pop_patch()
+        if patch is not None:
+            patches.append(patch)
+
+    formats: Dict[str, Tuple[Callable[[Dict[str, Any]], Any], Callable[[Dict[str, Any]], Any]]] = {
+        "legacy-json": (legacy_message, encode_message),
+    }
+    for name, encoder in WIRE_ENCODERS.items():
+        formats[name] = ((lambda message: message), encoder)
+
+    results = []
+    for kind, messages in (("snapshot", [snapshot]), ("patch", patches)):
+        for name, (convert, encoder) in formats.items():
+            converted = [convert(message) for message in messages]
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                payloads = [encoder(message) for message in converted]
+            encode_s = (time.perf_counter() - start) / args.repeat
+            payloads = [p if isinstance(p, bytes) else p.encode() for p in payloads]
+            row = {
+                "message": kind,
+                "format": name,
+                "count": len(payloads),
+                "bytes": sum(map(len, payloads)) / len(payloads),
+                "encode_us": encode_s / len(payloads) * 1e6,
+            }
+            for level, mem_level in ((1, 6), (1, 8), (6, 8), (9, 8)):
+                size, elapsed = deflate_stream(payloads, level, mem_level)
+                row[f"deflate{level}_mem{mem_level}_bytes"] = size / len(payloads)
+                row[f"deflate{level}_mem{mem_level}_us"] = elapsed / len(payloads) * 1e6
+            results.append(row)
+    return results
+
+
+def spawn_ops(size: int, chunk: int) -> List[Dict[str, Any]]:
+    ops = []
+    for start in range(0, size, chunk):
+        ops.append({"op": "spawn", "name": "Goblin", "hpRoll": "2d6", "count": min(chunk, size - start),
+                    "image": "/static/goblin.png", "abilities": ["Nimble", "Scimitar", "Shortbow", "Darkvision"]})
+    return ops
+
+
+def run_spawn(size: int, chunk: int) -> Tuple[WebpageData, float, int, int]:
+    webpage_data = WebpageData()
+    broadcasts = patch_bytes = 0
+    start = time.perf_counter()
+    for op in spawn_ops(size, chunk):
+        apply_command(webpage_data, op)
+        # Spawns are urgent, so each one is a broadcast of its own.
+        patch_bytes += len(encode_message(webpage_data.pop_patch()))
+        broadcasts += 1
+    return webpage_data, time.perf_counter() - start, broadcasts, patch_bytes
+
+
+def bench_spawn(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for size in (100, 500, 10000):
+        row: Dict[str, Any] = {"characters": size}
+        for label, chunk in (("single", 1), ("spawn", MAX_SPAWN_COUNT)):
+            _, elapsed, broadcasts, patch_bytes = run_spawn(size, chunk)
+            row[f"{label}_ms"] = elapsed * 1000
+            row[f"{label}_broadcasts"] = broadcasts
+            row[f"{label}_patch_bytes"] = patch_bytes
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        webpage_data = run_spawn(size, MAX_SPAWN_COUNT)[0]
+        row["bytes_per_character"] = (tracemalloc.get_traced_memory()[0] - before) / size
+        tracemalloc.stop()
+        character = webpage_data.get_character_by_name("Goblin")
+        row["instance_bytes"] = sys.getsizeof(character)
+        row["has_dict"] = hasattr(character, "__dict__")
+        results.append(row)
+    return results
+
+
+def bench_effects(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for count in (1000, 10000, 100000):
+        webpage_data = WebpageData()
+        # Ten effects per character, so the roster grows with the effect count.
+        webpage_data.spawn_characters(Character("Goblin", 7, 7, ""), [(7, 7)] * (count // 10))
+        names = webpage_data.get_character_names()
+        rng = random.Random(0)
+        start = time.perf_counter()
+        for i in range(count):
+            character = webpage_data.get_character_by_name(names[i % len(names)])
+            webpage_data.add_effect(character, f"Effect{i // len(names)}", expires_at=1000.0 + rng.random() * 600)
+        add_s = time.perf_counter() - start
+        webpage_data.pop_patch()
+
+        # A timer tick with nothing due only looks at the top of the heap.
+        idle_s = timed(lambda: webpage_data.expire_effects(999.0), args.repeat * 100)
+
+        # One tick's worth: everything due in a 100 ms slice of the 10 minute spread.
+        start = time.perf_counter()
+        expired = webpage_data.expire_effects(1000.1)
+        patch = webpage_data.pop_patch()
+        tick_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        while webpage_data.next_effect_expiry() is not None:
+            webpage_data.expire_effects(webpage_data.next_effect_expiry() + 0.1)
+            webpage_data.pop_patch()
+        drain_s = time.perf_counter() - start
+
+        results.append({
+            "effects": count,
+            "add_us": add_s / count * 1e6,
+            "idle_tick_us": idle_s * 1e6,
+            "tick_expired": len(expired),
+            "tick_ms": tick_s * 1000,
+            "tick_broadcasts": int(patch is not None),
+            "expire_us": drain_s / (count - len(expired)) * 1e6,
+        })
+    return results
+
+
+def recorded(history: History, webpage_data: WebpageData, op: Dict[str, Any]) -> None:
+    history.begin(webpage_data, [op])
+    try:
+        apply_command(webpage_data, op)
+    finally:
+        history.commit(webpage_data, [op])
+
+
+def bench_history(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    results = []
+    for roster in (200, 10000):
+        history = History()
+        webpage_data = WebpageData()
+        ops = mutation_mix(roster + args.mutations * 4, roster=roster)
+        tracemalloc.start()
+        for count, op in enumerate(ops, 1):
+            recorded(history, webpage_data, op)
+            webpage_data.pop_patch()
+            # Memory should stop growing once the history is full, however long the session.
+            if count > roster and (count - roster) % args.mutations == 0:
+                results.append({"roster": roster, "mutations": count - roster, "entries": len(history),
+                                 "images": history.images, "traced_mb": tracemalloc.get_traced_memory()[0] / 1e6})
+        tracemalloc.stop()
+        # The first patch after tracemalloc stops pays for its teardown; keep that out of
+        # the undo timings.
+        for op in ({"op": "undo"}, {"op": "redo"}):
+            apply_command(webpage_data, history.resolve(op), internal=True)
+            webpage_data.pop_patch()
+
+        for steps in (1, 10, 100):
+            start = time.perf_counter()
+            for _ in range(steps):
+                apply_command(webpage_data, history.resolve({"op": "undo"}), internal=True)
+            patch = webpage_data.pop_patch()
+            elapsed = time.perf_counter() - start
+            for _ in range(steps):
+                apply_command(webpage_data, history.resolve({"op": "redo"}), internal=True)
+            webpage_data.pop_patch()
+            results.append({"roster": roster, "undo_steps": steps, "undo_ms": elapsed * 1000,
+                            "patched_characters": len(patch.get("changed", {})) if patch else 0})
+    return results
+
+
+BENCHMARKS = {
+    "fanout": bench_fanout,
+    "roster": bench_roster,
+    "recovery": bench_recovery,
+    "rooms": bench_rooms,
+    "cluster": bench_cluster,
+    "load": bench_load,
+    "wire": bench_wire,
+    "spawn": bench_spawn,
+    "effects": bench_effects,
+    "history": bench_history,
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--characters", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mutations", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=8)
+    parser.add_argument("--displays", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--controls", type=int, default=2)
+    parser.add_argument("--rate", type=float, default=20.0, help="Mutations per second per control client")
+    parser.add_argument("--output", help="Also write the results, with the environment, to this JSON file")
+    args = parser.parse_args()
+    rows = BENCHMARKS[args.benchmark](args)
+    for row in rows:
+        print(json.dumps(row))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({
+                "benchmark": args.benchmark,
+                "args": vars(args),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "revision": _git_revision(),
+                "results": rows,
+            }, f, indent=2)
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import gzip
+import hashlib
+import re
+from typing import Dict, Optional
+
+import tornado.web
+
+from assets import IMMUTABLE_CACHE_CONTROL
+
+BUNDLE_PREFIX = "/bundle/"
+
+_bundles: Dict[str, "Asset"] = {}
+
+
+class Asset:
+    def __init__(self, name: str, content_type: str, body: str) -> None:
+        self._body = body.encode("utf-8")
+        self._digest = hashlib.sha256(self._body).hexdigest()[:16]
+        self._name = name
+        self._content_type = content_type
+        self._gzipped = gzip.compress(self._body, compresslevel=9, mtime=0)
+
+    @property
+    def filename(self) -> str:
+        base, _, extension = self._name.rpartition(".")
+        return f"{base}.{self._digest}.{extension}"
+
+    @property
+    def url(self) -> str:
+        return BUNDLE_PREFIX + self.filename
+
+    @property
+    def etag(self) -> str:
+        return f'"{self._digest}"'
+
+    @property
+    def content_type(self) -> str:
+        return self._content_type
+
+    @property
+    def body(self) -> bytes:
+        return self._body
+
+    @property
+    def gzipped(self) -> bytes:
+        return self._gzipped
+
+
+def minify_js(source: str) -> str:
+    # Deliberately conservative: only indentation, blank lines and whole-line comments
+    # go, so template literals and ASI keep working without a real JS parser.
+    lines = (line.strip() for line in source.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def minify_css(source: str) -> str:
+    source = re.sub(r"/\*.*?\*/", "", source, flags=re.S)
+    source = re.sub(r"\s+", " ", source)
+    return re.sub(r"\s*([{}:;,>])\s*", r"\1", source).strip()
+
+
+def _register(asset: Asset) -> Asset:
+    _bundles[asset.filename] = asset
+    return asset
+
+
+def build_page(name: str, title: str, html: str, css: str, js: str) -> Asset:
+    head = f'<meta charset="utf-8"><title>{title}</title>'
+    if css.strip():
+        head += f'<link rel="stylesheet" href="{_register(Asset(name + ".css", "text/css", minify_css(css))).url}">'
+    script = _register(Asset(name + ".js", "application/javascript", minify_js(js)))
+    shell = f'<!DOCTYPE html><html><head>{head}</head><body>{html.strip()}<script src="{script.url}"></script></body></html>'
+    return Asset(name + ".html", "text/html; charset=UTF-8", shell)
+
+
+class AssetHandler(tornado.web.RequestHandler):
+    def write_asset(self, asset: Asset, cache_control: str) -> None:
+        self.set_header("Content-Type", asset.content_type)
+        self.set_header("Cache-Control", cache_control)
+        self.set_header("Vary", "Accept-Encoding")
+        self.set_header("Etag", asset.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            self.write(asset.gzipped)
+        else:
+            self.write(asset.body)
+
+
+class PageHandler(AssetHandler):
+    def initialize(self, page: Asset) -> None:
+        self.page = page
+
+    def get(self, **path_kwargs: str):
+        # Pages are revalidated on every load, so a display reconnecting after a Wi-Fi
+        # drop gets a 304 rather than the whole page. The same page serves every room;
+        # it works out which room it belongs to from its own URL.
+        self.write_asset(self.page, "no-cache")
+
+
+class BundleHandler(AssetHandler):
+    def get(self, filename: str):
+        asset: Optional[Asset] = _bundles.get(filename)
+        if asset is None:
+            raise tornado.web.HTTPError(404)
+        self.write_asset(asset, IMMUTABLE_CACHE_CONTROL)
@@ -1,9 +1,25 @@
-from typing import Dict, Tuple, Optional, Union, List
+import bisect
+from typing import Callable, Dict, Tuple, Optional, List, Set, Any
 
-from utility import get_unique_name, Weather
+from assets import static_url
+from effects import ExpiryQueue
+from images import portrait_urls
+from utility import Weather, get_options
+
+# Short wire ids for the fields of a character entry. Clients depend on them: a new
+# field gets a new id, and an id is never reused for something else.
+ENTRY_KEYS = {"hp": "h", "maxHp": "m", "image": "i", "imageSet": "s", "initiative": "n", "abilities": "a",
+              "effects": "e", "original": "o", "arrival": "r"}
+# Character state fields and the slots holding them, for restoring a character in place.
+STATE_SLOTS = {"hp": "_hp", "maxHp": "_max_hp", "image": "_img", "initiative": "_initiative",
+               "abilities": "_abilities", "effects": "_effects"}
 
 
 class Character:
+    # Horde encounters keep thousands of these alive; slots drop the per-instance dict.
+    __slots__ = ("_name", "_hp", "_max_hp", "_img", "_initiative", "_abilities", "_effects",
+                 "_arrival", "_listener")
+
     def __init__(self, name: str, hp: int, max_hp: int, img: str) -> None:
         self._name = name
         self._hp = hp
@@ -11,6 +27,11 @@ class Character:
         self._img = img
         self._initiative = 0
         self._abilities: Dict[str, str] = {}
+        # Effect name -> (round it ends at, wall-clock time it ends at); 0 means no limit.
+        self._effects: Dict[str, Tuple[int, float]] = {}
+        # When the character joined the room; breaks initiative ties.
+        self._arrival = 0
+        self._listener: Optional[Callable[["Character", str], None]] = None
 
     @property
     def name(self) -> str:
@@ -24,51 +45,160 @@ class Character:
     def max_hp(self) -> int:
         return self._max_hp
 
+    @property
+    def image(self) -> str:
+        return self._img
+
     @property
     def initiative(self) -> int:
         return self._initiative
 
+    @property
+    def arrival(self) -> int:
+        return self._arrival
+
     @property
     def abilities(self) -> Tuple[str, ...]:
         return tuple(self._abilities)
 
+    @property
+    def effects(self) -> Dict[str, Tuple[int, float]]:
+        return dict(self._effects)
+
+    def set_listener(self, listener: Optional[Callable[["Character", str], None]]) -> None:
+        self._listener = listener
+
+    def _changed(self, *fields: str) -> None:
+        if self._listener is not None:
+            for field in fields:
+                self._listener(self, field)
+
     def add_ability(self, name: str) -> None:
         if name not in self._abilities:
             self._abilities[name] = "1"
+            self._changed("abilities")
 
     def remove_ability(self, name: str) -> None:
         if name in self._abilities:
             del self._abilities[name]
+            self._changed("abilities")
 
     def toggle_ability(self, name: str) -> None:
         if name in self._abilities:
             self._abilities[name] = "0" if self._abilities[name] == "1" else "1"
+            self._changed("abilities")
+
+    def add_effect(self, name: str, until_round: int, expires_at: float) -> None:
+        if self._effects.get(name) != (until_round, expires_at):
+            self._effects[name] = (until_round, expires_at)
+            self._changed("effects")
+
+    def remove_effect(self, name: str) -> bool:
+        if self._effects.pop(name, None) is None:
+            return False
+        self._changed("effects")
+        return True
+
+    def set_arrival(self, arrival: int) -> None:
+        self._arrival = arrival
+        self._changed("arrival")
 
     def update_hp(self, name: Optional[str], hp: Optional[int]):
         if name is not None:
             self._name = name
-        if hp is not None:
+        if hp is not None and hp != self._hp:
             self._hp = hp
+            self._changed("hp")
 
     def update_initiative(self, initiative: int) -> None:
-        self._initiative = initiative
+        if initiative != self._initiative:
+            self._initiative = initiative
+            self._changed("initiative")
 
-    def entry(self) -> Dict[str, Union[str, int]]:
+    def to_state(self) -> Dict[str, Any]:
         return {
+            "name": self._name,
             "hp": self._hp,
             "maxHp": self._max_hp,
             "image": self._img,
             "initiative": self._initiative,
-            "abilities": ",".join(self._abilities.keys()),
-            "abilityAvailable": ",".join(self._abilities.values())
+            "abilities": dict(self._abilities),
+            "effects": {name: list(expiry) for name, expiry in self._effects.items()},
+        }
+
+    def spawn(self, name: str, hp: int, max_hp: int) -> "Character":
+        character = Character(name, hp, max_hp, self._img)
+        character._initiative = self._initiative
+        character._abilities = dict(self._abilities)
+        character._effects = dict(self._effects)
+        return character
+
+    @classmethod
+    def from_state(cls, state: Dict[str, Any]) -> "Character":
+        character = cls(state["name"], state["hp"], state["maxHp"], state["image"])
+        character._initiative = state["initiative"]
+        character._abilities = dict(state["abilities"])
+        character._effects = {name: tuple(expiry) for name, expiry in state.get("effects", {}).items()}
+        return character
+
+    def apply_state(self, state: Dict[str, Any]) -> None:
+        restored = Character.from_state(state)
+        fields = []
+        for field, slot in STATE_SLOTS.items():
+            value = getattr(restored, slot)
+            if value != getattr(self, slot):
+                setattr(self, slot, value)
+                fields.append(field)
+        if "image" in fields:
+            fields += ["imageSet", "original"]
+        self._changed(*fields)
+
+    def image_changed(self) -> None:
+        self._changed("image", "imageSet")
+
+    def entry(self) -> Dict[str, Any]:
+        image, image_set = portrait_urls(self._img)
+        return {
+            "h": self._hp,
+            "m": self._max_hp,
+            "i": image,
+            "s": image_set,
+            "n": self._initiative,
+            "a": [[name, int(available == "1")] for name, available in self._abilities.items()],
+            "e": [[name, until_round, expires_at] for name, (until_round, expires_at) in self._effects.items()],
+            "o": self._img,
+            "r": self._arrival,
         }
 
 
 class WebpageData:
     def __init__(self) -> None:
-        self._characters: List[Character] = []
+        self._characters: Dict[str, Character] = {}
+        self._name_counters: Dict[str, int] = {}
         self._background = "village.png"
         self._weather = Weather.CLEAR
+        self._version = 0
+        self._changes: Dict[str, Set[str]] = {}
+        self._removed: Set[str] = set()
+        self._selected_changes: Set[str] = set()
+        # Initiative order as sorted (-initiative, arrival, name) keys; ties keep the
+        # order characters joined in. Clients keep the same order from each entry's
+        # initiative and arrival, so a patch never carries the whole order.
+        self._order: List[Tuple[int, int, str]] = []
+        self._order_keys: Dict[str, Tuple[int, int, str]] = {}
+        self._arrivals = 0
+        self._turn: Optional[str] = None
+        self._round = 0
+        self._turn_changed = False
+        self._round_expiry = ExpiryQueue()
+        self._time_expiry = ExpiryQueue()
+        # Before-images of whatever the current command touches, one per open recording;
+        # a batch records inside the undo step that wraps it.
+        self._recordings: List[Dict[str, Any]] = []
+
+    @property
+    def version(self) -> int:
+        return self._version
 
     @property
     def background(self) -> str:
@@ -79,39 +209,336 @@ class WebpageData:
         return self._weather
 
     def set_background(self, background: str) -> None:
-        self._background = background
+        if background != self._background:
+            self._record_global("background")
+            self._background = background
+            self._selected_changes.update(("background", "backgroundUrl"))
 
     def set_weather(self, weather: Weather) -> None:
-        self._weather = weather
+        if weather != self._weather:
+            self._record_global("weather")
+            self._weather = weather
+            self._selected_changes.add("weather")
+
+    @property
+    def turn(self) -> Optional[str]:
+        return self._turn
+
+    @property
+    def round(self) -> int:
+        return self._round
+
+    def _on_character_changed(self, character: Character, field: str) -> None:
+        self._changes.setdefault(character.name, set()).add(field)
+        if field == "initiative":
+            self._reorder(character)
+
+    def _order_insert(self, character: Character) -> None:
+        self._arrivals += 1
+        character.set_arrival(self._arrivals)
+        key = (-character.initiative, character.arrival, character.name)
+        self._order_keys[character.name] = key
+        bisect.insort(self._order, key)
+
+    def _order_remove(self, name: str) -> int:
+        index = bisect.bisect_left(self._order, self._order_keys.pop(name))
+        del self._order[index]
+        return index
+
+    def _reorder(self, character: Character) -> None:
+        old_key = self._order_keys[character.name]
+        del self._order[bisect.bisect_left(self._order, old_key)]
+        key = (-character.initiative, old_key[1], character.name)
+        index = bisect.bisect_left(self._order, key)
+        self._order.insert(index, key)
+        self._order_keys[character.name] = key
+
+    def get_initiative_order(self) -> List[str]:
+        return [name for _, _, name in self._order]
+
+    def _set_turn(self, turn: Optional[str], round_: int, expire: bool = True) -> None:
+        if (turn, round_) != (self._turn, self._round):
+            self._record_global("turn")
+            new_round = expire and round_ > self._round
+            self._turn = turn
+            self._round = round_
+            self._turn_changed = True
+            if new_round:
+                self._expire(self._round_expiry.pop_due(round_))
+
+    def _schedule_effect(self, name: str, effect: str, until_round: int, expires_at: float) -> None:
+        for queue, deadline in ((self._round_expiry, until_round), (self._time_expiry, expires_at)):
+            if deadline:
+                queue.push((name, effect), deadline)
+            else:
+                queue.discard((name, effect))
+
+    def add_effect(self, character: Character, effect: str, rounds: int = 0, expires_at: float = 0.0) -> int:
+        # A duration in rounds runs out when the round that many rounds on begins.
+        until_round = max(self._round, 1) + rounds if rounds else 0
+        self.record_character(character.name)
+        character.add_effect(effect, until_round, expires_at)
+        self._schedule_effect(character.name, effect, until_round, expires_at)
+        return until_round
+
+    def remove_effect(self, character: Character, effect: str) -> bool:
+        self.record_character(character.name)
+        self._round_expiry.discard((character.name, effect))
+        self._time_expiry.discard((character.name, effect))
+        return character.remove_effect(effect)
+
+    def _expire(self, keys: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        expired = []
+        for name, effect in keys:
+            character = self._characters.get(name)
+            if character is not None and self.remove_effect(character, effect):
+                expired.append((name, effect))
+        return expired
+
+    def expire_effects(self, now: float) -> List[Tuple[str, str]]:
+        return self._expire(self._time_expiry.pop_due(now))
+
+    def next_effect_expiry(self) -> Optional[float]:
+        return self._time_expiry.peek()
+
+    def advance_turn(self, step: int) -> None:
+        if not self._order:
+            return
+        if self._turn is None:
+            self._set_turn(self._order[0][2], max(self._round, 1))
+            return
+
+        index = bisect.bisect_left(self._order, self._order_keys[self._turn]) + step
+        round_ = self._round
+        if index >= len(self._order):
+            index, round_ = 0, round_ + 1
+        elif index < 0:
+            if round_ <= 1:
+                return
+            index, round_ = len(self._order) - 1, round_ - 1
+        self._set_turn(self._order[index][2], round_)
 
     def get_character_names(self) -> List[str]:
-        return [x.name for x in self._characters]
+        return list(self._characters)
 
     def get_character_by_name(self, name: str) -> Optional[Character]:
-        for character in self._characters:
-            if name == character.name:
-                return character
+        return self._characters.get(name)
+
+    def _allocate_names(self, name: str, count: int) -> List[str]:
+        names = [] if name in self._characters else [name]
 
-        return None
+        # Remember the last suffix handed out per base name so repeated spawns don't
+        # rescan every existing "Goblin<n>".
+        suffix = self._name_counters.get(name, 0)
+        while len(names) < count:
+            suffix += 1
+            candidate = f"{name}{suffix}"
+            if candidate not in self._characters:
+                names.append(candidate)
+        if suffix:
+            self._record_global("nameCounters")
+            self._name_counters[name] = suffix
+        return names[:count]
+
+    def _insert(self, character: Character) -> None:
+        self.record_character(character.name)
+        self._characters[character.name] = character
+        character.set_listener(self._on_character_changed)
+        self._removed.discard(character.name)
+        self._changes[character.name] = set(ENTRY_KEYS)
+        self._order_insert(character)
+        for effect, (until_round, expires_at) in character.effects.items():
+            self._schedule_effect(character.name, effect, until_round, expires_at)
 
     def add_character(self, character: Character) -> None:
-        new_char = character
-        character_names = self.get_character_names()
-        if new_char.name in character_names:
-            new_char.update_hp(name=get_unique_name(new_char.name, character_names), hp=None)
+        unique_name = self._allocate_names(character.name, 1)[0]
+        if unique_name != character.name:
+            character.update_hp(name=unique_name, hp=None)
+        self._insert(character)
 
-        self._characters.append(new_char)
+    def spawn_characters(self, template: Character, hps: List[Tuple[int, int]]) -> List[Character]:
+        # One name allocation pass for the whole horde; every minion lands in the same
+        # patch.
+        names = self._allocate_names(template.name, len(hps))
+        spawned = [template.spawn(name, hp, max_hp) for name, (hp, max_hp) in zip(names, hps)]
+        for character in spawned:
+            self._insert(character)
+        return spawned
 
     def remove_character(self, character: Character) -> None:
-        self._characters.remove(character)
+        self.record_character(character.name)
+        for effect in character.effects:
+            self._schedule_effect(character.name, effect, 0, 0.0)
+        del self._characters[character.name]
+        character.set_listener(None)
+        self._changes.pop(character.name, None)
+        self._removed.add(character.name)
+        index = self._order_remove(character.name)
+        if character.name == self._turn:
+            # The turn passes to whoever acted next, as if it had been ended.
+            if not self._order:
+                self._set_turn(None, self._round)
+            elif index == len(self._order):
+                self._set_turn(self._order[0][2], self._round + 1)
+            else:
+                self._set_turn(self._order[index][2], self._round)
 
     def remove_character_by_name(self, character_name: str) -> None:
-        if character_name in self.get_character_names():
-            character = self.get_character_by_name(character_name)
-            self._characters.remove(character)
+        character = self._characters.get(character_name)
+        if character is not None:
+            self.remove_character(character)
+
+    def _global_image(self, key: str) -> Any:
+        if key == "turn":
+            return [self._turn, self._round]
+        if key == "weather":
+            return self._weather.value
+        if key == "nameCounters":
+            return dict(self._name_counters)
+        return self._background
+
+    def start_recording(self) -> None:
+        self._recordings.append({})
+
+    def record_character(self, name: str) -> None:
+        for recording in self._recordings:
+            characters = recording.setdefault("characters", {})
+            if name not in characters:
+                character = self._characters.get(name)
+                characters[name] = character.to_state() if character is not None else None
 
-    def get_roster(self) -> Dict[str, Dict[str, Union[str, int]]]:
-        return {y.name: y.entry() for y in self._characters}
+    def _record_global(self, key: str) -> None:
+        for recording in self._recordings:
+            if key not in recording:
+                recording[key] = self._global_image(key)
+
+    def stop_recording(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        # Returns before- and after-images of just the entities that ended up different.
+        recorded = self._recordings.pop()
+        before: Dict[str, Any] = {}
+        after: Dict[str, Any] = {}
+        for name, state in recorded.pop("characters", {}).items():
+            character = self._characters.get(name)
+            current = character.to_state() if character is not None else None
+            if current != state:
+                before.setdefault("characters", {})[name] = state
+                after.setdefault("characters", {})[name] = current
+        for key, image in recorded.items():
+            current = self._global_image(key)
+            if current != image:
+                before[key] = image
+                after[key] = current
+        return before, after
+
+    def restore_entities(self, images: Dict[str, Any], now: float = 0.0) -> None:
+        for name, state in images.get("characters", {}).items():
+            character = self._characters.get(name)
+            if state is None:
+                if character is not None:
+                    self.remove_character(character)
+            elif character is None:
+                self.add_character(Character.from_state(state))
+            else:
+                for effect in character.effects:
+                    self._schedule_effect(name, effect, 0, 0.0)
+                character.apply_state(state)
+                for effect, (until_round, expires_at) in character.effects.items():
+                    self._schedule_effect(name, effect, until_round, expires_at)
+        if "background" in images:
+            self.set_background(images["background"])
+        if "weather" in images:
+            self.set_weather(Weather(images["weather"]))
+        if "nameCounters" in images:
+            # Otherwise a spawn that was undone or rolled back would still move the next
+            # spawn's suffixes on, and a journal replay would hand out different names.
+            self._name_counters = dict(images["nameCounters"])
+        if "turn" in images:
+            turn, round_ = images["turn"]
+            if turn not in self._characters:
+                turn = None
+            # Going back to a later round must not expire effects a second time.
+            self._set_turn(turn, round_, expire=False)
+        # An image taken before one of its effects ran out would otherwise bring that
+        # effect back until the next tick or round.
+        stale = []
+        for name in images.get("characters", {}):
+            character = self._characters.get(name)
+            if character is not None:
+                stale.extend((name, effect) for effect, (until_round, expires_at) in character.effects.items()
+                             if 0 < until_round <= self._round or 0 < expires_at <= now)
+        self._expire(stale)
+
+    def refresh_image(self, image_url: str) -> None:
+        for character in self._characters.values():
+            if character.image == image_url:
+                character.image_changed()
+
+    def to_state(self) -> Dict[str, Any]:
+        return {
+            "characters": [character.to_state() for character in self._characters.values()],
+            "nameCounters": dict(self._name_counters),
+            "background": self._background,
+            "weather": self._weather.value,
+            "turn": self._turn,
+            "round": self._round,
+        }
+
+    def restore(self, state: Dict[str, Any]) -> None:
+        for character in list(self._characters.values()):
+            self.remove_character(character)
+        for character_state in state["characters"]:
+            self.add_character(Character.from_state(character_state))
+        # Counters go in after the roster so unique-name allocation continues exactly
+        # where the snapshotted session left off.
+        self._name_counters = dict(state["nameCounters"])
+        self.set_background(state["background"])
+        self.set_weather(Weather(state["weather"]))
+        self._set_turn(state.get("turn"), state.get("round", 0))
+
+    def get_roster(self) -> Dict[str, Dict[str, Any]]:
+        return {name: character.entry() for name, character in self._characters.items()}
 
     def get_selected_data(self) -> dict[str, str]:
-        return  {"weather": str(self.weather.name.lower()), "background": self.background}
+        known = self.background in get_options()["backgroundOptions"]
+        return  {
+            "weather": str(self.weather.name.lower()),
+            "background": self.background,
+            "backgroundUrl": static_url(f"backgrounds/{self.background}") if known else "",
+        }
+
+    def get_turn_data(self) -> Dict[str, Any]:
+        return {"turn": self._turn, "round": self._round}
+
+    def get_snapshot(self) -> Dict[str, Any]:
+        return ({"version": self._version, "characters": self.get_roster()}
+                | self.get_turn_data() | self.get_selected_data())
+
+    def has_changes(self) -> bool:
+        return bool(self._changes or self._removed or self._selected_changes or self._turn_changed)
+
+    def pop_patch(self) -> Optional[Dict[str, Any]]:
+        if not self.has_changes():
+            return None
+
+        self._version += 1
+        patch: Dict[str, Any] = {"version": self._version, "base": self._version - 1}
+        if self._changes:
+            changed = {}
+            for name, fields in self._changes.items():
+                entry = self.get_character_by_name(name).entry()
+                changed[name] = {ENTRY_KEYS[field]: entry[ENTRY_KEYS[field]] for field in fields}
+            patch["changed"] = changed
+        if self._removed:
+            patch["removed"] = sorted(self._removed)
+        if self._selected_changes:
+            selected = self.get_selected_data()
+            patch |= {key: selected[key] for key in self._selected_changes}
+        # A turn change is just the pointer.
+        if self._turn_changed:
+            patch |= self.get_turn_data()
+
+        self._changes = {}
+        self._removed = set()
+        self._selected_changes = set()
+        self._turn_changed = False
+        return patch
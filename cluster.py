@@ -0,0 +1,354 @@
+import asyncio
+import itertools
+import json
+import logging
+import socket
+import struct
+import zlib
+from asyncio import Future
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+from commands import CommandError
+from fanout import Payload, encode_as, encode_message, fan_out
+from images import register_variants
+from rooms import Room, RoomRegistry
+
+# Every frame is a JSON header followed by an optional raw body, so an encoded
+# broadcast crosses the socket as-is instead of being escaped into another JSON string.
+_FRAME = struct.Struct("!II")
+
+logger = logging.getLogger(__name__)
+
+
+def worker_socket_path(ipc_dir: Path, worker_id: int) -> str:
+    return str(ipc_dir / f"worker-{worker_id}.sock")
+
+
+def bind_worker_sockets(ipc_dir: Path, workers: int) -> List[socket.socket]:
+    # Bound in the parent before forking, so a peer can be dialled before it starts
+    # accepting and a restarted worker takes over the same socket.
+    ipc_dir.mkdir(parents=True, exist_ok=True)
+    return [tornado.netutil.bind_unix_socket(worker_socket_path(ipc_dir, i)) for i in range(workers)]
+
+
+def write_frame(stream: tornado.iostream.IOStream, header: Dict[str, Any], body: bytes = b"") -> None:
+    encoded = json.dumps(header, separators=(",", ":")).encode()
+    stream.write(_FRAME.pack(len(encoded), len(body)) + encoded + body)
+
+
+async def read_frame(stream: tornado.iostream.IOStream) -> Tuple[Dict[str, Any], bytes]:
+    header_size, body_size = _FRAME.unpack(await stream.read_bytes(_FRAME.size))
+    header = json.loads(await stream.read_bytes(header_size))
+    body = await stream.read_bytes(body_size) if body_size else b""
+    return header, body
+
+
+class PeerRelay:
+    # Stands in for a whole worker among an owned room's clients: the room's encoded
+    # broadcast is forwarded once and the peer fans it out to its own sockets.
+    wire_format = "json"
+
+    def __init__(self, stream: tornado.iostream.IOStream, room_id: str) -> None:
+        self._stream = stream
+        self._room_id = room_id
+
+    def send(self, payload: str) -> None:
+        if self._stream.closed():
+            return
+        write_frame(self._stream, {"type": "broadcast", "room": self._room_id}, payload.encode())
+
+
+class RemoteRoom:
+    # A room owned by another worker. Mutations go to the owner; broadcasts come back
+    # already encoded, and a mirror of the latest snapshot serves resyncs locally.
+    def __init__(self, room_id: str, cluster: "Cluster", owner: int) -> None:
+        self._room_id = room_id
+        self._cluster = cluster
+        self._owner = owner
+        self._clients: Set[Any] = set()
+        self._mirror: Dict[str, Any] = {}
+        self._encoded: Dict[str, Payload] = {}
+        self._subscribed: Optional[Future] = None
+
+    @property
+    def room_id(self) -> str:
+        return self._room_id
+
+    @property
+    def owner(self) -> int:
+        return self._owner
+
+    @property
+    def clients(self) -> Set[Any]:
+        return self._clients
+
+    def add_client(self, client: Any) -> None:
+        self._clients.add(client)
+
+    def remove_client(self, client: Any) -> None:
+        self._clients.discard(client)
+
+    def idle_for(self) -> float:
+        return 0.0 if self._clients else float("inf")
+
+    async def ready(self) -> None:
+        if self._subscribed is None:
+            self._subscribed = asyncio.ensure_future(
+                self._cluster.request(self._owner, {"type": "subscribe", "room": self._room_id}))
+        await self._subscribed
+
+    def load_snapshot(self, body: bytes) -> None:
+        self._mirror = json.loads(body)
+        self._encoded = {}
+
+    def deliver(self, body: bytes) -> None:
+        payload = body.decode()
+        message = json.loads(payload)
+        self._encoded = {}
+        if "characters" in message:
+            self._mirror = message
+        elif "base" in message or "optionsVersion" in message:
+            # Announcements such as a fresh upload pass straight through; they are
+            # not part of the room's state.
+            characters = self._mirror.setdefault("characters", {})
+            for name in message.get("removed", ()):
+                characters.pop(name, None)
+            for name, fields in message.get("changed", {}).items():
+                characters.setdefault(name, {}).update(fields)
+            self._mirror.update((k, v) for k, v in message.items() if k not in ("base", "changed", "removed"))
+        fan_out(self._clients, message, {"json": payload})
+
+    def encoded_snapshot(self, wire_format: str = "json") -> Payload:
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            encoded = self._encoded[wire_format] = encode_as(wire_format, self._mirror)
+        return encoded
+
+    async def submit(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        header, _ = await self._cluster.request(self._owner, {"type": "command", "room": self._room_id, "op": op})
+        if "error" in header:
+            raise CommandError(header["error"])
+        return header["result"]
+
+    async def submit_batch(self, ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        header, _ = await self._cluster.request(self._owner, {"type": "batch", "room": self._room_id, "ops": ops})
+        if "error" in header:
+            raise CommandError(header["error"])
+        return header["results"]
+
+    async def announce(self, message: Dict[str, Any]) -> None:
+        await self._cluster.notify(self._owner, {"type": "announce", "room": self._room_id},
+                                   encode_message(message).encode())
+
+    def refresh_image(self, image_url: str) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self._cluster.forget_remote_room(self._room_id)
+        if self._subscribed is not None:
+            self._cluster.notify_soon(self._owner, {"type": "unsubscribe", "room": self._room_id})
+
+    def disconnect(self) -> None:
+        self._cluster.forget_remote_room(self._room_id)
+        for c in list(self._clients):
+            c.close(1012, "Room owner restarted")
+
+
+class PeerConnection:
+    # This worker's outgoing connection to one peer: requests and their replies, plus
+    # the broadcasts of every room subscribed through it.
+    def __init__(self, cluster: "Cluster", worker_id: int, stream: tornado.iostream.IOStream) -> None:
+        self._cluster = cluster
+        self._worker_id = worker_id
+        self._stream = stream
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+
+    @property
+    def worker_id(self) -> int:
+        return self._worker_id
+
+    def send(self, header: Dict[str, Any], body: bytes = b"") -> None:
+        write_frame(self._stream, header, body)
+
+    def request(self, header: Dict[str, Any]) -> Future:
+        request_id = next(self._ids)
+        future = Future()
+        self._pending[request_id] = future
+        self.send(header | {"id": request_id})
+        return future
+
+    async def run(self) -> None:
+        try:
+            while True:
+                header, body = await read_frame(self._stream)
+                kind = header["type"]
+                if kind == "broadcast":
+                    room = self._cluster.remote_room(header["room"])
+                    if room is not None:
+                        room.deliver(body)
+                    continue
+                if kind == "snapshot":
+                    # Loaded before the next frame is read, so no broadcast can reach
+                    # the mirror ahead of the snapshot it builds on.
+                    room = self._cluster.remote_room(header["room"])
+                    if room is not None:
+                        room.load_snapshot(body)
+                future = self._pending.pop(header["id"], None)
+                if future is not None and not future.done():
+                    future.set_result((header, body))
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(CommandError("Room owner is unavailable"))
+            self._pending.clear()
+            self._cluster.peer_closed(self)
+
+
+class ClusterServer(tornado.tcpserver.TCPServer):
+    def __init__(self, registry: RoomRegistry) -> None:
+        super().__init__()
+        self._registry = registry
+
+    async def handle_stream(self, stream: tornado.iostream.IOStream, address: Any) -> None:
+        relays: Dict[str, PeerRelay] = {}
+        try:
+            while True:
+                header, body = await read_frame(stream)
+                self._handle(stream, relays, header, body)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            for room_id, relay in relays.items():
+                self._owned(room_id).remove_client(relay)
+
+    def _owned(self, room_id: str) -> Room:
+        room = self._registry.get(room_id)
+        assert isinstance(room, Room), f"Worker does not own room {room_id}"
+        return room
+
+    def _handle(self, stream: tornado.iostream.IOStream, relays: Dict[str, PeerRelay],
+                header: Dict[str, Any], body: bytes) -> None:
+        kind = header["type"]
+        if kind == "image":
+            if register_variants(header["url"]):
+                self._registry.refresh_image(header["url"])
+            return
+
+        room = self._owned(header["room"])
+        if kind == "subscribe":
+            write_frame(stream, {"type": "snapshot", "room": room.room_id, "id": header["id"]},
+                        room.encoded_snapshot().encode())
+            relays[room.room_id] = PeerRelay(stream, room.room_id)
+            room.add_client(relays[room.room_id])
+        elif kind == "unsubscribe":
+            relay = relays.pop(room.room_id, None)
+            if relay is not None:
+                room.remove_client(relay)
+        elif kind == "announce":
+            payload = body.decode()
+            fan_out(room.clients, json.loads(payload), {"json": payload})
+        elif kind in ("command", "batch"):
+            reply: Dict[str, Any] = {"type": "reply", "id": header["id"]}
+            try:
+                if kind == "command":
+                    reply["result"] = room.run_command(header["op"])
+                else:
+                    reply["results"] = room.run_batch(header["ops"])
+            except CommandError as e:
+                reply["error"] = str(e)
+            write_frame(stream, reply)
+
+
+class Cluster:
+    def __init__(self, registry: RoomRegistry, ipc_dir: Path, worker_id: int, workers: int) -> None:
+        self._registry = registry
+        self._ipc_dir = ipc_dir
+        self._worker_id = worker_id
+        self._workers = workers
+        self._server = ClusterServer(registry)
+        self._peers: Dict[int, Future] = {}
+        self._remote_rooms: Dict[str, RemoteRoom] = {}
+
+    @property
+    def worker_id(self) -> int:
+        return self._worker_id
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def start(self, worker_sockets: List[socket.socket]) -> None:
+        self._server.add_socket(worker_sockets[self._worker_id])
+        for i, sock in enumerate(worker_sockets):
+            if i != self._worker_id:
+                sock.close()
+
+    def owner(self, room_id: str) -> int:
+        return zlib.crc32(room_id.encode()) % self._workers
+
+    def owns(self, room_id: str) -> bool:
+        return self.owner(room_id) == self._worker_id
+
+    def make_remote_room(self, room_id: str) -> RemoteRoom:
+        room = RemoteRoom(room_id, self, self.owner(room_id))
+        self._remote_rooms[room_id] = room
+        return room
+
+    def remote_room(self, room_id: str) -> Optional[RemoteRoom]:
+        return self._remote_rooms.get(room_id)
+
+    def forget_remote_room(self, room_id: str) -> None:
+        self._remote_rooms.pop(room_id, None)
+
+    def _peer(self, worker_id: int) -> Future:
+        if worker_id not in self._peers:
+            connecting = asyncio.ensure_future(self._connect(worker_id))
+            connecting.add_done_callback(
+                lambda f: f.exception() is not None and self._peers.pop(worker_id, None))
+            self._peers[worker_id] = connecting
+        return self._peers[worker_id]
+
+    async def _connect(self, worker_id: int) -> PeerConnection:
+        stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        await stream.connect(worker_socket_path(self._ipc_dir, worker_id))
+        peer = PeerConnection(self, worker_id, stream)
+        tornado.ioloop.IOLoop.current().spawn_callback(peer.run)
+        return peer
+
+    async def request(self, worker_id: int, header: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+        peer = await self._peer(worker_id)
+        return await peer.request(header)
+
+    async def notify(self, worker_id: int, header: Dict[str, Any], body: bytes = b"") -> None:
+        peer = await self._peer(worker_id)
+        peer.send(header, body)
+
+    def notify_soon(self, worker_id: int, header: Dict[str, Any], body: bytes = b"") -> None:
+        tornado.ioloop.IOLoop.current().spawn_callback(self.notify, worker_id, header, body)
+
+    def publish_image(self, image_url: str) -> None:
+        for worker_id in range(self._workers):
+            if worker_id != self._worker_id:
+                self.notify_soon(worker_id, {"type": "image", "url": image_url})
+
+    def peer_closed(self, peer: PeerConnection) -> None:
+        logger.warning("Lost connection to worker %d", peer.worker_id)
+        self._peers.pop(peer.worker_id, None)
+        # Rooms mirrored from that worker can no longer be trusted; their clients
+        # reconnect and resubscribe from scratch.
+        for room in list(self._remote_rooms.values()):
+            if room.owner == peer.worker_id:
+                self._registry.discard(room.room_id)
+                room.disconnect()
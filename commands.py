@@ -0,0 +1,347 @@
+import math
+import random
+import re
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from character import Character, WebpageData
+from effects import EXPIRY_TOLERANCE_SECONDS
+from utility import Weather, get_options
+
+MAX_SPAWN_COUNT = 500
+HP_ROLL_PATTERN = re.compile(r"\s*(\d{1,3})d(\d{1,4})\s*(?:([+-])\s*(\d{1,5}))?\s*")
+
+
+class CommandError(Exception):
+    pass
+
+
+def _get_character(webpage_data: WebpageData, op: Dict[str, Any]) -> Character:
+    name = op.get("name")
+    character = webpage_data.get_character_by_name(name) if isinstance(name, str) else None
+    if character is None:
+        raise CommandError(f"Unknown character: {name}")
+    return character
+
+
+def _string(op: Dict[str, Any], key: str, required: bool = True) -> str:
+    # Names end up as dict keys and in patches, so anything but a string is refused here
+    # rather than failing halfway through a change.
+    value = op.get(key) or ""
+    if not isinstance(value, str):
+        raise CommandError(f"Invalid {key}: {value}")
+    if required and not value:
+        raise CommandError(f"Missing {key}")
+    return value
+
+
+def _int(op: Dict[str, Any], key: str) -> int:
+    try:
+        return int(op.get(key, 0))
+    except (TypeError, ValueError, OverflowError):
+        raise CommandError(f"Invalid {key}: {op.get(key)}")
+
+
+def update_hp(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    character.update_hp(character.name, character.hp + _int(op, "delta"))
+    return {"name": character.name, "hp": character.hp}
+
+
+def update_initiative(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    character.update_initiative(_int(op, "initiative"))
+    return {"name": character.name, "initiative": character.initiative}
+
+
+def add_ability(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    character.add_ability(_string(op, "ability"))
+    return {"name": character.name, "abilities": list(character.abilities)}
+
+
+def remove_ability(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    character.remove_ability(_string(op, "ability"))
+    return {"name": character.name, "abilities": list(character.abilities)}
+
+
+def toggle_ability(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    character.toggle_ability(_string(op, "ability"))
+    return {"name": character.name}
+
+
+def _number(op: Dict[str, Any], key: str) -> float:
+    try:
+        value = float(op.get(key) or 0)
+    except (TypeError, ValueError):
+        raise CommandError(f"Invalid {key}: {op.get(key)}")
+    # NaN and infinity would go out as bare NaN/Infinity, which JSON.parse rejects, and
+    # would break the ordering of the expiry heaps.
+    if not math.isfinite(value):
+        raise CommandError(f"Invalid {key}: {op.get(key)}")
+    return value
+
+
+def add_effect(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    effect = _string(op, "effect")
+    rounds, seconds = _int(op, "rounds"), _number(op, "seconds")
+    if rounds < 0 or seconds < 0:
+        raise CommandError("Durations cannot be negative")
+    # Replays carry the deadline that was set when the op first ran.
+    expires_at = _number(op, "expiresAt") if "expiresAt" in op else (round(time.time() + seconds, 3) if seconds else 0)
+    if expires_at < 0:
+        raise CommandError("Durations cannot be negative")
+    until_round = webpage_data.add_effect(character, effect, rounds, expires_at)
+    return {"name": character.name, "effect": effect, "untilRound": until_round, "expiresAt": expires_at}
+
+
+def remove_effect(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    effect = _string(op, "effect")
+    if not webpage_data.remove_effect(character, effect):
+        raise CommandError(f"{character.name} has no effect {effect}")
+    return {"name": character.name, "effect": effect}
+
+
+def expire_effects(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    expired = webpage_data.expire_effects(_number(op, "now") + EXPIRY_TOLERANCE_SECONDS)
+    return {"expired": [list(key) for key in expired]}
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value: Any) -> bool:
+    return (isinstance(value, float) and math.isfinite(value)) or _is_int(value)
+
+
+def _valid_character_state(name: str, state: Any) -> bool:
+    if state is None:
+        return True
+    if not isinstance(state, dict) or state.get("name") != name:
+        return False
+    if not all(_is_int(state.get(key)) for key in ("hp", "maxHp", "initiative")) or not isinstance(state.get("image"), str):
+        return False
+    abilities, effects = state.get("abilities"), state.get("effects", {})
+    return (isinstance(abilities, dict) and all(isinstance(ability, str) and available in ("0", "1")
+                                                for ability, available in abilities.items())
+            and isinstance(effects, dict) and all(isinstance(effect, str) and isinstance(expiry, list) and len(expiry) == 2
+                                                  and _is_int(expiry[0]) and _is_number(expiry[1])
+                                                  for effect, expiry in effects.items()))
+
+
+def _check_images(images: Any) -> None:
+    # Everything is checked before anything is restored, so a bad image cannot leave a
+    # room half-restored.
+    if not isinstance(images, dict) or not isinstance(images.get("characters", {}), dict):
+        raise CommandError("Invalid images")
+    for name, state in images.get("characters", {}).items():
+        if not _valid_character_state(name, state):
+            raise CommandError(f"Invalid image for {name}")
+    if "background" in images:
+        _check_background(images["background"])
+    if "weather" in images and images["weather"] not in {weather.value for weather in Weather}:
+        raise CommandError(f"Unknown weather: {images['weather']}")
+    turn = images.get("turn", [None, 0])
+    if not (isinstance(turn, list) and len(turn) == 2 and (turn[0] is None or isinstance(turn[0], str))
+            and _is_int(turn[1])):
+        raise CommandError("Invalid turn")
+    counters = images.get("nameCounters", {})
+    if not isinstance(counters, dict) or not all(isinstance(name, str) and _is_int(suffix)
+                                                 for name, suffix in counters.items()):
+        raise CommandError("Invalid name counters")
+
+
+def restore_entities(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    images = op.get("images")
+    _check_images(images)
+    now = _number(op, "now")
+    webpage_data.restore_entities(images, now + EXPIRY_TOLERANCE_SECONDS if now else 0.0)
+    characters = images.get("characters", {})
+    return {"characters": sorted(characters), "globals": sorted(key for key in images if key != "characters")}
+
+
+def add_character(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = Character(_string(op, "name"), _int(op, "hp"), _int(op, "maxHp"), _string(op, "image", required=False))
+    webpage_data.add_character(character)
+    return {"name": character.name}
+
+
+def _roll(expression: str, count: int) -> List[Tuple[int, int]]:
+    match = HP_ROLL_PATTERN.fullmatch(expression)
+    if match is None or int(match[1]) < 1 or int(match[2]) < 1:
+        raise CommandError(f"Invalid hpRoll: {expression}")
+    dice, sides = int(match[1]), int(match[2])
+    modifier = int(match[4] or 0) * (-1 if match[3] == "-" else 1)
+    hps = []
+    for _ in range(count):
+        hp = max(1, sum(random.randint(1, sides) for _ in range(dice)) + modifier)
+        hps.append((hp, hp))
+    return hps
+
+
+def spawn_characters(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    name = _string(op, "name")
+    count = _int(op, "count")
+    if not 1 <= count <= MAX_SPAWN_COUNT:
+        raise CommandError(f"count must be between 1 and {MAX_SPAWN_COUNT}")
+    if op.get("hps") is not None:
+        # Replayed from the journal: the rolls were made when the op first ran.
+        try:
+            hps = [(int(hp), int(max_hp)) for hp, max_hp in op["hps"]]
+        except (TypeError, ValueError, OverflowError):
+            raise CommandError(f"Invalid hps: {op['hps']}")
+        if len(hps) != count:
+            raise CommandError("hps must have one entry per spawned character")
+    elif op.get("hpRoll"):
+        hps = _roll(str(op["hpRoll"]), count)
+    else:
+        hps = [(_int(op, "hp"), _int(op, "maxHp"))] * count
+
+    template = Character(name, 0, 0, _string(op, "image", required=False))
+    abilities = op.get("abilities") or []
+    if not isinstance(abilities, list):
+        raise CommandError("abilities must be a list")
+    for ability in abilities:
+        template.add_ability(str(ability))
+    spawned = webpage_data.spawn_characters(template, hps)
+    return {"names": [character.name for character in spawned], "hps": [list(hp) for hp in hps]}
+
+
+def remove_character(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    character = _get_character(webpage_data, op)
+    webpage_data.remove_character(character)
+    return {"name": character.name}
+
+
+def _advance_turn(webpage_data: WebpageData, step: int) -> Dict[str, Any]:
+    webpage_data.advance_turn(step)
+    if webpage_data.turn is None:
+        raise CommandError("No characters in initiative order")
+    return webpage_data.get_turn_data()
+
+
+def next_turn(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    return _advance_turn(webpage_data, 1)
+
+
+def previous_turn(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    return _advance_turn(webpage_data, -1)
+
+
+def set_weather(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    try:
+        weather = Weather(op.get("weather"))
+    except ValueError:
+        raise CommandError(f"Unknown weather: {op.get('weather')}")
+    webpage_data.set_weather(weather)
+    return {"weather": weather.value}
+
+
+def _check_background(background: Any) -> None:
+    # Only names listed from the backgrounds directory: the value ends up as a static
+    # file path, and anything else could point outside it.
+    if background not in get_options()["backgroundOptions"]:
+        raise CommandError(f"Unknown background: {background}")
+
+
+def set_background(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    if not op.get("background"):
+        raise CommandError("Missing background")
+    _check_background(op["background"])
+    webpage_data.set_background(op["background"])
+    return {"background": webpage_data.background}
+
+
+def start_recording(webpage_data: WebpageData, ops: List[Any]) -> None:
+    webpage_data.start_recording()
+    # Commands that edit a character in place name it; everything else is recorded by
+    # WebpageData as it happens.
+    for op in ops:
+        if isinstance(op, dict) and isinstance(op.get("name"), str):
+            webpage_data.record_character(op["name"])
+
+
+def apply_batch(webpage_data: WebpageData, ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    if not isinstance(ops, list):
+        raise CommandError("ops must be a list")
+
+    # All or nothing: if any op fails, whatever the others changed goes back to how it
+    # was before the batch. Every result is still reported.
+    start_recording(webpage_data, ops)
+    results = []
+    try:
+        for op in ops:
+            try:
+                results.append({"status": "ok"} | apply_command(webpage_data, op))
+            except CommandError as e:
+                results.append({"status": "error", "error": str(e)})
+    except Exception:
+        # Not a refusal but a bug; the batch still must not stay half-applied.
+        before, _ = webpage_data.stop_recording()
+        webpage_data.restore_entities(before)
+        raise
+    before, _ = webpage_data.stop_recording()
+    if any(result["status"] == "error" for result in results):
+        webpage_data.restore_entities(before)
+        results = [result | {"status": "rolledBack"} if result["status"] == "ok" else result for result in results]
+    return results
+
+
+def batch(webpage_data: WebpageData, op: Dict[str, Any]) -> Dict[str, Any]:
+    return {"results": apply_batch(webpage_data, op.get("ops"))}
+
+
+COMMANDS: Dict[str, Callable[[WebpageData, Dict[str, Any]], Dict[str, Any]]] = {
+    "update": update_hp,
+    "updateInitiative": update_initiative,
+    "addAbility": add_ability,
+    "removeAbility": remove_ability,
+    "setAvailableAbilities": toggle_ability,
+    "addEffect": add_effect,
+    "removeEffect": remove_effect,
+    "add": add_character,
+    "spawn": spawn_characters,
+    "remove": remove_character,
+    "nextTurn": next_turn,
+    "previousTurn": previous_turn,
+    "setWeather": set_weather,
+    "setBg": set_background,
+    "batch": batch,
+}
+
+# Ops only the server itself issues: the effect timer expires effects, and undo and redo
+# resolve to a restore. Rooms and journal replay can run them; clients cannot.
+INTERNAL_COMMANDS: Dict[str, Callable[[WebpageData, Dict[str, Any]], Dict[str, Any]]] = {
+    "expireEffects": expire_effects,
+    "restoreEntities": restore_entities,
+}
+
+# Structural changes skip the broadcast coalescing window.
+URGENT_COMMANDS = {"add", "spawn", "remove", "setWeather", "setBg", "restoreEntities", "batch"}
+
+# Result fields that pin down a random outcome. They are journaled with the op so a
+# replay rebuilds the same state instead of rolling again.
+RESOLVED_FIELDS = {"spawn": ("hps",), "addEffect": ("expiresAt",)}
+
+
+def apply_command(webpage_data: WebpageData, op: Dict[str, Any], internal: bool = False) -> Dict[str, Any]:
+    if not isinstance(op, dict):
+        raise CommandError(f"Invalid op: {op}")
+    name = op.get("op") if isinstance(op.get("op"), str) else None
+    command = COMMANDS.get(name) or (INTERNAL_COMMANDS.get(name) if internal else None)
+    if command is None:
+        raise CommandError(f"Unknown op: {op.get('op')}")
+    return command(webpage_data, op)
+
+
+def resolved_op(op: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    if op["op"] == "batch":
+        ops = [resolved_op(inner, inner_result) if inner_result["status"] != "error" else inner
+               for inner, inner_result in zip(op["ops"], result["results"])]
+        return op | {"ops": ops}
+    return op | {key: result[key] for key in RESOLVED_FIELDS.get(op["op"], ())}
@@ -1,159 +1,403 @@
-import tornado
-
-
-class ControlHandler(tornado.web.RequestHandler):
-    def get(self):
-        self.write("""
-        <h1>Control Panel</h1>
-        <div id="background"></div>
-        <form id="addForm" enctype="multipart/form-data">
-          <input name="name" placeholder="Character Name" pattern="[A-Za-z]+" required>
-          <input name="hp" type="number" placeholder="HP" style="width: 50px" required><span> / </span>
-          <input name="maxHp" type="number" placeholder="MaxHP" style="width: 50px" required>
-          <input type="file" name="file">
-          <button type="submit">Add Character</button>
-        </form>
-        <hr>
-        <div id="charList"></div>
-
-        <script>
-        function refreshGlobal(backgrounds, weathers, currentBg, currentWeather) {
-            let div = document.getElementById("background");
-            let html = `
-              <label for="backgroundSelect">Background:</label>
-              <select name="background" id="backgroundSelect" onchange="setBg(this.value)">
-            `;
-            for (let bg of backgrounds) {
-                html += `<option value="${bg}" ${bg === currentBg ? " selected" : ""}>${bg}</option>`;
-            }
-            html += "</select>";
-
-            html += `
-              <label for="backgroundSelect">Weather:</label>
-              <select name="weather" id="weatherSelect" onchange="setWeather(this.value)">
-            `;
-            for (let w of weathers) {
-                html += `<option value="${w}" ${w === currentWeather ? " selected" : ""}>${w}</option>`;
-            }
-            html += "</select>";
-            div.innerHTML = html;
-        }
-        
-        function refreshList(chars) {
-            let div = document.getElementById("charList");
-            div.innerHTML = "";
-            for (let c in chars) {
-                let char = chars[c];
-                div.innerHTML += `<p>${c} (HP: ${chars[c].hp} / ${chars[c].maxHp})
-                  <button onclick="updateChar('${c}', 1)">+1</button>
-                  <button onclick="updateChar('${c}', -1)">-1</button>
-                  <button onclick="removeChar('${c}')">Remove</button></p>
-                  <span>Initiative: ${chars[c].initiative} </span><input id="initiative${c}" name="initiative" type="number" placeholder="Initiative" style="width: 45px" onchange="updateInitiative('${c}', this.value)" value="${chars[c].initiative}">
-                  <input id="abilityInput${c}" name="ability" placeholder="Ability Name" pattern="[A-Za-z]+" required>
-                  <button id="addAbilityBtn${c}">Add Ability</button>
-                  <p>Abilities:</p>`;
-
-                if (char.abilities.length !== 0) {
-                    for (let a of char.abilities.split(",")) {
-                        const checked = char.abilityAvailable.split(",")[char.abilities.split(",").indexOf(a)] === "1";
-                        div.innerHTML += `<span>${a} | Available: </span>
-                          <input type="checkbox" name="available${c}${a}" value="value1" ${checked ? "checked" : ""} onchange="setAvailableAbilities('${c}', '${a}')">
-                          <button onclick="removeAbility('${c}', '${a}')">Remove Ability</button></p>`;
-                    }
-                }
-            }
+from bundles import Asset, build_page
 
-            div.addEventListener("click", function(e) {
-                if (e.target.matches("button[id^='addAbilityBtn']")) {
-                    const c = e.target.id.replace("addAbilityBtn", "");
-                    const abilityName = document.getElementById("abilityInput" + c).value;
-                    addAbility(c, abilityName);
-                }
-                if (e.target.matches("button[id^='updateInitiative']")) {
-                    const c = e.target.id.replace("updateInitiative", "");
-                    const initiative = document.getElementById("initiative" + c).value;
-                }
-            });
-        }
-        
-        function setBg(bg) {
-            fetch("/setBg", {
-                method:"POST",
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({background:bg})
-            });
+CONTROL_HTML = """
+<h1>Control Panel</h1>
+<div id="background"></div>
+<p>
+  <button id="undo">Undo</button>
+  <button id="redo">Redo</button>
+</p>
+<form id="addForm" enctype="multipart/form-data">
+  <input name="name" placeholder="Character Name" pattern="[A-Za-z]+" required>
+  <input name="hp" type="number" placeholder="HP" style="width: 50px" required><span> / </span>
+  <input name="maxHp" type="number" placeholder="MaxHP" style="width: 50px" required>
+  <input name="hpRoll" placeholder="HP roll (2d6+3)" style="width: 110px">
+  <span> x </span><input name="count" type="number" min="1" max="500" value="1" style="width: 50px">
+  <input type="file" name="file">
+  <button type="submit">Add Character</button>
+</form>
+<hr>
+<p>
+  <button id="previousTurn">Previous Turn</button>
+  <span id="turn">Combat not started</span>
+  <button id="nextTurn">Next Turn</button>
+</p>
+<div id="charList"></div>
+"""
+
+CONTROL_CSS = """
+.char-row.current-turn {
+  border-left: 4px solid gold;
+  padding-left: 6px;
+}
+"""
+
+CONTROL_JS = """
+function refreshGlobal(backgrounds, weathers, currentBg, currentWeather) {
+    let div = document.getElementById("background");
+    let html = `
+      <label for="backgroundSelect">Background:</label>
+      <select name="background" id="backgroundSelect" onchange="setBg(this.value)">
+    `;
+    for (let bg of backgrounds) {
+        html += `<option value="${bg}" ${bg === currentBg ? " selected" : ""}>${bg}</option>`;
+    }
+    html += "</select>";
+
+    html += `
+      <label for="backgroundSelect">Weather:</label>
+      <select name="weather" id="weatherSelect" onchange="setWeather(this.value)">
+    `;
+    for (let w of weathers) {
+        html += `<option value="${w}" ${w === currentWeather ? " selected" : ""}>${w}</option>`;
+    }
+    html += "</select>";
+    div.innerHTML = html;
+}
+
+const rowViews = new Map();
+
+function createRow(name) {
+    const root = document.createElement("div");
+    root.className = "char-row";
+    root.dataset.name = name;
+    root.innerHTML = `<p><span class="summary"></span>
+      <button data-action="hp" data-delta="1">+1</button>
+      <button data-action="hp" data-delta="-1">-1</button>
+      <button data-action="remove">Remove</button></p>
+      <span class="initiative-label"></span><input class="initiative-input" name="initiative" type="number" placeholder="Initiative" style="width: 45px">
+      <input class="ability-input" name="ability" placeholder="Ability Name" pattern="[A-Za-z]+" required>
+      <button data-action="addAbility">Add Ability</button>
+      <input class="effect-input" name="effect" placeholder="Effect" style="width: 80px">
+      <input class="effect-duration" name="duration" type="number" min="0" placeholder="For" style="width: 45px">
+      <select class="effect-unit"><option value="rounds">rounds</option><option value="seconds">seconds</option></select>
+      <button data-action="addEffect">Add Effect</button>
+      <p>Abilities:</p>
+      <div class="ability-list"></div>
+      <div class="effect-list"></div>`;
+    return {
+        root: root,
+        summary: root.querySelector(".summary"),
+        initiativeLabel: root.querySelector(".initiative-label"),
+        initiativeInput: root.querySelector(".initiative-input"),
+        abilityList: root.querySelector(".ability-list"),
+        effectList: root.querySelector(".effect-list"),
+        shown: {},
+    };
+}
+
+// Character entries use short field ids: h hp, m maxHp, i image, s imageSet,
+// n initiative, a [[ability, available], ...], e [[effect, untilRound, expiresAt], ...],
+// o the original upload, r when the character joined.
+function describeExpiry(untilRound, expiresAt) {
+    const parts = [];
+    if (untilRound) parts.push(`until round ${untilRound}`);
+    if (expiresAt) parts.push(`until ${new Date(expiresAt * 1000).toLocaleTimeString()}`);
+    return parts.length ? ` (${parts.join(" or ")})` : "";
+}
+
+function renderEffects(list, char) {
+    list.textContent = "";
+    for (const [effect, untilRound, expiresAt] of char.e) {
+        const label = document.createElement("span");
+        label.textContent = `Effect: ${effect}${describeExpiry(untilRound, expiresAt)} `;
+        const remove = document.createElement("button");
+        remove.dataset.action = "removeEffect";
+        remove.dataset.effect = effect;
+        remove.textContent = "End Effect";
+        const line = document.createElement("p");
+        line.append(label, remove);
+        list.appendChild(line);
+    }
+}
+
+function renderAbilities(list, char) {
+    list.textContent = "";
+    for (const [ability, available] of char.a) {
+        const label = document.createElement("span");
+        label.textContent = `${ability} | Available: `;
+        const checkbox = document.createElement("input");
+        checkbox.type = "checkbox";
+        checkbox.dataset.action = "toggleAbility";
+        checkbox.dataset.ability = ability;
+        checkbox.checked = available === 1;
+        const remove = document.createElement("button");
+        remove.dataset.action = "removeAbility";
+        remove.dataset.ability = ability;
+        remove.textContent = "Remove Ability";
+        const line = document.createElement("p");
+        line.append(label, checkbox, " ", remove);
+        list.appendChild(line);
+    }
+}
+
+function updateRow(name, view, char) {
+    const summary = `${name} (HP: ${char.h} / ${char.m})`;
+    if (view.shown.summary !== summary) {
+        view.shown.summary = summary;
+        view.summary.textContent = summary;
+    }
+    if (view.shown.initiative !== char.n) {
+        view.shown.initiative = char.n;
+        view.initiativeLabel.textContent = `Initiative: ${char.n} `;
+        // Leave the box alone while the DM is typing in it.
+        if (document.activeElement !== view.initiativeInput) view.initiativeInput.value = char.n;
+    }
+    // Every message carries a fresh list, so identity tells whether it changed.
+    if (view.shown.abilities !== char.a) {
+        view.shown.abilities = char.a;
+        renderAbilities(view.abilityList, char);
+    }
+    if (view.shown.effects !== char.e) {
+        view.shown.effects = char.e;
+        renderEffects(view.effectList, char);
+    }
+}
+
+function renderRow(list, name, char) {
+    let view = rowViews.get(name);
+    if (!view) {
+        view = createRow(name);
+        rowViews.set(name, view);
+        list.appendChild(view.root);
+    }
+    updateRow(name, view, char);
+}
+
+function removeRow(name) {
+    const view = rowViews.get(name);
+    if (view) {
+        view.root.remove();
+        rowViews.delete(name);
+    }
+}
+
+function refreshList(chars, changed, removed, moved) {
+    const list = document.getElementById("charList");
+    if (changed === undefined) {
+        for (const name of Array.from(rowViews.keys())) {
+            if (!(name in chars)) removeRow(name);
         }
-        function setWeather(weather) {
-            fetch("/setWeather", {
-                method:"POST",
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({weather:weather})
-            });
+        for (const name of Object.keys(chars).sort(byInitiative)) {
+            renderRow(list, name, chars[name]);
+            list.appendChild(rowViews.get(name).root);
         }
+        return;
+    }
+    for (const name of removed) removeRow(name);
+    for (const name of changed) {
+        if (chars[name]) renderRow(list, name, chars[name]);
+    }
+    placeRows(list, moved.filter(name => chars[name]));
+}
 
-        function removeAbility(name, ability) {
-            fetch("/removeAbility", {
-                method:"POST", 
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({name:name, ability:ability})
-            });
-        }
+// Initiative order: highest initiative first, ties in the order characters joined.
+function byInitiative(a, b) {
+    const x = state.characters[a], y = state.characters[b];
+    return y.n - x.n || x.r - y.r;
+}
 
-        function addAbility(name, ability) {
-            fetch("/addAbility", {
-                method:"POST", 
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({name:name, ability:ability})
-            });
-        }
+// Names whose initiative or arrival came in the patch, so whose place may have changed.
+function movedNames(changed) {
+    return Object.keys(changed).filter(name => "n" in changed[name] || "r" in changed[name]);
+}
 
-        function updateInitiative(name, initiative) {
-            fetch("/updateInitiative", {
-                method:"POST", 
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({name:name, initiative:initiative})
-            });
+// Patches carry no order. Rows whose place may have changed are taken out and put back
+// by binary search among the rest, which are still in order.
+function placeRows(list, names) {
+    for (const name of names) rowViews.get(name).root.remove();
+    for (const name of names) {
+        const rows = list.children;
+        let low = 0, high = rows.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (byInitiative(rows[mid].dataset.name, name) < 0) low = mid + 1;
+            else high = mid;
         }
+        list.insertBefore(rowViews.get(name).root, rows[low] || null);
+    }
+}
+
+let currentTurn = null;
+
+function showTurn(turn, round) {
+    const previous = rowViews.get(currentTurn);
+    if (previous) previous.root.classList.remove("current-turn");
+    currentTurn = turn;
+    const view = rowViews.get(turn);
+    if (view) view.root.classList.add("current-turn");
+    document.getElementById("turn").textContent = turn === null ? "Combat not started" : `Round ${round}: ${turn}`;
+}
 
-        function removeChar(name) {
-            fetch("/remove", {
-                method:"POST", 
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({name:name})
-            });
+function rowAction(e) {
+    const target = e.target.closest("[data-action]");
+    const row = e.target.closest(".char-row");
+    return target && row ? {target: target, name: row.dataset.name, action: target.dataset.action} : null;
+}
+
+const charList = document.getElementById("charList");
+
+charList.addEventListener("click", e => {
+    const hit = rowAction(e);
+    if (!hit || hit.target.tagName !== "BUTTON") return;
+    if (hit.action === "hp") {
+        updateChar(hit.name, Number(hit.target.dataset.delta));
+    } else if (hit.action === "remove") {
+        removeChar(hit.name);
+    } else if (hit.action === "addAbility") {
+        const input = rowViews.get(hit.name).root.querySelector(".ability-input");
+        if (input.value) {
+            addAbility(hit.name, input.value);
+            input.value = "";
+        }
+    } else if (hit.action === "removeAbility") {
+        removeAbility(hit.name, hit.target.dataset.ability);
+    } else if (hit.action === "addEffect") {
+        const root = rowViews.get(hit.name).root;
+        const input = root.querySelector(".effect-input");
+        const duration = Number(root.querySelector(".effect-duration").value) || 0;
+        if (input.value) {
+            addEffect(hit.name, input.value, root.querySelector(".effect-unit").value, duration);
+            input.value = "";
         }
+    } else if (hit.action === "removeEffect") {
+        removeEffect(hit.name, hit.target.dataset.effect);
+    }
+});
+
+charList.addEventListener("change", e => {
+    if (e.target.classList.contains("initiative-input")) {
+        const row = e.target.closest(".char-row");
+        updateInitiative(row.dataset.name, e.target.value);
+        return;
+    }
+    const hit = rowAction(e);
+    if (hit && hit.action === "toggleAbility") setAvailableAbilities(hit.name, hit.target.dataset.ability);
+});
+
+// Pages under /room/<id>/ talk to that room; the bare /control page is the default room.
+const roomBase = location.pathname.slice(0, -"/control".length);
+let nextRequestId = 1;
+const pendingCommands = {};
+
+function sendCommand(path, op, body) {
+    if (ws.readyState === WebSocket.OPEN) {
+        const id = nextRequestId++;
+        ws.send(JSON.stringify(Object.assign({type: "command", id: id, op: op}, body)));
+        return new Promise(resolve => pendingCommands[id] = resolve);
+    }
+    return fetch(roomBase + path, {
+        method: "POST",
+        headers: {"Content-Type": "application/json"},
+        body: JSON.stringify(body)
+    }).then(response => response.json());
+}
+
+function setBg(bg) {
+    sendCommand("/setBg", "setBg", {background: bg});
+}
+function setWeather(weather) {
+    sendCommand("/setWeather", "setWeather", {weather: weather});
+}
+
+function removeAbility(name, ability) {
+    sendCommand("/removeAbility", "removeAbility", {name: name, ability: ability});
+}
+
+function addAbility(name, ability) {
+    sendCommand("/addAbility", "addAbility", {name: name, ability: ability});
+}
+
+function addEffect(name, effect, unit, duration) {
+    sendCommand("/addEffect", "addEffect", {name: name, effect: effect, [unit]: duration});
+}
+
+function removeEffect(name, effect) {
+    sendCommand("/removeEffect", "removeEffect", {name: name, effect: effect});
+}
 
-        function updateChar(name, delta) {
-            fetch("/update", {
-                method:"POST", 
-                headers:{"Content-Type":"application/json"},
-                body: JSON.stringify({name:name, delta:delta})
-            });
+function updateInitiative(name, initiative) {
+    sendCommand("/updateInitiative", "updateInitiative", {name: name, initiative: initiative});
+}
+
+function removeChar(name) {
+    sendCommand("/remove", "remove", {name: name});
+}
+
+function updateChar(name, delta) {
+    sendCommand("/update", "update", {name: name, delta: delta});
+}
+
+function setAvailableAbilities(charName, ability) {
+    sendCommand("/setAvailableAbilities", "setAvailableAbilities", {name: charName, ability: ability});
+}
+
+document.getElementById("undo").addEventListener("click", () => sendCommand("/undo", "undo", {}));
+document.getElementById("redo").addEventListener("click", () => sendCommand("/redo", "redo", {}));
+document.getElementById("nextTurn").addEventListener("click", () => sendCommand("/nextTurn", "nextTurn", {}));
+document.getElementById("previousTurn").addEventListener("click", () => sendCommand("/previousTurn", "previousTurn", {}));
+
+document.getElementById("addForm").addEventListener("submit", e=>{
+    e.preventDefault();
+    let formData = new FormData(e.target);
+    fetch(roomBase + "/add", {method:"POST", body: formData});
+});
+
+let state = {version: null, characters: {}, awaitingSnapshot: false};
+
+function applyMessage(data) {
+    if (data.backgroundOptions) state.backgroundOptions = data.backgroundOptions;
+    if (data.weatherOptions) state.weatherOptions = data.weatherOptions;
+    if (data.characters) {
+        state.characters = data.characters;
+        state.version = data.version;
+        state.awaitingSnapshot = false;
+    } else if (data.base !== undefined) {
+        if (data.base !== state.version) {
+            if (!state.awaitingSnapshot) {
+                state.awaitingSnapshot = true;
+                ws.send(JSON.stringify({type: "snapshot"}));
+            }
+            return false;
         }
+        for (let name of data.removed || []) delete state.characters[name];
+        for (let name in data.changed || {}) {
+            state.characters[name] = Object.assign(state.characters[name] || {}, data.changed[name]);
+        }
+        state.version = data.version;
+    }
+    if (data.background) state.background = data.background;
+    if (data.weather) state.weather = data.weather;
+    return true;
+}
 
-        function setAvailableAbilities(charName, ability) {
-            fetch("/setAvailableAbilities", {
-                method: "POST",
-                headers: {"Content-Type": "application/json"},
-                body: JSON.stringify({name: charName, ability: ability})
-            });
+let ws = new WebSocket((location.protocol === "https:" ? "wss://" : "ws://") + location.host + roomBase + "/ws");
+ws.onmessage = (msg)=>{
+    let data = JSON.parse(msg.data);
+    console.log(data);
+    if (data.ack !== undefined) {
+        if (data.status !== "ok") console.warn("Command failed", data);
+        if (pendingCommands[data.ack]) {
+            pendingCommands[data.ack](data);
+            delete pendingCommands[data.ack];
         }
+        return;
+    }
+    if (!applyMessage(data)) return;
+    if (data.characters) {
+        refreshList(state.characters);
+    } else if (data.changed || data.removed) {
+        const changed = data.changed || {};
+        refreshList(state.characters, Object.keys(changed), data.removed || [], movedNames(changed));
+    }
+    if (data.turn !== undefined) showTurn(data.turn, data.round);
+    if (state.backgroundOptions && state.weatherOptions &&
+        (data.backgroundOptions || data.weatherOptions || data.background || data.weather)) {
+        refreshGlobal(state.backgroundOptions, state.weatherOptions, state.background, state.weather);
+    }
+};
+"""
 
-        document.getElementById("addForm").addEventListener("submit", e=>{
-            e.preventDefault();
-            let formData = new FormData(e.target);
-            fetch("/add", {method:"POST", body: formData});
-        });
-
-        let ws = new WebSocket("ws://" + location.host + "/ws");
-        ws.onmessage = (msg)=>{
-            let data = JSON.parse(msg.data);
-            console.log(data);
-            if (data.characters) refreshList(data.characters);
-            if (data.backgroundOptions && data.weatherOptions) {
-                refreshGlobal(data.backgroundOptions, data.weatherOptions, data.background, data.weather);            
-            }
-        };
-        </script>
-        """)
 
+def build_control_page() -> Asset:
+    return build_page("control", "Control Panel", CONTROL_HTML, CONTROL_CSS, CONTROL_JS)
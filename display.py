@@ -1,246 +1,517 @@
-import tornado
-
-
-class DisplayHandler(tornado.web.RequestHandler):
-    def get(self):
-        self.write("""
-        <h1>Battlefield</h1>
-        <div id="header"></div>
-        <div id="weather-effects"></div>
-        <div id="weather"></div>
-        <div id="chars"></div>
-        <style>
-          body {
-            font-family: sans-serif;
-            background: grey;
-            color: white;
-            text-align: center;
-            margin: 0;
-            padding: 0;
-            overflow: hidden;
-          }
-          
-          #weather-effects {
-            position: fixed;
-            top: 0;
-            left: 0;
-            width: 100vw;
-            height: 100vh;
-            pointer-events: none;
-            z-index: 0;
-          }
-          
-          #header, #weather, #chars {
-            position: relative;
-            z-index: 1;
-          }
-
-          #chars {
-            display: flex;
-            justify-content: center;
-            align-items: flex-start;
-            gap: 10px; 
-            overflow: hidden;
-            padding: 10px;
-          }
-
-          .char {
-            margin: 10px;
-            padding: 10px;
-            border: 2px solid white;
-            background: #111;
-            flex: 1 1 180px;   
-            max-width: 220px;
-            text-align: center;
-          }
-
-          .name {
-            font-size: 1.2em;
-            margin-bottom: 5px;
-          }
-
-          .initiative {
-            font-size: 1.5em;
-            font-weight: bold;
-            text-align: right;
-          }
-
-          .hp-bar-bg {
-            width: 100%;
-            height: 20px;
-            background: #801401;
-            border-radius: 5px;
-            overflow: hidden;
-            margin-bottom: 5px;
-          }
-
-          .hp-bar {
-            height: 100%;
-            background: green;
-            width: 100%;
-            transition: width 0.3s;
-          }
-
-          .hp-text {
-            font-size: 0.9em;
-            margin-top: 5px;
-          }
-
-          img {
-            max-width: 100%;
-            max-height: 120px;
-            display: block;
-            margin: auto;
-          }
-          
-          .raindrop {
-            width: 2px;
-            height: 20px;
-            background-color: white;
-            animation: fall linear infinite;
-            position: absolute;
-            top: 0;
-          }
-          
-          .fog {
-            width: 1600px;
-            height: 1000px;
-            background-image: url('static/utility/fog.png');
-            background-position: center;
-            background-repeat: no-repeat;
-            background-size: cover;
-            animation: simmerLeft 100000s linear infinite;
-            position: absolute;
-            top: 0;
-          }
-
-          @keyframes fall {
-            from { top: -20px; }
-            to { top: 100vh; }
-          }
-          
-          @keyframes simmerLeft {
-            from { left: -1600px; }
-            to { left: 20vw; }
-          }
-        </style>
-
-        <script>
-        function render(chars) {
-            let div = document.getElementById("chars");
-            div.innerHTML = "";
-            for (let c in chars) {
-                let char = chars[c];
-                let hpPercent = (Math.max(0, char.hp) / Math.max(char.hp, char.maxHp)) * 100;
-                div.innerHTML += `<div class="char">
-                  <div class="name">${c}<div class="initiative">${char.initiative}</div></div>
-                  <div class="hp-bar-bg">
-                      <div class="hp-bar" style="width:${hpPercent}%;"></div>
-                  </div>
-                  ${char.image ? `<img src="${char.image}" width="150">` : ""}
-                  <div class="hp-text">HP: ${char.hp} / ${char.maxHp}</div>
-                  <div class="abilities">
-                    Abilities: ${
-                      char.abilities && char.abilityAvailable
-                        ? char.abilities
-                            .split(",")
-                            .filter((a, i) => char.abilityAvailable.split(",")[i] === "1")
-                            .join(", ") || "None"
-                        : "None"
-                  }</div>                
-                </div>`;
-            }
-        }
+from assets import static_url
+from bundles import Asset, build_page
+
+DISPLAY_HTML = """
+<h1>Battlefield</h1>
+<div id="header"></div>
+<div id="turn"></div>
+<div id="weather-effects"></div>
+<div id="weather"></div>
+<div id="chars"></div>
+"""
+
+DISPLAY_CSS = """
+body {
+  font-family: sans-serif;
+  background: grey;
+  color: white;
+  text-align: center;
+  margin: 0;
+  padding: 0;
+  overflow: hidden;
+}
+
+#weather-effects {
+  position: fixed;
+  top: 0;
+  left: 0;
+  width: 100vw;
+  height: 100vh;
+  pointer-events: none;
+  z-index: 0;
+}
+
+#header, #turn, #weather, #chars, #render-stats {
+  position: relative;
+  z-index: 1;
+}
+
+#chars {
+  display: flex;
+  justify-content: center;
+  align-items: flex-start;
+  gap: 10px; 
+  overflow: hidden;
+  padding: 10px;
+}
+
+.char {
+  margin: 10px;
+  padding: 10px;
+  border: 2px solid white;
+  background: #111;
+  flex: 1 1 180px;   
+  max-width: 220px;
+  text-align: center;
+}
+
+.char.current {
+  border-color: gold;
+  box-shadow: 0 0 12px gold;
+}
+
+.name {
+  font-size: 1.2em;
+  margin-bottom: 5px;
+}
+
+.initiative {
+  font-size: 1.5em;
+  font-weight: bold;
+  text-align: right;
+}
+
+.hp-bar-bg {
+  width: 100%;
+  height: 20px;
+  background: #801401;
+  border-radius: 5px;
+  overflow: hidden;
+  margin-bottom: 5px;
+}
+
+.hp-bar {
+  height: 100%;
+  background: green;
+  width: 100%;
+  transition: width 0.3s;
+}
+
+#render-stats {
+  font-size: 0.8em;
+  opacity: 0.7;
+}
+
+.hp-text {
+  font-size: 0.9em;
+  margin-top: 5px;
+}
 
-        function rerenderBackground(data) {
-            if (!data || !data.background) {
-                document.body.style.background = ``;
-                return;
-            };
-            document.body.style.backgroundImage = `url('static/backgrounds/${data.background}')`;
-            document.body.style.backgroundRepeat = 'no-repeat';
-            document.body.style.backgroundPosition = 'center center';
+img {
+  max-width: 100%;
+  max-height: 120px;
+  display: block;
+  margin: auto;
+}
+
+#weather-effects canvas {
+  width: 100%;
+  height: 100%;
+  display: block;
+}
+"""
+
+DISPLAY_JS = """
+const charViews = new Map();
+const renderStats = {updates: 0, lastMs: 0, maxMs: 0, averageMs: 0, characters: 0};
+
+function createCharView(name) {
+    const root = document.createElement("div");
+    root.className = "char";
+    root.dataset.name = name;
+    root.innerHTML = `<div class="name"><span></span><div class="initiative"></div></div>
+      <div class="hp-bar-bg"><div class="hp-bar"></div></div>
+      <a target="_blank"><img width="150" hidden></a>
+      <div class="hp-text"></div>
+      <div class="abilities"></div>
+      <div class="effects" hidden></div>`;
+    root.querySelector(".name span").textContent = name;
+    return {
+        root: root,
+        initiative: root.querySelector(".initiative"),
+        hpBar: root.querySelector(".hp-bar"),
+        image: root.querySelector("img"),
+        original: root.querySelector("a"),
+        hpText: root.querySelector(".hp-text"),
+        abilities: root.querySelector(".abilities"),
+        effects: root.querySelector(".effects"),
+        shown: {},
+    };
+}
+
+function setShown(view, key, value, apply) {
+    if (view.shown[key] !== value) {
+        view.shown[key] = value;
+        apply(value);
+    }
+}
+
+// Character entries use short field ids: h hp, m maxHp, i image, s imageSet,
+// n initiative, a [[ability, available], ...], e [[effect, untilRound, expiresAt], ...],
+// o the original upload, r when the character joined.
+function visibleAbilities(char) {
+    return char.a.filter(([, available]) => available).map(([ability]) => ability).join(", ") || "None";
+}
+
+function describeEffect([effect, untilRound, expiresAt]) {
+    const parts = [];
+    if (untilRound) parts.push(`until round ${untilRound}`);
+    if (expiresAt) parts.push(`until ${new Date(expiresAt * 1000).toLocaleTimeString()}`);
+    return parts.length ? `${effect} (${parts.join(" or ")})` : effect;
+}
+
+function updateCharView(view, char) {
+    const hpPercent = (Math.max(0, char.h) / Math.max(char.h, char.m)) * 100;
+    setShown(view, "width", hpPercent + "%", value => view.hpBar.style.width = value);
+    setShown(view, "initiative", String(char.n), value => view.initiative.textContent = value);
+    setShown(view, "hp", `HP: ${char.h} / ${char.m}`, value => view.hpText.textContent = value);
+    setShown(view, "abilities", "Abilities: " + visibleAbilities(char), value => view.abilities.textContent = value);
+    setShown(view, "effects", char.e.map(describeEffect).join(", "), value => {
+        view.effects.hidden = !value;
+        view.effects.textContent = value;
+    });
+    setShown(view, "image", char.i || "", value => {
+        view.image.hidden = !value;
+        if (value) view.image.src = value;
+    });
+    setShown(view, "imageSet", char.s || "", value => {
+        if (value) view.image.srcset = value;
+        else view.image.removeAttribute("srcset");
+    });
+    // The portrait shows a small variant; clicking it opens the full-size upload.
+    setShown(view, "original", char.o || "", value => {
+        if (value) view.original.href = value;
+        else view.original.removeAttribute("href");
+    });
+}
+
+function renderCharacter(container, name, char) {
+    let view = charViews.get(name);
+    if (!view) {
+        view = createCharView(name);
+        charViews.set(name, view);
+        container.appendChild(view.root);
+    }
+    updateCharView(view, char);
+}
+
+function removeCharacter(name) {
+    const view = charViews.get(name);
+    if (view) {
+        view.root.remove();
+        charViews.delete(name);
+    }
+}
+
+function render(chars, changed, removed, moved) {
+    const start = performance.now();
+    const container = document.getElementById("chars");
+    if (changed === undefined) {
+        for (const name of Array.from(charViews.keys())) {
+            if (!(name in chars)) removeCharacter(name);
+        }
+        for (const name of Object.keys(chars).sort(byInitiative)) {
+            renderCharacter(container, name, chars[name]);
+            container.appendChild(charViews.get(name).root);
         }
-        
-        function rain() {
-            const raindrop = document.createElement('div');
-            raindrop.classList.add('raindrop');
-            raindrop.style.left = Math.random() * window.innerWidth + 'px';
-            raindrop.style.animationDuration = (0.5 + Math.random()) + 's';
-            document.getElementById('weather-effects').appendChild(raindrop);
-            setTimeout(() => {
-                raindrop.remove();
-            }, 2000);
+    } else {
+        for (const name of removed) removeCharacter(name);
+        for (const name of changed) {
+            if (chars[name]) renderCharacter(container, name, chars[name]);
         }
+        placeViews(container, moved.filter(name => chars[name]));
+    }
+    recordRender(performance.now() - start);
+}
 
-        function fog() {
-            const fog = document.createElement('div');
-            fog.classList.add('fog');
-            fog.style.left = '-1600px';
-            fog.style.animationDuration = (0.5 + Math.random()) + 's';
-            document.getElementById('weather-effects').appendChild(fog);
-            setTimeout(() => {
-                fog.remove();
-            }, 3000);
+// Initiative order: highest initiative first, ties in the order characters joined.
+function byInitiative(a, b) {
+    const x = state.characters[a], y = state.characters[b];
+    return y.n - x.n || x.r - y.r;
+}
+
+// Names whose initiative or arrival came in the patch, so whose place may have changed.
+function movedNames(changed) {
+    return Object.keys(changed).filter(name => "n" in changed[name] || "r" in changed[name]);
+}
+
+// Patches carry no order. Views whose place may have changed are taken out and put back
+// by binary search among the rest, which are still in order.
+function placeViews(container, names) {
+    for (const name of names) charViews.get(name).root.remove();
+    for (const name of names) {
+        const views = container.children;
+        let low = 0, high = views.length;
+        while (low < high) {
+            const mid = (low + high) >> 1;
+            if (byInitiative(views[mid].dataset.name, name) < 0) low = mid + 1;
+            else high = mid;
         }
-        
-        function startRain() {
-            if (rainInterval === null) {
-                rainInterval = setInterval(rain, 100);
+        container.insertBefore(charViews.get(name).root, views[low] || null);
+    }
+}
+
+let currentTurn = null;
+
+function showTurn(turn, round) {
+    const previous = charViews.get(currentTurn);
+    if (previous) previous.root.classList.remove("current");
+    currentTurn = turn;
+    const view = charViews.get(turn);
+    if (view) view.root.classList.add("current");
+    document.getElementById("turn").textContent = turn === null ? "" : `Round ${round}: ${turn}`;
+}
+
+function recordRender(elapsed) {
+    renderStats.updates += 1;
+    renderStats.lastMs = elapsed;
+    renderStats.maxMs = Math.max(renderStats.maxMs, elapsed);
+    renderStats.averageMs += (elapsed - renderStats.averageMs) / Math.min(renderStats.updates, 100);
+    renderStats.characters = charViews.size;
+    const overlay = document.getElementById("render-stats");
+    if (overlay) {
+        overlay.textContent = `render ${elapsed.toFixed(2)} ms (avg ${renderStats.averageMs.toFixed(2)}, ` +
+            `max ${renderStats.maxMs.toFixed(2)}) for ${renderStats.characters} characters`;
+    }
+}
+
+if (new URLSearchParams(location.search).has("stats")) {
+    const overlay = document.createElement("div");
+    overlay.id = "render-stats";
+    document.body.appendChild(overlay);
+}
+
+function rerenderBackground(data) {
+    if (!data || !data.background) {
+        document.body.style.background = ``;
+        return;
+    };
+    document.body.style.backgroundImage = `url('${data.backgroundUrl}')`;
+    document.body.style.backgroundRepeat = 'no-repeat';
+    document.body.style.backgroundPosition = 'center center';
+}
+
+const fogImage = new Image();
+fogImage.src = "{fog_url}";
+
+// Each weather effect owns a slice of the shared particle pool. To support a new
+// utility.Weather member, add an entry here and a label in WEATHER_LABELS.
+const WEATHER_EFFECTS = {
+    rain: {
+        maxParticles: 400,
+        spawnPerSecond: 200,
+        spawn(p, width, height, initial) {
+            p.x = Math.random() * width;
+            p.y = initial ? Math.random() * height : -20;
+            p.vx = 0;
+            p.vy = height / (0.5 + Math.random());
+            p.size = 20;
+        },
+        step(p, dt, width, height) {
+            p.y += p.vy * dt;
+            return p.y < height;
+        },
+        draw(ctx, particles, count) {
+            ctx.strokeStyle = "rgba(255, 255, 255, 0.8)";
+            ctx.lineWidth = 2;
+            ctx.beginPath();
+            for (let i = 0; i < count; i++) {
+                const p = particles[i];
+                ctx.moveTo(p.x, p.y);
+                ctx.lineTo(p.x, p.y + p.size);
             }
-        }
-        
-        function startFog() {
-            if (fogInterval === null) {
-                fogInterval = setInterval(fog, 3000);
+            ctx.stroke();
+        },
+    },
+    fog: {
+        maxParticles: 8,
+        spawnPerSecond: 1,
+        spawn(p, width, height, initial) {
+            p.size = Math.max(width, height) * (0.6 + Math.random() * 0.4);
+            p.x = initial ? Math.random() * width - p.size / 2 : -p.size;
+            p.y = Math.random() * height - p.size / 2;
+            p.vx = width / (20 + Math.random() * 20);
+            p.vy = 0;
+            p.alpha = 0.3 + Math.random() * 0.4;
+        },
+        step(p, dt, width, height) {
+            p.x += p.vx * dt;
+            return p.x < width;
+        },
+        draw(ctx, particles, count) {
+            if (!fogImage.complete || fogImage.naturalWidth === 0) return;
+            for (let i = 0; i < count; i++) {
+                const p = particles[i];
+                ctx.globalAlpha = p.alpha;
+                ctx.drawImage(fogImage, p.x, p.y, p.size, p.size * fogImage.naturalHeight / fogImage.naturalWidth);
             }
+            ctx.globalAlpha = 1;
+        },
+    },
+};
+
+const WEATHER_LABELS = {rain: "🌧️ Raining", fog: "🌫️ Foggy", clear: "☀️ Clear"};
+
+const POOL_SIZE = Math.max(...Object.values(WEATHER_EFFECTS).map(effect => effect.maxParticles));
+const FRAME_BUDGET_MS = 1000 / 50;
+
+const weatherEngine = {
+    canvas: null,
+    ctx: null,
+    effect: null,
+    particles: Array.from({length: POOL_SIZE}, () => ({x: 0, y: 0, vx: 0, vy: 0, size: 0, alpha: 1})),
+    active: 0,
+    density: 1,
+    frameMs: 16,
+    spawnBudget: 0,
+    lastTime: null,
+    frame: null,
+
+    init() {
+        this.canvas = document.createElement("canvas");
+        this.ctx = this.canvas.getContext("2d");
+        document.getElementById("weather-effects").appendChild(this.canvas);
+        this.resize();
+        window.addEventListener("resize", () => this.resize());
+    },
+
+    resize() {
+        this.canvas.width = window.innerWidth;
+        this.canvas.height = window.innerHeight;
+    },
+
+    start(effect) {
+        if (this.effect === effect) return;
+        this.effect = effect;
+        this.active = 0;
+        this.spawnBudget = 0;
+        const initial = Math.floor(effect.maxParticles * this.density / 2);
+        while (this.active < initial) {
+            effect.spawn(this.particles[this.active++], this.canvas.width, this.canvas.height, true);
+        }
+        if (this.frame === null) {
+            this.lastTime = null;
+            this.frame = requestAnimationFrame(time => this.tick(time));
         }
+    },
 
-        function clearRaindrops() {
-            document.querySelectorAll('.raindrop').forEach(drop => drop.remove());
-            clearInterval(rainInterval);
-            rainInterval = null;
+    stop() {
+        this.effect = null;
+        this.active = 0;
+        if (this.frame !== null) {
+            cancelAnimationFrame(this.frame);
+            this.frame = null;
         }
+        this.ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
+    },
 
-        function clearFog() {
-            document.querySelectorAll('.fog').forEach(cloud => cloud.remove());
-            clearInterval(fogInterval);
-            fogInterval = null;
+    adaptDensity(elapsedMs) {
+        // Shed particles quickly when frames run long and win them back slowly, so weak
+        // display machines settle on what they can draw without stuttering the HP bars.
+        this.frameMs += (elapsedMs - this.frameMs) * 0.1;
+        if (this.frameMs > FRAME_BUDGET_MS) {
+            this.density = Math.max(0.1, this.density * 0.95);
+        } else {
+            this.density = Math.min(1, this.density + 0.005);
         }
-        
-        function updateWeather(weather) {
-            if (weather === "rain") {
-                console.log("Starting rain");
-                document.getElementById("weather").innerText = "🌧️ Raining";
-                clearFog();
-                startRain();
-            } else if (weather === "fog") {
-                console.log("Starting fog");
-                document.getElementById("weather").innerText = "🌫️ Foggy";
-                clearRaindrops();
-                startFog();
+    },
+
+    tick(time) {
+        this.frame = requestAnimationFrame(next => this.tick(next));
+        const elapsedMs = this.lastTime === null ? 16 : Math.min(time - this.lastTime, 250);
+        this.lastTime = time;
+        this.adaptDensity(elapsedMs);
+
+        const effect = this.effect;
+        const width = this.canvas.width;
+        const height = this.canvas.height;
+        const dt = elapsedMs / 1000;
+        const target = Math.floor(effect.maxParticles * this.density);
+
+        // Swap-remove finished particles so the live ones stay packed at the front.
+        for (let i = 0; i < this.active;) {
+            if (effect.step(this.particles[i], dt, width, height) && i < target) {
+                i++;
             } else {
-                console.log("Clearing weather effects");
-                document.getElementById("weather").innerText = "☀️ Clear";
-                clearRaindrops();
-                clearFog();
+                this.active--;
+                const finished = this.particles[i];
+                this.particles[i] = this.particles[this.active];
+                this.particles[this.active] = finished;
             }
         }
-              
-        let rainInterval = null;
-        let fogInterval = null
-
-        let ws = new WebSocket("ws://" + location.host + "/ws");
-        ws.onmessage = (msg)=>{
-            let data = JSON.parse(msg.data);
-            if (data.characters) render(data.characters);
-            if (data.background) {
-                rerenderBackground(data);
-            }
-            if (data.weather) {
-                updateWeather(data.weather);
-            }
-        };
-        </script>
-        """)
 
+        this.spawnBudget += effect.spawnPerSecond * dt;
+        while (this.spawnBudget >= 1 && this.active < target) {
+            effect.spawn(this.particles[this.active++], width, height, false);
+            this.spawnBudget -= 1;
+        }
+        this.spawnBudget = Math.min(this.spawnBudget, 1);
+
+        this.ctx.clearRect(0, 0, width, height);
+        effect.draw(this.ctx, this.particles, this.active);
+    },
+};
+
+weatherEngine.init();
+
+function updateWeather(weather) {
+    document.getElementById("weather").innerText = WEATHER_LABELS[weather] || weather;
+    const effect = WEATHER_EFFECTS[weather];
+    if (effect) {
+        weatherEngine.start(effect);
+    } else {
+        weatherEngine.stop();
+    }
+}
+
+let state = {version: null, characters: {}, awaitingSnapshot: false};
+
+function applyMessage(data) {
+    if (data.characters) {
+        state.characters = data.characters;
+        state.version = data.version;
+        state.awaitingSnapshot = false;
+        return true;
+    }
+    if (data.base === undefined) return true;
+    if (data.base !== state.version) {
+        if (!state.awaitingSnapshot) {
+            state.awaitingSnapshot = true;
+            ws.send(JSON.stringify({type: "snapshot"}));
+        }
+        return false;
+    }
+    for (let name of data.removed || []) delete state.characters[name];
+    for (let name in data.changed || {}) {
+        state.characters[name] = Object.assign(state.characters[name] || {}, data.changed[name]);
+    }
+    state.version = data.version;
+    return true;
+}
+
+const roomBase = location.pathname.slice(0, -"/display".length);
+let ws = new WebSocket((location.protocol === "https:" ? "wss://" : "ws://") + location.host + roomBase + "/ws");
+ws.onmessage = (msg)=>{
+    let data = JSON.parse(msg.data);
+    if (!applyMessage(data)) return;
+    if (data.characters) {
+        render(state.characters);
+    } else if (data.changed || data.removed) {
+        const changed = data.changed || {};
+        render(state.characters, Object.keys(changed), data.removed || [], movedNames(changed));
+    }
+    // Advancing a turn sends only the pointer; the rest of the roster is untouched.
+    if (data.turn !== undefined) showTurn(data.turn, data.round);
+    if (data.background) {
+        rerenderBackground(data);
+    }
+    if (data.weather) {
+        updateWeather(data.weather);
+    }
+};
+"""
+
+
+def build_display_page() -> Asset:
+    js = DISPLAY_JS.replace("{fog_url}", static_url("utility/fog.png"))
+    return build_page("display", "Battlefield", DISPLAY_HTML, DISPLAY_CSS, js)
@@ -0,0 +1,87 @@
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tornado.ioloop
+
+# Expirations this close together go out in the same broadcast.
+EXPIRY_TOLERANCE_SECONDS = 0.1
+
+# (character name, effect name)
+EffectKey = Tuple[str, str]
+
+
+class ExpiryQueue:
+    # A min-heap of deadlines. Rescheduled and cancelled keys are dropped lazily when
+    # they reach the top, so every operation is O(log n) and a tick that has nothing
+    # due only looks at the top entry.
+    def __init__(self) -> None:
+        self._heap: List[Tuple[float, int, EffectKey]] = []
+        self._deadlines: Dict[EffectKey, float] = {}
+        self._pushed = 0
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def push(self, key: EffectKey, deadline: float) -> None:
+        self._deadlines[key] = deadline
+        self._pushed += 1
+        heapq.heappush(self._heap, (deadline, self._pushed, key))
+        self._compact()
+
+    def discard(self, key: EffectKey) -> None:
+        if self._deadlines.pop(key, None) is not None:
+            self._compact()
+
+    def _is_live(self, entry: Tuple[float, int, EffectKey]) -> bool:
+        return self._deadlines.get(entry[2]) == entry[0]
+
+    def _compact(self) -> None:
+        # Rebuilding once stale entries dominate keeps memory proportional to the live
+        # count.
+        if len(self._heap) > 2 * len(self._deadlines) + 16:
+            self._heap = [entry for entry in self._heap if self._is_live(entry)]
+            heapq.heapify(self._heap)
+
+    def peek(self) -> Optional[float]:
+        while self._heap and not self._is_live(self._heap[0]):
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: float) -> List[EffectKey]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._is_live(entry):
+                del self._deadlines[entry[2]]
+                due.append(entry[2])
+        return due
+
+
+class ExpiryTimer:
+    # One IOLoop timeout per room, always set for the earliest wall-clock deadline.
+    def __init__(self, callback: Callable[[], None]) -> None:
+        self._callback = callback
+        self._deadline: Optional[float] = None
+        self._timeout: Optional[object] = None
+
+    def schedule(self, deadline: Optional[float]) -> None:
+        if deadline == self._deadline:
+            return
+        self.cancel()
+        if deadline is None:
+            return
+        loop = tornado.ioloop.IOLoop.current()
+        self._deadline = deadline
+        self._timeout = loop.call_at(loop.time() + max(0.0, deadline - time.time()), self._fire)
+
+    def cancel(self) -> None:
+        if self._timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self._timeout)
+        self._timeout = None
+        self._deadline = None
+
+    def _fire(self) -> None:
+        self._timeout = None
+        self._deadline = None
+        self._callback()
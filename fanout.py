@@ -0,0 +1,216 @@
+import json
+import logging
+import time
+from asyncio import Future
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, Optional, Union
+
+import tornado.ioloop
+import tornado.websocket
+
+from metrics import SENT_BYTES
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+BROADCAST_WINDOW_SECONDS = 0.03
+MAX_QUEUED_MESSAGES = 8
+STALL_TIMEOUT_SECONDS = 15.0
+# Patches are small and repeat the same keys and names, so with context takeover even
+# the fastest zlib level removes most of them; a smaller memLevel keeps the deflate
+# state per display socket down.
+WS_COMPRESSION_OPTIONS = {"compression_level": 1, "mem_level": 6}
+
+Payload = Union[str, bytes]
+
+logger = logging.getLogger(__name__)
+
+
+def encode_message(message: Dict[str, Any]) -> str:
+    return json.dumps(message, separators=(",", ":"), allow_nan=False)
+
+
+WIRE_ENCODERS: Dict[str, Callable[[Dict[str, Any]], Payload]] = {"json": encode_message}
+WIRE_DECODERS: Dict[str, Callable[[Payload], Any]] = {"json": json.loads}
+if msgpack is not None:
+    WIRE_ENCODERS["msgpack"] = msgpack.packb
+    WIRE_DECODERS["msgpack"] = msgpack.unpackb
+
+
+def encode_as(wire_format: str, message: Dict[str, Any]) -> Payload:
+    return WIRE_ENCODERS[wire_format](message)
+
+
+def fan_out(clients: Iterable[Any], message: Dict[str, Any],
+            encoded: Optional[Dict[str, Payload]] = None) -> Dict[str, Payload]:
+    # Encode once per wire format in use and hand every socket of that format the same
+    # payload; passing the dict would make tornado encode it again for each client.
+    encoded = dict(encoded or {})
+    for c in list(clients):
+        payload = encoded.get(c.wire_format)
+        if payload is None:
+            payload = encoded[c.wire_format] = encode_as(c.wire_format, message)
+        c.send(payload)
+    return encoded
+
+
+class OutboundQueue:
+    def __init__(self, handler: tornado.websocket.WebSocketHandler, snapshot: Callable[[], Payload],
+                 max_depth: int = MAX_QUEUED_MESSAGES, stall_timeout: float = STALL_TIMEOUT_SECONDS) -> None:
+        self._handler = handler
+        self._snapshot = snapshot
+        self._max_depth = max_depth
+        self._stall_timeout = stall_timeout
+        self._queue: Deque[Payload] = deque()
+        self._in_flight_since: Optional[float] = None
+        self._needs_snapshot = False
+        self._sent = 0
+        self._dropped = 0
+        self._resyncs = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue) + (self._in_flight_since is not None)
+
+    @property
+    def sent(self) -> int:
+        return self._sent
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def resyncs(self) -> int:
+        return self._resyncs
+
+    def stalled_for(self) -> float:
+        if self._in_flight_since is None:
+            return 0.0
+        return time.monotonic() - self._in_flight_since
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "depth": self.depth,
+            "sent": self._sent,
+            "dropped": self._dropped,
+            "resyncs": self._resyncs,
+            "stalledFor": round(self.stalled_for(), 3),
+        }
+
+    def send(self, payload: Payload) -> None:
+        if self.stalled_for() > self._stall_timeout:
+            logger.info("Closing client stalled for %.1fs", self.stalled_for())
+            self._handler.close(1013, "Slow consumer")
+            return
+
+        if self._needs_snapshot:
+            self._dropped += 1
+            return
+        if len(self._queue) >= self._max_depth:
+            # Queued patches only matter as a chain; once the client is this far behind,
+            # drop them all and let a fresh snapshot carry the latest state instead.
+            self._dropped += len(self._queue) + 1
+            self._queue.clear()
+            self._needs_snapshot = True
+            return
+
+        self._queue.append(payload)
+        self._pump()
+
+    def resync(self) -> None:
+        self._dropped += len(self._queue)
+        self._queue.clear()
+        self._needs_snapshot = True
+        self._pump()
+
+    def _pump(self) -> None:
+        if self._in_flight_since is not None:
+            return
+        if self._queue:
+            payload = self._queue.popleft()
+        elif self._needs_snapshot:
+            payload = self._snapshot()
+            self._needs_snapshot = False
+            self._resyncs += 1
+        else:
+            return
+
+        try:
+            future = self._handler.write_message(payload, binary=isinstance(payload, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            return
+        SENT_BYTES.inc(len(payload))
+        self._in_flight_since = time.monotonic()
+        future.add_done_callback(self._on_written)
+
+    def _on_written(self, future: Future) -> None:
+        self._in_flight_since = None
+        if future.exception() is not None:
+            return
+        self._sent += 1
+        self._pump()
+
+
+class BroadcastScheduler:
+    def __init__(self, flush: Callable[[], None], window: float = BROADCAST_WINDOW_SECONDS) -> None:
+        self._flush_callback = flush
+        self._window = window
+        self._pending = 0
+        self._timeout: Optional[object] = None
+        self._last_flush = float("-inf")
+        self._last_merged = 0
+        self._flushes = 0
+        self._mutations = 0
+
+    @property
+    def window(self) -> float:
+        return self._window
+
+    @window.setter
+    def window(self, window: float) -> None:
+        self._window = window
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def last_merged(self) -> int:
+        return self._last_merged
+
+    @property
+    def flushes(self) -> int:
+        return self._flushes
+
+    @property
+    def mutations(self) -> int:
+        return self._mutations
+
+    def mark_dirty(self, urgent: bool = False) -> None:
+        self._pending += 1
+        self._mutations += 1
+        if urgent or self._window <= 0:
+            self.flush()
+            return
+        if self._timeout is None:
+            loop = tornado.ioloop.IOLoop.current()
+            delay = max(0.0, self._last_flush + self._window - loop.time())
+            self._timeout = loop.call_later(delay, self.flush)
+
+    def flush(self) -> None:
+        loop = tornado.ioloop.IOLoop.current()
+        if self._timeout is not None:
+            loop.remove_timeout(self._timeout)
+            self._timeout = None
+
+        merged = self._pending
+        self._pending = 0
+        self._last_flush = loop.time()
+        self._last_merged = merged
+        self._flushes += 1
+        if merged > 1:
+            logger.debug("Broadcast merged %d mutations", merged)
+        self._flush_callback()
@@ -0,0 +1,74 @@
+from collections import deque
+from typing import Any, Deque, Dict, List, Tuple
+
+from character import WebpageData
+from commands import CommandError, start_recording
+
+HISTORY_LIMIT = 200
+# Images kept across every entry; a 500 goblin spawn counts as 1000 (before and after).
+HISTORY_MAX_IMAGES = 10000
+HISTORY_COMMANDS = {"undo", "redo"}
+# Changes the DM did not make themselves; undo steps over them.
+UNRECORDED_COMMANDS = {"expireEffects"}
+
+Images = Dict[str, Any]
+
+
+def _size(images: Images) -> int:
+    return sum(len(value) if key == "characters" else 1 for key, value in images.items())
+
+
+class History:
+    # Each entry keeps only the entities its command touched, as they were before and
+    # after, so undoing N steps costs the entities those steps changed.
+    def __init__(self, limit: int = HISTORY_LIMIT, max_images: int = HISTORY_MAX_IMAGES) -> None:
+        self._limit = limit
+        self._max_images = max_images
+        self._undo: Deque[Tuple[Images, Images]] = deque()
+        self._redo: List[Tuple[Images, Images]] = []
+        self._images = 0
+
+    def __len__(self) -> int:
+        return len(self._undo)
+
+    @property
+    def images(self) -> int:
+        return self._images
+
+    def begin(self, webpage_data: WebpageData, ops: List[Any]) -> None:
+        start_recording(webpage_data, ops)
+
+    def commit(self, webpage_data: WebpageData, ops: List[Any]) -> None:
+        before, after = webpage_data.stop_recording()
+        recorded = any(isinstance(op, dict) and str(op.get("op")) not in UNRECORDED_COMMANDS for op in ops)
+        if not before or not recorded:
+            return
+        for entry in self._redo:
+            self._images -= _size(entry[0]) + _size(entry[1])
+        self._redo = []
+        self._undo.append((before, after))
+        self._images += _size(before) + _size(after)
+        # The oldest entries fall off, so memory stays flat however long the session runs.
+        while len(self._undo) > 1 and (len(self._undo) > self._limit or self._images > self._max_images):
+            dropped = self._undo.popleft()
+            self._images -= _size(dropped[0]) + _size(dropped[1])
+
+    def abort(self, webpage_data: WebpageData) -> None:
+        # A command that failed leaves things as they were and no undo step behind.
+        before, _ = webpage_data.stop_recording()
+        webpage_data.restore_entities(before)
+
+    def resolve(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        if op["op"] == "undo":
+            if not self._undo:
+                raise CommandError("Nothing to undo")
+            entry = self._undo.pop()
+            self._redo.append(entry)
+            images = entry[0]
+        else:
+            if not self._redo:
+                raise CommandError("Nothing to redo")
+            entry = self._redo.pop()
+            self._undo.append(entry)
+            images = entry[1]
+        return {"op": "restoreEntities", "images": images}
@@ -0,0 +1,123 @@
+import logging
+import os
+import re
+from asyncio import Future
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import tornado.ioloop
+
+from uploads import IMAGE_DIR
+from utility import STATIC_DIR
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+VARIANT_DIR = IMAGE_DIR / "variants"
+# The display draws portraits at 150px wide and at most 120px high; the 2x variant
+# keeps them sharp on high-density screens.
+PORTRAIT_SIZES = ((150, 120), (300, 240))
+VARIANT_FORMAT = "webp"
+VARIANT_QUALITY = 80
+
+_HASHED_IMAGE = re.compile(r"^/static/images/([0-9a-f]{64})\.\w+$")
+_VARIANT_FILE = re.compile(r"^([0-9a-f]{64})-(\d+)\." + VARIANT_FORMAT + "$")
+
+_variants: Dict[str, Dict[int, str]] = {}
+_pending: Dict[str, Future] = {}
+_executor: Optional[ProcessPoolExecutor] = None
+
+logger = logging.getLogger(__name__)
+
+
+def _variant_name(digest: str, width: int) -> str:
+    return f"{digest}-{width}.{VARIANT_FORMAT}"
+
+
+def _variant_url(name: str) -> str:
+    return f"/static/images/variants/{name}"
+
+
+def _render_variants(source: str, digest: str) -> List[Tuple[int, str]]:
+    VARIANT_DIR.mkdir(parents=True, exist_ok=True)
+    rendered = []
+    with Image.open(source) as original:
+        original.load()
+        for width, height in PORTRAIT_SIZES:
+            name = _variant_name(digest, width)
+            target = VARIANT_DIR / name
+            if not target.exists():
+                variant = original.copy()
+                variant.thumbnail((width, height))
+                if variant.mode not in ("RGB", "RGBA"):
+                    variant = variant.convert("RGBA")
+                temp = target.with_suffix(".part")
+                variant.save(temp, format=VARIANT_FORMAT, quality=VARIANT_QUALITY)
+                os.replace(temp, target)
+            rendered.append((width, name))
+    return rendered
+
+
+def load_existing_variants() -> None:
+    if not VARIANT_DIR.is_dir():
+        return
+    for name in os.listdir(VARIANT_DIR):
+        match = _VARIANT_FILE.match(name)
+        if match:
+            _variants.setdefault(match.group(1), {})[int(match.group(2))] = _variant_url(name)
+
+
+def register_variants(image_url: str) -> bool:
+    # Picks up variants that another worker process rendered.
+    match = _HASHED_IMAGE.match(image_url)
+    if match is None:
+        return False
+    digest = match.group(1)
+    rendered = {
+        width: _variant_url(_variant_name(digest, width))
+        for width, _ in PORTRAIT_SIZES if (VARIANT_DIR / _variant_name(digest, width)).exists()
+    }
+    if not rendered:
+        return False
+    _variants[digest] = rendered
+    return True
+
+
+def portrait_urls(image_url: str) -> Tuple[str, str]:
+    match = _HASHED_IMAGE.match(image_url)
+    variants = _variants.get(match.group(1)) if match else None
+    if not variants:
+        return image_url, ""
+    smallest = min(variants)
+    image_set = ", ".join(f"{url} {width // smallest}x" for width, url in sorted(variants.items()))
+    return variants[smallest], image_set
+
+
+async def build_variants(image_url: str) -> bool:
+    global _executor
+    match = _HASHED_IMAGE.match(image_url)
+    if Image is None or match is None:
+        return False
+    digest = match.group(1)
+    if len(_variants.get(digest, ())) == len(PORTRAIT_SIZES):
+        return False
+
+    if digest not in _pending:
+        if _executor is None:
+            _executor = ProcessPoolExecutor()
+        source = str(STATIC_DIR / Path(image_url).relative_to("/static"))
+        _pending[digest] = tornado.ioloop.IOLoop.current().run_in_executor(_executor, _render_variants, source, digest)
+    try:
+        rendered = await _pending[digest]
+    except Exception:
+        # Not every upload is an image Pillow can read; those keep using the original.
+        logger.warning("Could not build variants for %s", image_url, exc_info=True)
+        return False
+    finally:
+        _pending.pop(digest, None)
+
+    _variants[digest] = {width: _variant_url(name) for width, name in rendered}
+    return True
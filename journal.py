@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import tornado.ioloop
+
+from character import WebpageData
+from commands import CommandError, apply_command
+
+JOURNAL_FLUSH_SECONDS = 0.2
+SNAPSHOT_EVERY = 5000
+# Transport keys added by the WebSocket command channel; they don't affect state.
+_TRANSPORT_KEYS = ("type", "id")
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(record: Dict[str, Any]) -> str:
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+class Journal:
+    def __init__(self, directory: Path, snapshot_every: int = SNAPSHOT_EVERY) -> None:
+        self._directory = directory
+        self._journal_path = directory / "journal.jsonl"
+        self._snapshot_path = directory / "snapshot.json"
+        self._snapshot_every = snapshot_every
+        self._seq = 0
+        self._since_snapshot = 0
+        self._buffer: List[str] = []
+        self._file = None
+        # A single worker keeps journal writes and snapshot rotations in order.
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._flusher: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def recover(self, webpage_data: WebpageData) -> int:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        snapshot_seq = 0
+        if self._snapshot_path.exists():
+            with open(self._snapshot_path, encoding="utf-8") as f:
+                snapshot = json.load(f)
+            webpage_data.restore(snapshot["state"])
+            snapshot_seq = snapshot["seq"]
+        self._seq = snapshot_seq
+
+        replayed = 0
+        if self._journal_path.exists():
+            with open(self._journal_path, "r+b") as f:
+                end = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("no newline")
+                        record = json.loads(line)
+                    except ValueError:
+                        # A crash can leave the last line half-written. It is cut off, or
+                        # the next record appended would be glued onto it and lost too.
+                        logger.warning("Ignoring truncated journal record")
+                        f.truncate(end)
+                        break
+                    end += len(line)
+                    if record["seq"] <= snapshot_seq:
+                        continue
+                    try:
+                        apply_command(webpage_data, record["op"], internal=True)
+                    except CommandError:
+                        logger.warning("Journal record %d no longer applies", record["seq"])
+                    except Exception:
+                        # One bad record must not keep the room from starting.
+                        logger.exception("Journal record %d failed to replay", record["seq"])
+                    self._seq = record["seq"]
+                    replayed += 1
+        self._since_snapshot = replayed
+        self._file = open(self._journal_path, "a", encoding="utf-8")
+        return replayed
+
+    def start(self, flush_seconds: float = JOURNAL_FLUSH_SECONDS) -> None:
+        self._flusher = tornado.ioloop.PeriodicCallback(self.flush, flush_seconds * 1000)
+        self._flusher.start()
+
+    def append(self, op: Dict[str, Any], webpage_data: WebpageData) -> None:
+        self._seq += 1
+        self._since_snapshot += 1
+        self._buffer.append(_encode({"seq": self._seq, "op": {k: v for k, v in op.items() if k not in _TRANSPORT_KEYS}}))
+        if self._since_snapshot >= self._snapshot_every:
+            self.snapshot(webpage_data)
+
+    def _write(self, lines: List[str]) -> None:
+        self._file.writelines(lines)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def flush(self) -> None:
+        if not self._buffer or self._file is None:
+            return
+        lines, self._buffer = self._buffer, []
+        self._executor.submit(self._write, lines)
+
+    def _rotate(self, lines: List[str], snapshot: str) -> None:
+        self._write(lines)
+        temp_path = self._snapshot_path.with_suffix(".tmp")
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._snapshot_path)
+        # Everything up to the snapshot's seq is now covered, so the journal restarts.
+        self._file.close()
+        self._file = open(self._journal_path, "w", encoding="utf-8")
+
+    def snapshot(self, webpage_data: WebpageData) -> None:
+        if self._file is None:
+            return
+        lines, self._buffer = self._buffer, []
+        snapshot = json.dumps({"seq": self._seq, "state": webpage_data.to_state()}, separators=(",", ":"))
+        self._since_snapshot = 0
+        self._executor.submit(self._rotate, lines, snapshot)
+
+    def close(self) -> None:
+        if self._file is None:
+            return
+        if self._flusher is not None:
+            self._flusher.stop()
+        self.flush()
+        self._executor.shutdown(wait=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -1,28 +1,59 @@
 import json
 import os
-from typing import Any, Generator, Optional
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Generator, List, Tuple
 
+import tornado.autoreload
+import tornado.httpserver
 import tornado.ioloop
+import tornado.log
+import tornado.netutil
+import tornado.options
+import tornado.process
 import tornado.web
 import tornado.websocket
 
-from character import Character, WebpageData
-from control import ControlHandler
-from display import DisplayHandler
-from utility import STATIC_DIR, get_options, Weather
+from assets import CachedStaticFileHandler, precompress_static
+from bundles import BundleHandler, PageHandler
+from cluster import Cluster, bind_worker_sockets
+from commands import CommandError
+from control import build_control_page
+from display import build_display_page
+from fanout import (BROADCAST_WINDOW_SECONDS, WIRE_DECODERS, WIRE_ENCODERS, WS_COMPRESSION_OPTIONS, OutboundQueue,
+                    Payload, encode_as)
+from images import build_variants, load_existing_variants
+from metrics import (CONNECTED_CLIENTS, LOADED_ROOMS, LoopLagMonitor, MetricsHandler, ProfileHandler, log_request,
+                     set_const_label)
+from rooms import DEFAULT_ROOM, ROOM_ID_PATTERN, ROOM_IDLE_SECONDS, RoomRegistry
+from uploads import MAX_UPLOAD_BYTES, StreamingFormHandler
+from utility import OPTIONS_REFRESH_SECONDS, STATIC_DIR
 
-clients = set()
 assert os.path.isdir(STATIC_DIR)
-webpage_data = WebpageData()
-
-
-# TODO: Features:
-# status effects (poisoned, stunned, etc)
-
-
-def broadcast():
-    for c in list(clients):
-        c.write_message({"characters": webpage_data.get_roster()} | get_options() | webpage_data.get_selected_data())
+rooms = RoomRegistry()
+
+tornado.options.define("port", default=8888, type=int)
+tornado.options.define("data_dir", default=str(Path(__file__).parent / "data"),
+                       help="Directory for the mutation journal and state snapshots")
+tornado.options.define("production", default=False, type=bool,
+                       help="Disable autoreload and serve static assets with long-lived caching")
+tornado.options.define("broadcast_window", default=BROADCAST_WINDOW_SECONDS, type=float,
+                       help="Seconds to coalesce mutations into a single broadcast")
+tornado.options.define("max_upload_size", default=MAX_UPLOAD_BYTES, type=int,
+                       help="Largest accepted image upload in bytes")
+tornado.options.define("processes", default=1, type=int,
+                       help="Worker processes sharing the port; 0 starts one per CPU")
+tornado.options.define("profiling", default=False, type=bool,
+                       help="Enable /debug/profile, which records a cProfile for a time window")
+tornado.options.define("room_idle_seconds", default=ROOM_IDLE_SECONDS, type=float,
+                       help="Seconds without clients or mutations before a room is persisted and unloaded")
+
+
+async def refresh_portraits(image_url: str) -> None:
+    if await build_variants(image_url):
+        rooms.refresh_image(image_url)
+        if rooms.cluster is not None:
+            rooms.cluster.publish_image(image_url)
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -31,12 +62,74 @@ class MainHandler(tornado.web.RequestHandler):
 
 
 class WSHandler(tornado.websocket.WebSocketHandler):
-    def open(self):
-        clients.add(self)
-        self.write_message({"characters": webpage_data.get_roster()} | get_options() | webpage_data.get_selected_data())
+    def prepare(self):
+        # Negotiated before the upgrade, so a client asking for an encoding this server
+        # can't produce gets a plain 400 instead of frames it can't read.
+        self.wire_format = self.get_argument("format", "json")
+        if self.wire_format not in WIRE_ENCODERS:
+            raise tornado.web.HTTPError(400, "Unsupported format: %s", self.wire_format)
+
+    def get_compression_options(self):
+        return WS_COMPRESSION_OPTIONS
+
+    async def open(self, room_id: str = DEFAULT_ROOM):
+        self.room = rooms.get(room_id)
+        self.outbound = OutboundQueue(self, lambda: self.room.encoded_snapshot(self.wire_format))
+        self.room.add_client(self)
+        await self.room.ready()
+        self.outbound.resync()
+
+    def send(self, payload: Payload) -> None:
+        self.outbound.send(payload)
+
+    def write_ack(self, ack: Dict[str, Any]) -> None:
+        payload = encode_as(self.wire_format, ack)
+        try:
+            self.write_message(payload, binary=isinstance(payload, bytes))
+        except tornado.websocket.WebSocketClosedError:
+            # The client went away while its command ran; the change still stands.
+            pass
+
+    async def on_message(self, message):
+        try:
+            data = WIRE_DECODERS[self.wire_format](message)
+        except (ValueError, TypeError) as e:
+            # msgpack's decode errors are ValueError subclasses, as is JSONDecodeError.
+            self.write_ack({"ack": None, "status": "error", "error": f"Undecodable message: {e}"})
+            return
+        if not isinstance(data, dict):
+            self.write_ack({"ack": None, "status": "error", "error": "Expected an object"})
+            return
+        kind = data.get("type")
+        if kind == "snapshot":
+            self.outbound.resync()
+            return
+        # Every other message gets an ack, so a control page never waits on one forever.
+        ack: Dict[str, Any] = {"ack": data.get("id")}
+        try:
+            if kind == "command":
+                ack |= {"status": "ok"} | await self.room.submit(data)
+            elif kind == "batch":
+                ack |= {"status": "ok", "results": await self.room.submit_batch(data.get("ops"))}
+            else:
+                ack |= {"status": "error", "error": f"Unknown message type: {kind}"}
+        except CommandError as e:
+            ack |= {"status": "error", "error": str(e)}
+        except Exception:
+            tornado.log.app_log.exception("Command from %s failed", self.request.remote_ip)
+            ack |= {"status": "error", "error": "Internal error"}
+        self.write_ack(ack)
 
     def on_close(self):
-        clients.discard(self)
+        self.room.remove_client(self)
+
+
+class ClientStatsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"clients": [
+            {"room": room.room_id, "remote": c.request.remote_ip, "path": c.request.path} | c.outbound.stats()
+            for room in rooms for c in list(room.clients) if isinstance(c, WSHandler)
+        ]})
 
 
 class BaseCharacterHandler(tornado.web.RequestHandler):
@@ -44,128 +137,230 @@ class BaseCharacterHandler(tornado.web.RequestHandler):
         data = json.loads(self.request.body.decode())
         return (data.get(k, 0) for k in key)
 
-    @staticmethod
-    def get_character(name: str) -> Optional[Character]:
-        return webpage_data.get_character_by_name(name)
+    async def run_command(self, room_id: str, op: Dict[str, Any]) -> None:
+        try:
+            result = await rooms.get(room_id).submit(op)
+        except CommandError as e:
+            self.set_status(400)
+            self.write({"status": "error", "error": str(e)})
+            return
+        self.write({"status": "ok"} | result)
 
 
 class UpdateHpHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         name, delta = self.json_parse("name", "delta")
-        character = self.get_character(name)
-
-        if character is not None:
-            character.update_hp(name, character.hp + delta)
-            broadcast()
-        self.write({"status": "ok"})
+        await self.run_command(room_id, {"op": "update", "name": name, "delta": delta})
 
 
 class UpdateInitiativeHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         name, initiative = self.json_parse("name", "initiative")
-        character = webpage_data.get_character_by_name(name)
+        await self.run_command(room_id, {"op": "updateInitiative", "name": name, "initiative": initiative})
+
+
+class UploadHandler(StreamingFormHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.require_complete_form()
+        image_url = self.get_uploaded_url("file")
+        if image_url is None:
+            raise tornado.web.HTTPError(400, "Missing file")
+        await rooms.get(room_id).announce({"image": image_url})
+
+        self.write(f"Uploaded. <a href='control'>Back to control</a>")
+
+
+class AddHandler(StreamingFormHandler, BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.require_complete_form()
+        image_url = self.get_uploaded_url("file") or ""
+        op = {
+            "op": "add",
+            "name": self.get_form_field("name"),
+            "hp": self.get_form_field("hp"),
+            "maxHp": self.get_form_field("maxHp"),
+            "image": image_url,
+        }
+        count = self.get_form_field("count") or "1"
+        hp_roll = self.get_form_field("hpRoll")
+        if count != "1" or hp_roll:
+            op |= {"op": "spawn", "count": count, "hpRoll": hp_roll}
+        await self.run_command(room_id, op)
+        if image_url:
+            tornado.ioloop.IOLoop.current().spawn_callback(refresh_portraits, image_url)
+
+
+class SpawnHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        op = json.loads(self.request.body.decode())
+        if not isinstance(op, dict):
+            raise tornado.web.HTTPError(400)
+        keys = ("name", "hp", "maxHp", "image", "abilities", "count", "hpRoll")
+        await self.run_command(room_id, {"op": "spawn"} | {k: op[k] for k in keys if k in op})
 
-        if character is not None:
-            character.update_initiative(initiative)
-            broadcast()
-        self.write({"status": "ok"})
 
+class AddAbilityHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        name, ability = self.json_parse("name", "ability")
+        await self.run_command(room_id, {"op": "addAbility", "name": name, "ability": ability})
 
-class UploadHandler(tornado.web.RequestHandler):
-    def post(self):
-        file1 = self.request.files['file'][0]
-        filename = file1['filename']
-        filepath = os.path.join(STATIC_DIR, filename)
 
-        with open(filepath, 'wb') as f:
-            f.write(file1['body'])
+class RemoveAbilityHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        name, ability = self.json_parse("name", "ability")
+        await self.run_command(room_id, {"op": "removeAbility", "name": name, "ability": ability})
 
-        image_url = f"/static/{filename}"
-        update = {"image": image_url}
-        for c in clients:
-            c.write_message(update)
 
-        self.write(f"Uploaded. <a href='/control'>Back to control</a>")
+class AddEffectHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        name, effect, rounds, seconds = self.json_parse("name", "effect", "rounds", "seconds")
+        await self.run_command(room_id, {"op": "addEffect", "name": name, "effect": effect,
+                                         "rounds": rounds, "seconds": seconds})
 
 
-class AddHandler(BaseCharacterHandler):
-    def post(self):
-        name = self.get_body_argument("name")
-        hp = int(self.get_body_argument("hp"))
-        max_hp = int(self.get_body_argument("maxHp"))
-        image_url = ""
-        if "file" in self.request.files:
-            fileinfo = self.request.files["file"][0]
-            filepath = os.path.join(STATIC_DIR, fileinfo["filename"])
-            with open(filepath, "wb") as f:
-                f.write(fileinfo["body"])
-            image_url = f"/static/{fileinfo['filename']}"
-        webpage_data.add_character(Character(name, hp, max_hp, image_url))
-        broadcast()
+class RemoveEffectHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        name, effect = self.json_parse("name", "effect")
+        await self.run_command(room_id, {"op": "removeEffect", "name": name, "effect": effect})
 
 
-class AddAbilityHandler(BaseCharacterHandler):
-    def post(self):
-        name, ability = self.json_parse("name", "ability")
-        webpage_data.get_character_by_name(name).add_ability(ability)
-        broadcast()
+class NextTurnHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.run_command(room_id, {"op": "nextTurn"})
 
 
-class RemoveAbilityHandler(BaseCharacterHandler):
-    def post(self):
-        name, ability = self.json_parse("name", "ability")
-        webpage_data.get_character_by_name(name).remove_ability(ability)
-        broadcast()
+class PreviousTurnHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.run_command(room_id, {"op": "previousTurn"})
+
+
+class UndoHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.run_command(room_id, {"op": "undo"})
+
+
+class RedoHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        await self.run_command(room_id, {"op": "redo"})
 
 
 class SetWeatherHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         weather = list(self.json_parse("weather"))[0]
-        webpage_data.set_weather(Weather(weather))
-        broadcast()
+        await self.run_command(room_id, {"op": "setWeather", "weather": weather})
 
 
 class SetBackgroundHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         background = list(self.json_parse("background"))[0]
-        webpage_data.set_background(background)
-        broadcast()
+        await self.run_command(room_id, {"op": "setBg", "background": background})
 
 
 class RemoveHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         name = list(self.json_parse("name"))[0]
-        webpage_data.remove_character_by_name(name)
-        broadcast()
+        await self.run_command(room_id, {"op": "remove", "name": name})
 
 class SetAvailableAbilitiesHandler(BaseCharacterHandler):
-    def post(self):
+    async def post(self, room_id: str = DEFAULT_ROOM):
         name, ability = self.json_parse("name", "ability")
-        character = webpage_data.get_character_by_name(name)
-        if character is not None:
-            character.toggle_ability(ability)
-            broadcast()
+        await self.run_command(room_id, {"op": "setAvailableAbilities", "name": name, "ability": ability})
+
+
+class BatchHandler(BaseCharacterHandler):
+    async def post(self, room_id: str = DEFAULT_ROOM):
+        ops = list(self.json_parse("ops"))[0]
+        try:
+            results = await rooms.get(room_id).submit_batch(ops)
+        except CommandError as e:
+            self.set_status(400)
+            self.write({"status": "error", "error": str(e)})
+            return
+        self.write({"status": "ok", "results": results})
+
+
+def room_routes(*routes: Tuple) -> List[Tuple]:
+    # Each room-scoped route is served under /room/<id>/ and, for the default room, at
+    # its original path.
+    scoped = []
+    for path, *handler in routes:
+        scoped.append((path, *handler))
+        scoped.append((rf"/room/(?P<room_id>{ROOM_ID_PATTERN}){path}", *handler))
+    return scoped
+
 
 def make_app():
     return tornado.web.Application([
         (r"/", MainHandler),
-        (r"/control", ControlHandler),
-        (r"/display", DisplayHandler),
+        (r"/bundle/(.*)", BundleHandler),
+        (r"/stats/clients", ClientStatsHandler),
+        (r"/metrics", MetricsHandler),
+        (r"/debug/profile", ProfileHandler),
+    ] + room_routes(
+        (r"/control", PageHandler, {"page": build_control_page()}),
+        (r"/display", PageHandler, {"page": build_display_page()}),
         (r"/ws", WSHandler),
         (r"/add", AddHandler),
+        (r"/spawn", SpawnHandler),
+        (r"/upload", UploadHandler),
         (r"/addAbility", AddAbilityHandler),
         (r"/removeAbility", RemoveAbilityHandler),
         (r"/remove", RemoveHandler),
         (r"/update", UpdateHpHandler),
         (r"/updateInitiative", UpdateInitiativeHandler),
+        (r"/addEffect", AddEffectHandler),
+        (r"/removeEffect", RemoveEffectHandler),
+        (r"/nextTurn", NextTurnHandler),
+        (r"/previousTurn", PreviousTurnHandler),
+        (r"/undo", UndoHandler),
+        (r"/redo", RedoHandler),
         (r"/setAvailableAbilities", SetAvailableAbilitiesHandler),
         (r"/setBg", SetBackgroundHandler),
         (r"/setWeather", SetWeatherHandler),
-        (r"/static/(.*)", tornado.web.StaticFileHandler, {"path": STATIC_DIR}),
-    ], debug=True)
+        (r"/batch", BatchHandler),
+    ),
+        # Autoreload can't restart forked workers.
+        debug=not tornado.options.options.production and tornado.options.options.processes == 1,
+        static_path=STATIC_DIR,
+        static_handler_class=CachedStaticFileHandler,
+        max_upload_size=tornado.options.options.max_upload_size,
+        log_function=log_request,
+        profiling=tornado.options.options.profiling,
+    )
 
 
 if __name__ == "__main__":
-    app = make_app()
-    app.listen(8888)
-    tornado.ioloop.IOLoop.current().start()
+    tornado.options.parse_command_line()
+    load_existing_variants()
+    if tornado.options.options.production:
+        precompress_static()
+    sockets = tornado.netutil.bind_sockets(tornado.options.options.port)
+    cluster = None
+    if tornado.options.options.processes != 1:
+        processes = tornado.options.options.processes or tornado.process.cpu_count()
+        ipc_dir = Path(tempfile.mkdtemp(prefix="dnddisplay-"))
+        worker_sockets = bind_worker_sockets(ipc_dir, processes)
+        worker_id = tornado.process.fork_processes(processes)
+        cluster = Cluster(rooms, ipc_dir, worker_id, processes)
+        cluster.start(worker_sockets)
+        # Each worker keeps its own metrics; scrapes land on whichever worker accepts.
+        set_const_label("worker", str(worker_id))
+    rooms.configure(
+        Path(tornado.options.options.data_dir),
+        tornado.options.options.broadcast_window,
+        tornado.options.options.room_idle_seconds,
+        cluster,
+    )
+    tornado.autoreload.add_reload_hook(rooms.close)
+    server = tornado.httpserver.HTTPServer(make_app())
+    server.add_sockets(sockets)
+    tornado.ioloop.PeriodicCallback(rooms.flush_all, OPTIONS_REFRESH_SECONDS * 1000).start()
+    tornado.ioloop.PeriodicCallback(rooms.evict_idle, 60 * 1000).start()
+    CONNECTED_CLIENTS.set_function(
+        lambda: sum(isinstance(c, WSHandler) for room in rooms for c in list(room.clients)))
+    LOADED_ROOMS.set_function(lambda: len(rooms))
+    LoopLagMonitor().start()
+    try:
+        tornado.ioloop.IOLoop.current().start()
+    finally:
+        rooms.close()
@@ -0,0 +1,245 @@
+import abc
+import asyncio
+import bisect
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tornado.ioloop
+import tornado.web
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+LOOP_LAG_INTERVAL_SECONDS = 0.5
+MAX_PROFILE_SECONDS = 60.0
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics: List["Metric"] = []
+_const_labels: Dict[str, str] = {}
+
+access_log = logging.getLogger("tornado.access")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{k}="{_escape(v)}"' for k, v in _const_labels.items()]
+    pairs += [f'{k}="{_escape(v)}"' for k, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric(abc.ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        self._name = name
+        self._documentation = documentation
+        self._label_names = labels
+        self._children: Dict[Tuple[str, ...], object] = {}
+        _metrics.append(self)
+
+    def labels(self, *values: str):
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abc.abstractmethod
+    def _new_child(self):
+        ...
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        ...
+
+    def render(self) -> str:
+        lines = [f"# HELP {self._name} {self._documentation}", f"# TYPE {self._name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [f"{self._name}{_format_labels(self._label_names, k)} {v.value}" for k, v in self._children.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labels)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        # Evaluated at scrape time, so nothing on the hot path keeps it up to date.
+        self._function = function
+
+    def _samples(self) -> List[str]:
+        if self._function is not None:
+            self.set(self._function())
+        return super()._samples()
+
+
+class _Buckets:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self._buckets = buckets
+
+    def _new_child(self) -> _Buckets:
+        return _Buckets(self._buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), child.counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                lines.append(f"{self._name}_bucket{_format_labels(self._label_names, key, le)} {cumulative}")
+            lines.append(f"{self._name}_sum{_format_labels(self._label_names, key)} {child.sum}")
+            lines.append(f"{self._name}_count{_format_labels(self._label_names, key)} {child.count}")
+        return lines
+
+
+def set_const_label(name: str, value: str) -> None:
+    _const_labels[name] = value
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in _metrics) + "\n"
+
+
+REQUEST_SECONDS = Histogram("dnd_request_duration_seconds", "Time to handle an HTTP request.",
+                            ("handler", "method", "status"))
+COMMAND_SECONDS = Histogram("dnd_command_duration_seconds", "Time to apply a state mutation.", ("op",))
+BROADCAST_SECONDS = Histogram("dnd_broadcast_duration_seconds", "Time to build, encode and fan out a broadcast.")
+BROADCAST_BYTES = Histogram("dnd_broadcast_bytes", "Encoded size of each broadcast, per wire format.",
+                            ("format",), buckets=SIZE_BUCKETS)
+SENT_BYTES = Counter("dnd_websocket_sent_bytes_total", "Bytes written to WebSocket clients.")
+CONNECTED_CLIENTS = Gauge("dnd_connected_clients", "Open WebSocket connections.")
+LOADED_ROOMS = Gauge("dnd_loaded_rooms", "Rooms held in memory by this process.")
+LOOP_LAG_SECONDS = Histogram("dnd_ioloop_lag_seconds", "How late a timer scheduled on the IOLoop fires.")
+UPLOAD_BYTES = Counter("dnd_upload_bytes_total", "Upload bytes received.")
+UPLOAD_SECONDS = Histogram("dnd_upload_duration_seconds", "Time from first to last byte of an upload.")
+
+
+def log_request(handler: tornado.web.RequestHandler) -> None:
+    # Installed as the Application's log_function, which every finished request
+    # passes through anyway; keeps tornado's access log line as it was.
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    REQUEST_SECONDS.labels(type(handler).__name__, handler.request.method, str(status)).observe(request_time)
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(), 1000.0 * request_time)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL_SECONDS) -> None:
+        self._interval = interval
+        self._expected = 0.0
+
+    def start(self) -> None:
+        loop = tornado.ioloop.IOLoop.current()
+        self._expected = loop.time() + self._interval
+        loop.call_at(self._expected, self._tick)
+
+    def _tick(self) -> None:
+        LOOP_LAG_SECONDS.observe(max(0.0, tornado.ioloop.IOLoop.current().time() - self._expected))
+        self.start()
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.set_header("Cache-Control", "no-store")
+        self.write(render())
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    _running = False
+
+    def prepare(self):
+        if not self.settings.get("profiling"):
+            raise tornado.web.HTTPError(404)
+
+    async def get(self):
+        if ProfileHandler._running:
+            raise tornado.web.HTTPError(409, "A profile is already being recorded")
+        seconds = min(float(self.get_argument("seconds", "10")), MAX_PROFILE_SECONDS)
+        profiler = cProfile.Profile()
+        ProfileHandler._running = True
+        profiler.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            ProfileHandler._running = False
+
+        profiler.create_stats()
+        if self.get_argument("format", "text") == "pstats":
+            # The raw dump loads into snakeviz, flameprof and friends.
+            self.set_header("Content-Type", "application/octet-stream")
+            self.set_header("Content-Disposition", f"attachment; filename=profile-{int(time.time())}.pstats")
+            self.write(marshal.dumps(profiler.stats))
+            return
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats(self.get_argument("sort", "cumulative")).print_stats(50)
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.write(out.getvalue())
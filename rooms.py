@@ -0,0 +1,273 @@
+import logging
+import re
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+import tornado.ioloop
+import tornado.web
+
+from character import WebpageData
+from commands import COMMANDS, INTERNAL_COMMANDS, URGENT_COMMANDS, apply_batch, apply_command, resolved_op
+from effects import ExpiryTimer
+from fanout import BROADCAST_WINDOW_SECONDS, BroadcastScheduler, Payload, encode_as, fan_out
+from history import HISTORY_COMMANDS, History
+from journal import Journal
+from metrics import BROADCAST_BYTES, BROADCAST_SECONDS, COMMAND_SECONDS
+from utility import get_options
+
+DEFAULT_ROOM = "default"
+ROOM_ID_PATTERN = r"[A-Za-z0-9_-]{1,64}"
+ROOM_IDLE_SECONDS = 900.0
+
+logger = logging.getLogger(__name__)
+
+
+def _command_label(op: Any) -> str:
+    # Ops come straight from clients. Anything that is not a known command, including
+    # payloads that are not objects at all, is counted as "unknown" so the label set
+    # stays bounded.
+    name = op.get("op") if isinstance(op, dict) else None
+    return name if isinstance(name, str) and (name in COMMANDS or name in INTERNAL_COMMANDS or name in HISTORY_COMMANDS) else "unknown"
+
+
+class Room:
+    def __init__(self, room_id: str, journal: Optional[Journal] = None,
+                 broadcast_window: float = BROADCAST_WINDOW_SECONDS) -> None:
+        self._room_id = room_id
+        self._journal = journal
+        self._webpage_data = WebpageData()
+        self._clients: Set[Any] = set()
+        self._scheduler = BroadcastScheduler(self.broadcast, broadcast_window)
+        self._effect_timer = ExpiryTimer(self._expire_effects)
+        self._history = History()
+        self._sent_options_version = 0
+        self._encoded_key: Optional[Tuple[int, int]] = None
+        self._encoded: Dict[str, Payload] = {}
+        self._last_active = time.monotonic()
+        if journal is not None:
+            journal.recover(self._webpage_data)
+            self._webpage_data.pop_patch()
+            journal.start()
+        self._effect_timer.schedule(self._webpage_data.next_effect_expiry())
+
+    @property
+    def room_id(self) -> str:
+        return self._room_id
+
+    @property
+    def webpage_data(self) -> WebpageData:
+        return self._webpage_data
+
+    @property
+    def clients(self) -> Set[Any]:
+        return self._clients
+
+    @property
+    def scheduler(self) -> BroadcastScheduler:
+        return self._scheduler
+
+    @property
+    def history(self) -> History:
+        return self._history
+
+    def add_client(self, client: Any) -> None:
+        self._clients.add(client)
+        self._last_active = time.monotonic()
+
+    def remove_client(self, client: Any) -> None:
+        self._clients.discard(client)
+        self._last_active = time.monotonic()
+
+    def idle_for(self) -> float:
+        if self._clients:
+            return 0.0
+        return time.monotonic() - self._last_active
+
+    def snapshot_message(self) -> Dict[str, Any]:
+        return self._webpage_data.get_snapshot() | get_options()
+
+    def encoded_snapshot(self, wire_format: str = "json") -> Payload:
+        # When many displays reconnect at once, each format is encoded once per state
+        # rather than once per client. Changes not yet broadcast have no version of their
+        # own, so those snapshots are not cached.
+        if self._webpage_data.has_changes():
+            return encode_as(wire_format, self.snapshot_message())
+        key = (self._webpage_data.version, get_options()["optionsVersion"])
+        if key != self._encoded_key:
+            self._encoded_key = key
+            self._encoded = {}
+        encoded = self._encoded.get(wire_format)
+        if encoded is None:
+            encoded = self._encoded[wire_format] = encode_as(wire_format, self.snapshot_message())
+        return encoded
+
+    def broadcast(self) -> None:
+        start = time.perf_counter()
+        message = self._webpage_data.pop_patch() or {}
+        options = get_options()
+        if options["optionsVersion"] != self._sent_options_version:
+            self._sent_options_version = options["optionsVersion"]
+            message |= options
+        if not message:
+            return
+        payloads = fan_out(self._clients, message)
+        BROADCAST_SECONDS.observe(time.perf_counter() - start)
+        for wire_format, payload in payloads.items():
+            BROADCAST_BYTES.labels(wire_format).observe(len(payload))
+
+    def run_command(self, op: Dict[str, Any], internal: bool = False) -> Dict[str, Any]:
+        start = time.perf_counter()
+        op_label = _command_label(op)
+        try:
+            if op_label in HISTORY_COMMANDS:
+                # Undo and redo run, and are journaled, as the restore they resolve to,
+                # along with the time that decides which restored effects already ran out.
+                op = self._history.resolve(op) | {"now": round(time.time(), 3)}
+                result = apply_command(self._webpage_data, op, internal=True)
+            else:
+                self._history.begin(self._webpage_data, [op])
+                try:
+                    result = apply_command(self._webpage_data, op, internal)
+                except Exception:
+                    self._history.abort(self._webpage_data)
+                    raise
+                self._history.commit(self._webpage_data, [op])
+        finally:
+            COMMAND_SECONDS.labels(op_label).observe(time.perf_counter() - start)
+        # The patch that will carry this change, so a client can tell when every display
+        # has seen it.
+        pending_version = self._webpage_data.version + 1
+        self._last_active = time.monotonic()
+        if self._journal is not None:
+            self._journal.append(resolved_op(op, result), self._webpage_data)
+        self._scheduler.mark_dirty(urgent=op["op"] in URGENT_COMMANDS)
+        self._effect_timer.schedule(self._webpage_data.next_effect_expiry())
+        return result | {"version": pending_version}
+
+    def run_batch(self, ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # The batch is applied within one IOLoop callback, so no client can observe it
+        # half-applied, and it goes out as a single patch.
+        start = time.perf_counter()
+        # The whole batch is one undo step.
+        recorded = ops if isinstance(ops, list) else []
+        self._history.begin(self._webpage_data, recorded)
+        try:
+            results = apply_batch(self._webpage_data, ops)
+        except Exception:
+            self._history.abort(self._webpage_data)
+            raise
+        self._history.commit(self._webpage_data, recorded)
+        COMMAND_SECONDS.labels("batch").observe(time.perf_counter() - start)
+        self._last_active = time.monotonic()
+        # A batch that was rolled back changed nothing, so there is nothing to journal.
+        applied = bool(results) and all(result["status"] == "ok" for result in results)
+        if self._journal is not None and applied:
+            self._journal.append(resolved_op({"op": "batch", "ops": ops}, {"results": results}),
+                                 self._webpage_data)
+        if applied:
+            self._scheduler.mark_dirty(urgent=True)
+            self._effect_timer.schedule(self._webpage_data.next_effect_expiry())
+        return results
+
+    def _expire_effects(self) -> None:
+        # Journaled with the time it ran at, so a replay expires exactly the same set.
+        self.run_command({"op": "expireEffects", "now": round(time.time(), 3)}, internal=True)
+
+    async def ready(self) -> None:
+        pass
+
+    async def submit(self, op: Dict[str, Any]) -> Dict[str, Any]:
+        return self.run_command(op)
+
+    async def submit_batch(self, ops: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return self.run_batch(ops)
+
+    async def announce(self, message: Dict[str, Any]) -> None:
+        fan_out(self._clients, message)
+
+    def refresh_image(self, image_url: str) -> None:
+        self._webpage_data.refresh_image(image_url)
+        self._scheduler.mark_dirty()
+
+    def flush(self) -> None:
+        self._scheduler.flush()
+
+    def close(self) -> None:
+        self._effect_timer.cancel()
+        self._scheduler.flush()
+        if self._journal is not None:
+            self._journal.snapshot(self._webpage_data)
+            self._journal.close()
+
+
+class RoomRegistry:
+    def __init__(self, data_dir: Optional[Path] = None, broadcast_window: float = BROADCAST_WINDOW_SECONDS,
+                 idle_seconds: float = ROOM_IDLE_SECONDS) -> None:
+        self._data_dir = data_dir
+        self._broadcast_window = broadcast_window
+        self._idle_seconds = idle_seconds
+        self._cluster: Optional[Any] = None
+        self._rooms: Dict[str, Room] = {}
+
+    def configure(self, data_dir: Optional[Path], broadcast_window: float, idle_seconds: float,
+                  cluster: Optional[Any] = None) -> None:
+        self._data_dir = data_dir
+        self._broadcast_window = broadcast_window
+        self._idle_seconds = idle_seconds
+        self._cluster = cluster
+
+    @property
+    def cluster(self) -> Optional[Any]:
+        return self._cluster
+
+    def __iter__(self) -> Iterator[Room]:
+        return iter(list(self._rooms.values()))
+
+    def __len__(self) -> int:
+        return len(self._rooms)
+
+    def get(self, room_id: str = DEFAULT_ROOM) -> Room:
+        room = self._rooms.get(room_id)
+        if room is None:
+            if not re.fullmatch(ROOM_ID_PATTERN, room_id):
+                raise tornado.web.HTTPError(404, "Invalid room id")
+            if self._cluster is not None and not self._cluster.owns(room_id):
+                room = self._rooms[room_id] = self._cluster.make_remote_room(room_id)
+                return room
+            journal = Journal(self._room_dir(room_id)) if self._data_dir is not None else None
+            room = Room(room_id, journal, self._broadcast_window)
+            self._rooms[room_id] = room
+        return room
+
+    def _room_dir(self, room_id: str) -> Path:
+        # The default room keeps the journal location used before rooms existed.
+        if room_id == DEFAULT_ROOM:
+            return self._data_dir
+        return self._data_dir / "rooms" / room_id
+
+    def evict_idle(self) -> None:
+        # Without a data directory an evicted room could not be brought back.
+        if self._data_dir is None:
+            return
+        for room in self:
+            if room.idle_for() > self._idle_seconds:
+                logger.info("Evicting idle room %s", room.room_id)
+                room.close()
+                del self._rooms[room.room_id]
+
+    def discard(self, room_id: str) -> None:
+        self._rooms.pop(room_id, None)
+
+    def refresh_image(self, image_url: str) -> None:
+        for room in self:
+            room.refresh_image(image_url)
+
+    def flush_all(self) -> None:
+        for room in self:
+            room.flush()
+
+    def close(self) -> None:
+        for room in self:
+            room.close()
+        self._rooms.clear()
@@ -0,0 +1,113 @@
+import pytest
+
+import commands
+from character import WebpageData
+from commands import CommandError, apply_batch, apply_command, resolved_op
+
+
+def test_failed_batch_rolls_back_every_op():
+    webpage_data = WebpageData()
+    apply_command(webpage_data, {"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    before = webpage_data.to_state()
+
+    results = apply_batch(webpage_data, [
+        {"op": "update", "name": "Fighter", "delta": -4},
+        {"op": "spawn", "name": "Goblin", "count": 2, "hpRoll": "2d6"},
+        {"op": "nextTurn"},
+        {"op": "update", "name": "Nobody", "delta": -1},
+    ])
+
+    assert [result["status"] for result in results] == ["rolledBack"] * 3 + ["error"]
+    assert webpage_data.to_state() == before
+
+
+def test_batch_replays_to_the_same_state():
+    webpage_data = WebpageData()
+    op = {"op": "batch", "ops": [
+        {"op": "spawn", "name": "Goblin", "count": 2, "hpRoll": "2d6"},
+        {"op": "addEffect", "name": "Goblin1", "effect": "Hasted", "seconds": 30},
+    ]}
+    result = apply_command(webpage_data, op)
+    assert [inner["status"] for inner in result["results"]] == ["ok", "ok"]
+
+    replayed = WebpageData()
+    apply_command(replayed, resolved_op(op, result))
+    assert replayed.to_state() == webpage_data.to_state()
+
+
+def test_clients_cannot_send_internal_ops():
+    webpage_data = WebpageData()
+    for op in ({"op": "restoreEntities", "images": {}}, {"op": "expireEffects", "now": 0}):
+        with pytest.raises(CommandError):
+            apply_command(webpage_data, op)
+
+
+def test_malformed_restore_changes_nothing():
+    webpage_data = WebpageData()
+    apply_command(webpage_data, {"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    webpage_data.pop_patch()
+    before = webpage_data.to_state()
+    state = {"name": "Goblin", "hp": 7, "maxHp": 7, "image": "", "initiative": 0, "abilities": {}, "effects": {}}
+
+    for images in (
+        {"characters": {"Goblin": state | {"hp": "lots"}}},
+        {"characters": {"Goblin": state | {"effects": {"Poisoned": 3}}}},
+        {"characters": {"Goblin": state}, "weather": "acid"},
+        {"characters": {"Goblin": state}, "turn": ["Goblin", "two"]},
+    ):
+        with pytest.raises(CommandError):
+            apply_command(webpage_data, {"op": "restoreEntities", "images": images}, internal=True)
+        assert webpage_data.to_state() == before
+        assert webpage_data.pop_patch() is None
+
+
+def test_batch_rolls_back_when_an_op_raises_unexpectedly(monkeypatch):
+    def explode(webpage_data, op):
+        raise ZeroDivisionError
+
+    monkeypatch.setitem(commands.COMMANDS, "explode", explode)
+    webpage_data = WebpageData()
+    apply_command(webpage_data, {"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    before = webpage_data.to_state()
+
+    with pytest.raises(ZeroDivisionError):
+        apply_batch(webpage_data, [{"op": "update", "name": "Fighter", "delta": -4}, {"op": "explode"}])
+    assert webpage_data.to_state() == before
+
+
+@pytest.mark.parametrize("op", [
+    {"op": "update", "name": ["Fighter"], "delta": -1},
+    {"op": "addAbility", "name": "Fighter", "ability": ["x"]},
+    {"op": "setAvailableAbilities", "name": "Fighter", "ability": {"x": 1}},
+    {"op": "addEffect", "name": "Fighter", "effect": ["Poisoned"]},
+    {"op": "removeEffect", "name": "Fighter", "effect": None},
+    {"op": "add", "name": ["Goblin"]},
+    {"op": "spawn", "name": "Goblin", "count": 2, "image": 5},
+    {"op": "update", "name": "Fighter", "delta": 1e309},
+])
+def test_malformed_fields_are_refused(op):
+    webpage_data = WebpageData()
+    apply_command(webpage_data, {"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    before = webpage_data.to_state()
+
+    results = apply_batch(webpage_data, [{"op": "update", "name": "Fighter", "delta": -4}, op])
+    assert [result["status"] for result in results] == ["rolledBack", "error"]
+    assert webpage_data.to_state() == before
+
+
+@pytest.mark.parametrize("fields", [
+    {"seconds": "nan"},
+    {"seconds": "inf"},
+    {"seconds": 1e309},
+    {"seconds": -5},
+    {"rounds": -1},
+    {"expiresAt": "-inf"},
+    {"expiresAt": -1},
+])
+def test_effect_durations_must_be_finite_and_positive(fields):
+    webpage_data = WebpageData()
+    apply_command(webpage_data, {"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    with pytest.raises(CommandError):
+        apply_command(webpage_data, {"op": "addEffect", "name": "Fighter", "effect": "Hasted"} | fields)
+    assert webpage_data.get_character_by_name("Fighter").effects == {}
+    assert webpage_data.next_effect_expiry() is None
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from character import WebpageData
+from commands import apply_command
+from effects import ExpiryQueue, ExpiryTimer
+
+
+def test_due_keys_come_out_in_deadline_order():
+    queue = ExpiryQueue()
+    for key, deadline in ((("Goblin", "Slowed"), 30.0), (("Orc", "Hasted"), 10.0), (("Wolf", "Prone"), 20.0)):
+        queue.push(key, deadline)
+    assert queue.peek() == 10.0
+    assert queue.pop_due(25.0) == [("Orc", "Hasted"), ("Wolf", "Prone")]
+    assert queue.peek() == 30.0
+    assert len(queue) == 1
+
+
+def test_discarded_key_is_skipped():
+    queue = ExpiryQueue()
+    queue.push(("Orc", "Hasted"), 10.0)
+    queue.push(("Wolf", "Prone"), 20.0)
+    queue.discard(("Orc", "Hasted"))
+    assert queue.peek() == 20.0
+    assert queue.pop_due(30.0) == [("Wolf", "Prone")]
+    assert queue.peek() is None
+
+
+def test_pushing_again_replaces_the_old_deadline():
+    queue = ExpiryQueue()
+    queue.push(("Orc", "Hasted"), 10.0)
+    queue.push(("Orc", "Hasted"), 40.0)
+    assert queue.pop_due(20.0) == []
+    assert queue.peek() == 40.0
+    assert queue.pop_due(40.0) == [("Orc", "Hasted")]
+
+
+def test_stale_entries_do_not_pile_up():
+    queue = ExpiryQueue()
+    for deadline in range(1000):
+        queue.push(("Orc", "Hasted"), float(deadline))
+    assert len(queue) == 1
+    assert len(queue._heap) < 100
+
+
+def test_effects_of_removed_character_are_skipped():
+    webpage_data = WebpageData()
+    for name in ("Orc", "Wolf"):
+        apply_command(webpage_data, {"op": "add", "name": name, "hp": 5, "maxHp": 5})
+    apply_command(webpage_data, {"op": "addEffect", "name": "Orc", "effect": "Hasted", "expiresAt": 100})
+    apply_command(webpage_data, {"op": "addEffect", "name": "Wolf", "effect": "Prone", "expiresAt": 200})
+    apply_command(webpage_data, {"op": "remove", "name": "Orc"})
+    assert webpage_data.next_effect_expiry() == 200
+    assert webpage_data.expire_effects(300) == [("Wolf", "Prone")]
+    assert webpage_data.next_effect_expiry() is None
+
+
+def test_timer_follows_the_earliest_deadline():
+    fired = []
+
+    async def run():
+        timer = ExpiryTimer(lambda: fired.append(time.time()))
+        timer.schedule(time.time() + 60)
+        timer.schedule(time.time() + 0.02)
+        await asyncio.sleep(0.1)
+        assert len(fired) == 1
+
+        timer.schedule(time.time() + 0.02)
+        timer.schedule(None)
+        await asyncio.sleep(0.1)
+        assert len(fired) == 1
+
+        timer.schedule(time.time() - 5)
+        await asyncio.sleep(0.01)
+        assert len(fired) == 2
+
+    asyncio.run(run())
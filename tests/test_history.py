@@ -0,0 +1,136 @@
+import asyncio
+import time
+
+import pytest
+
+from commands import CommandError
+from journal import Journal
+from rooms import Room
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+@pytest.fixture
+def open_room(tmp_path, loop):
+    rooms = []
+
+    def open_room():
+        room = Room("test", Journal(tmp_path))
+        rooms.append(room)
+        return room
+
+    yield open_room
+    for room in rooms:
+        room.close()
+
+
+def names(room):
+    return [character["name"] for character in room.webpage_data.to_state()["characters"]]
+
+
+def assert_replays(open_room, room):
+    # Undo and redo are journaled as the restores they resolve to; a restart must land
+    # on the same state.
+    state = room.webpage_data.to_state()
+    room.close()
+    assert open_room().webpage_data.to_state() == state
+
+
+def test_undo_redo_remove(open_room):
+    room = open_room()
+    room.run_command({"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7})
+    room.run_command({"op": "addEffect", "name": "Goblin", "effect": "Poisoned", "rounds": 3})
+    before = room.webpage_data.get_character_by_name("Goblin").to_state()
+    room.run_command({"op": "remove", "name": "Goblin"})
+    assert names(room) == []
+
+    room.run_command({"op": "undo"})
+    assert room.webpage_data.get_character_by_name("Goblin").to_state() == before
+    room.run_command({"op": "redo"})
+    assert names(room) == []
+    room.run_command({"op": "undo"})
+    assert_replays(open_room, room)
+
+
+def test_undo_redo_spawn(open_room):
+    room = open_room()
+    result = room.run_command({"op": "spawn", "name": "Goblin", "count": 3, "hpRoll": "2d6"})
+    spawned = room.webpage_data.to_state()["characters"]
+
+    room.run_command({"op": "undo"})
+    assert names(room) == []
+    room.run_command({"op": "redo"})
+    assert room.webpage_data.to_state()["characters"] == spawned
+    assert names(room) == result["names"]
+    assert_replays(open_room, room)
+
+
+def test_undone_spawn_reuses_names(open_room):
+    room = open_room()
+    room.run_command({"op": "spawn", "name": "Goblin", "count": 3, "hpRoll": "2d6"})
+    room.run_command({"op": "undo"})
+    assert room.run_command({"op": "spawn", "name": "Goblin", "count": 2, "hp": 5})["names"] == ["Goblin", "Goblin1"]
+    assert_replays(open_room, room)
+
+
+def test_undo_redo_turn(open_room):
+    room = open_room()
+    room.run_command({"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    room.run_command({"op": "add", "name": "Wizard", "hp": 6, "maxHp": 6})
+    room.run_command({"op": "nextTurn"})
+    first = (room.webpage_data.turn, room.webpage_data.round)
+    room.run_command({"op": "nextTurn"})
+    second = (room.webpage_data.turn, room.webpage_data.round)
+    assert first != second
+
+    room.run_command({"op": "undo"})
+    assert (room.webpage_data.turn, room.webpage_data.round) == first
+    room.run_command({"op": "redo"})
+    assert (room.webpage_data.turn, room.webpage_data.round) == second
+    assert_replays(open_room, room)
+
+
+def test_batch_is_one_undo_step(open_room):
+    room = open_room()
+    room.run_command({"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    before = room.webpage_data.to_state()
+    room.run_batch([{"op": "update", "name": "Fighter", "delta": -4},
+                    {"op": "spawn", "name": "Goblin", "count": 2, "hp": 5}])
+
+    room.run_command({"op": "undo"})
+    assert room.webpage_data.to_state() == before
+    assert_replays(open_room, room)
+
+
+def test_failed_commands_leave_no_undo_step(open_room):
+    room = open_room()
+    room.run_command({"op": "add", "name": "Fighter", "hp": 10, "maxHp": 10})
+    steps = len(room.history)
+    with pytest.raises(CommandError):
+        room.run_command({"op": "remove", "name": "Nobody"})
+    room.run_batch([{"op": "update", "name": "Fighter", "delta": -4}, {"op": "remove", "name": "Nobody"}])
+    assert len(room.history) == steps
+    assert room.webpage_data.get_character_by_name("Fighter").hp == 10
+
+
+def test_undo_does_not_bring_back_expired_effect(open_room):
+    room = open_room()
+    room.run_command({"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7})
+    room.run_command({"op": "addEffect", "name": "Goblin", "effect": "Hasted", "expiresAt": time.time() + 0.05})
+    room.run_command({"op": "update", "name": "Goblin", "delta": -2})
+    time.sleep(0.1)
+    room.run_command({"op": "expireEffects", "now": time.time()}, internal=True)
+    assert room.webpage_data.get_character_by_name("Goblin").effects == {}
+
+    room.run_command({"op": "undo"})
+    goblin = room.webpage_data.get_character_by_name("Goblin")
+    assert goblin.hp == 7
+    assert goblin.effects == {}
+    assert_replays(open_room, room)
@@ -0,0 +1,92 @@
+import json
+
+import commands
+from character import WebpageData
+from commands import apply_command, resolved_op
+from journal import Journal
+
+
+def run(journal, webpage_data, op):
+    journal.append(resolved_op(op, apply_command(webpage_data, op)), webpage_data)
+
+
+def test_replay_stops_at_half_written_last_line(tmp_path):
+    lines = [
+        {"seq": 1, "op": {"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7}},
+        {"seq": 2, "op": {"op": "update", "name": "Goblin", "delta": -3}},
+    ]
+    with open(tmp_path / "journal.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(line) + "\n" for line in lines)
+        f.write('{"seq": 3, "op": {"op": "remove", "na')
+
+    webpage_data = WebpageData()
+    journal = Journal(tmp_path)
+    assert journal.recover(webpage_data) == 2
+    journal.close()
+    assert journal.seq == 2
+    assert webpage_data.get_character_by_name("Goblin").hp == 4
+
+
+def test_snapshot_rotation_and_recovery(tmp_path):
+    webpage_data = WebpageData()
+    journal = Journal(tmp_path, snapshot_every=3)
+    journal.recover(webpage_data)
+    run(journal, webpage_data, {"op": "spawn", "name": "Goblin", "count": 3, "hpRoll": "2d6"})
+    run(journal, webpage_data, {"op": "update", "name": "Goblin1", "delta": -1})
+    run(journal, webpage_data, {"op": "nextTurn"})
+    run(journal, webpage_data, {"op": "remove", "name": "Goblin2"})
+    run(journal, webpage_data, {"op": "setWeather", "weather": "rain"})
+    journal.close()
+
+    snapshot = json.loads((tmp_path / "snapshot.json").read_text(encoding="utf-8"))
+    assert snapshot["seq"] == 3
+    records = [json.loads(line) for line in (tmp_path / "journal.jsonl").read_text(encoding="utf-8").splitlines()]
+    assert [record["seq"] for record in records] == [4, 5]
+
+    recovered = WebpageData()
+    journal = Journal(tmp_path, snapshot_every=3)
+    assert journal.recover(recovered) == 2
+    journal.close()
+    assert recovered.to_state() == webpage_data.to_state()
+
+
+def test_records_after_a_recovered_crash_survive_the_next_restart(tmp_path):
+    with open(tmp_path / "journal.jsonl", "w", encoding="utf-8") as f:
+        f.write(json.dumps({"seq": 1, "op": {"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7}}) + "\n")
+        f.write('{"seq": 2, "op": {"op": "upda')
+
+    webpage_data = WebpageData()
+    journal = Journal(tmp_path)
+    assert journal.recover(webpage_data) == 1
+    run(journal, webpage_data, {"op": "update", "name": "Goblin", "delta": -3})
+    run(journal, webpage_data, {"op": "add", "name": "Orc", "hp": 15, "maxHp": 15})
+    journal.close()
+
+    recovered = WebpageData()
+    journal = Journal(tmp_path)
+    assert journal.recover(recovered) == 3
+    journal.close()
+    assert recovered.get_character_by_name("Goblin").hp == 4
+    assert recovered.get_character_by_name("Orc") is not None
+    assert recovered.to_state() == webpage_data.to_state()
+
+
+def test_record_that_fails_to_replay_is_skipped(tmp_path, monkeypatch):
+    def explode(webpage_data, op):
+        raise ZeroDivisionError
+
+    monkeypatch.setitem(commands.COMMANDS, "explode", explode)
+    lines = [
+        {"seq": 1, "op": {"op": "add", "name": "Goblin", "hp": 7, "maxHp": 7}},
+        {"seq": 2, "op": {"op": "update", "name": "Nobody", "delta": -3}},
+        {"seq": 3, "op": {"op": "explode"}},
+        {"seq": 4, "op": {"op": "update", "name": "Goblin", "delta": -3}},
+    ]
+    with open(tmp_path / "journal.jsonl", "w", encoding="utf-8") as f:
+        f.writelines(json.dumps(line) + "\n" for line in lines)
+
+    webpage_data = WebpageData()
+    journal = Journal(tmp_path)
+    assert journal.recover(webpage_data) == 4
+    journal.close()
+    assert webpage_data.get_character_by_name("Goblin").hp == 4
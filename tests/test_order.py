@@ -0,0 +1,97 @@
+import random
+
+from character import WebpageData
+from commands import CommandError, apply_command
+
+
+def table(*initiatives):
+    webpage_data = WebpageData()
+    for name, initiative in initiatives:
+        apply_command(webpage_data, {"op": "add", "name": name, "hp": 5, "maxHp": 5})
+        apply_command(webpage_data, {"op": "updateInitiative", "name": name, "initiative": initiative})
+    return webpage_data
+
+
+def client_order(characters):
+    return sorted(characters, key=lambda name: (-characters[name]["n"], characters[name]["r"]))
+
+
+def test_highest_initiative_first_and_ties_keep_arrival_order():
+    webpage_data = table(("Fighter", 12), ("Wizard", 18), ("Goblin", 12), ("Rogue", 18))
+    assert webpage_data.get_initiative_order() == ["Wizard", "Rogue", "Fighter", "Goblin"]
+
+    apply_command(webpage_data, {"op": "updateInitiative", "name": "Wizard", "initiative": 12})
+    assert webpage_data.get_initiative_order() == ["Rogue", "Fighter", "Wizard", "Goblin"]
+
+
+def test_patches_carry_what_clients_need_to_keep_the_order():
+    rng = random.Random(7)
+    webpage_data = WebpageData()
+    characters = {}
+    for _ in range(500):
+        names = webpage_data.get_character_names()
+        roll = rng.random()
+        try:
+            if roll < 0.3 or not names:
+                apply_command(webpage_data, {"op": "spawn", "name": "Goblin", "count": rng.randint(1, 3), "hp": 1})
+            elif roll < 0.45:
+                apply_command(webpage_data, {"op": "remove", "name": rng.choice(names)})
+            else:
+                apply_command(webpage_data, {"op": "updateInitiative", "name": rng.choice(names),
+                                             "initiative": rng.randint(0, 5)})
+        except CommandError:
+            pass
+        if rng.random() < 0.5:
+            patch = webpage_data.pop_patch()
+            if patch is None:
+                continue
+            assert "order" not in patch
+            for name in patch.get("removed", ()):
+                del characters[name]
+            for name, fields in patch.get("changed", {}).items():
+                characters.setdefault(name, {}).update(fields)
+            assert client_order(characters) == webpage_data.get_initiative_order()
+    assert client_order(webpage_data.get_snapshot()["characters"]) == webpage_data.get_initiative_order()
+
+
+def test_turns_follow_the_order_and_count_rounds():
+    webpage_data = table(("Fighter", 12), ("Wizard", 18), ("Goblin", 3))
+    seen = []
+    for _ in range(4):
+        apply_command(webpage_data, {"op": "nextTurn"})
+        seen.append((webpage_data.turn, webpage_data.round))
+    assert seen == [("Wizard", 1), ("Fighter", 1), ("Goblin", 1), ("Wizard", 2)]
+
+    apply_command(webpage_data, {"op": "previousTurn"})
+    assert (webpage_data.turn, webpage_data.round) == ("Goblin", 1)
+
+
+def test_turn_patch_is_only_the_pointer():
+    webpage_data = table(("Fighter", 12), ("Wizard", 18))
+    webpage_data.pop_patch()
+    apply_command(webpage_data, {"op": "nextTurn"})
+    patch = webpage_data.pop_patch()
+    assert set(patch) == {"version", "base", "turn", "round"}
+
+
+def test_removing_the_current_character_passes_the_turn_on():
+    webpage_data = table(("Fighter", 12), ("Wizard", 18), ("Goblin", 3))
+    apply_command(webpage_data, {"op": "nextTurn"})
+    apply_command(webpage_data, {"op": "remove", "name": "Wizard"})
+    assert (webpage_data.turn, webpage_data.round) == ("Fighter", 1)
+
+    apply_command(webpage_data, {"op": "nextTurn"})
+    apply_command(webpage_data, {"op": "remove", "name": "Goblin"})
+    assert (webpage_data.turn, webpage_data.round) == ("Fighter", 2)
+
+    apply_command(webpage_data, {"op": "remove", "name": "Fighter"})
+    assert webpage_data.turn is None
+
+
+def test_reordering_keeps_the_turn_with_the_same_character():
+    webpage_data = table(("Fighter", 12), ("Wizard", 18), ("Goblin", 3))
+    apply_command(webpage_data, {"op": "nextTurn"})
+    apply_command(webpage_data, {"op": "updateInitiative", "name": "Wizard", "initiative": 1})
+    assert webpage_data.turn == "Wizard"
+    apply_command(webpage_data, {"op": "nextTurn"})
+    assert (webpage_data.turn, webpage_data.round) == ("Fighter", 2)
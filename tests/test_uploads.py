@@ -0,0 +1,133 @@
+import asyncio
+import os
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+
+import pytest
+import tornado.options
+import tornado.testing
+
+import main
+import uploads
+from uploads import MultipartStreamParser
+
+BOUNDARY = b"XyZzy"
+
+
+def body(*parts, end=True):
+    chunks = []
+    for headers, content in parts:
+        chunks.append(b"--" + BOUNDARY + b"\r\n" + headers + b"\r\n\r\n" + content + b"\r\n")
+    if end:
+        chunks.append(b"--" + BOUNDARY + b"--\r\n")
+    return b"".join(chunks)
+
+
+def field(name, value):
+    return b'Content-Disposition: form-data; name="' + name + b'"', value
+
+
+def upload(name, filename, content):
+    return b'Content-Disposition: form-data; name="' + name + b'"; filename="' + filename + b'"', content
+
+
+@pytest.fixture
+def image_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploads, "STATIC_DIR", tmp_path)
+    return tmp_path / "images"
+
+
+def parse(image_dir, chunks):
+    async def run():
+        parser = MultipartStreamParser(BOUNDARY, image_dir)
+        for chunk in chunks:
+            await parser.feed(chunk)
+        if not parser.complete:
+            await parser.abort()
+        return parser
+    return asyncio.run(run())
+
+
+def test_boundary_split_across_chunks(image_dir):
+    data = body(field(b"name", b"Goblin"), upload(b"image", b"g.png", b"\x89PNG" + b"\r\n-" * 50))
+    parser = parse(image_dir, [data[i:i + 7] for i in range(0, len(data), 7)])
+    assert parser.complete
+    assert parser.fields == {"name": "Goblin"}
+    image = parser.files["image"]
+    assert image.size == len(b"\x89PNG" + b"\r\n-" * 50)
+    assert (image_dir / image.url.rsplit("/", 1)[1]).read_bytes() == b"\x89PNG" + b"\r\n-" * 50
+
+
+def test_truncated_body_is_incomplete_and_leaves_no_files(image_dir):
+    data = body(field(b"name", b"Goblin"), upload(b"image", b"g.png", b"x" * 1000), end=False)
+    parser = parse(image_dir, [data[:-300]])
+    assert not parser.complete
+    assert "image" not in parser.files
+    assert list(image_dir.iterdir()) == []
+
+
+def test_committed_upload_is_world_readable(image_dir):
+    parser = parse(image_dir, [body(upload(b"image", b"g.png", b"\x89PNG\r\n"))])
+    assert stat.S_IMODE(os.stat(image_dir / parser.files["image"].url.rsplit("/", 1)[1]).st_mode) == 0o644
+
+
+@pytest.mark.parametrize("content", [b"", b"not an image", b"<svg></svg>"])
+def test_non_image_upload_is_refused(image_dir, content):
+    parser = parse(image_dir, [body(upload(b"image", b"g.png", content))])
+    assert parser.error == "Upload is not an image"
+    assert parser.files == {}
+    assert list(image_dir.iterdir()) == []
+
+
+def test_oversized_field_stops_parsing(image_dir):
+    data = body(field(b"name", b"x" * (uploads.MAX_FIELD_BYTES + 1)), upload(b"image", b"g.png", b"\x89PNG"))
+    parser = parse(image_dir, [data[i:i + 4096] for i in range(0, len(data), 4096)])
+    assert parser.error == "Form field too large"
+    assert not parser.complete
+    assert parser.fields == {} and parser.files == {}
+
+
+def test_empty_file_part_is_skipped(image_dir):
+    parser = parse(image_dir, [body(field(b"name", b"Goblin"), upload(b"image", b"", b""))])
+    assert parser.complete
+    assert parser.fields["name"] == "Goblin"
+    assert parser.files == {}
+    assert not image_dir.exists() or list(image_dir.iterdir()) == []
+
+
+class UploadHandlerTest(tornado.testing.AsyncHTTPTestCase):
+    def setUp(self):
+        self.static_dir = Path(tempfile.mkdtemp())
+        self.saved = uploads.STATIC_DIR, uploads.IMAGE_DIR
+        uploads.STATIC_DIR, uploads.IMAGE_DIR = self.static_dir, self.static_dir / "images"
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        uploads.STATIC_DIR, uploads.IMAGE_DIR = self.saved
+        shutil.rmtree(self.static_dir)
+
+    def get_app(self):
+        tornado.options.options.production = True
+        main.rooms = main.RoomRegistry()
+        return main.make_app()
+
+    def post_form(self, *parts):
+        headers = {"Content-Type": "multipart/form-data; boundary=" + BOUNDARY.decode()}
+        return self.fetch("/upload", method="POST", headers=headers, body=body(*parts))
+
+    def test_oversized_field_gets_a_400(self):
+        response = self.post_form(field(b"note", b"x" * 100 * 1024), upload(b"file", b"g.png", b"\x89PNG"))
+        assert response.code == 400
+
+    def test_empty_upload_gets_a_400(self):
+        response = self.post_form(upload(b"file", b"g.png", b""))
+        assert response.code == 400
+        assert list((self.static_dir / "images").iterdir()) == []
+
+    def test_image_upload_is_stored(self):
+        response = self.post_form(upload(b"file", b"g.png", b"\x89PNG\r\n"))
+        assert response.code == 200
+        assert [path.suffix for path in (self.static_dir / "images").iterdir()] == [".png"]
@@ -0,0 +1,51 @@
+import json
+
+import tornado.options
+import tornado.testing
+import tornado.websocket
+
+import main
+
+
+class WebSocketTest(tornado.testing.AsyncHTTPTestCase):
+    def get_app(self):
+        # Debug mode would start the autoreloader inside the test process.
+        tornado.options.options.production = True
+        main.rooms = main.RoomRegistry()
+        return main.make_app()
+
+    async def connect(self):
+        connection = await tornado.websocket.websocket_connect(f"ws://127.0.0.1:{self.get_http_port()}/room/ws_test/ws")
+        await connection.read_message()
+        return connection
+
+    async def ack(self, connection, message):
+        connection.write_message(message)
+        while True:
+            data = json.loads(await connection.read_message())
+            if "ack" in data:
+                return data
+
+    @tornado.testing.gen_test
+    async def test_malformed_messages_get_an_error_ack(self):
+        connection = await self.connect()
+        for message in ("{not json", "[1, 2]", json.dumps({"type": "shout", "id": 3})):
+            ack = await self.ack(connection, message)
+            assert ack["status"] == "error"
+        assert ack["ack"] == 3
+
+    @tornado.testing.gen_test
+    async def test_unexpected_error_is_acked_and_socket_stays_open(self):
+        connection = await self.connect()
+
+        async def explode(op):
+            raise ZeroDivisionError
+
+        main.rooms.get("ws_test").submit = explode
+        with tornado.testing.ExpectLog("tornado.application", "Command from"):
+            ack = await self.ack(connection, json.dumps({"type": "command", "id": 1, "op": "nextTurn"}))
+        assert ack == {"ack": 1, "status": "error", "error": "Internal error"}
+
+        del main.rooms.get("ws_test").submit
+        ack = await self.ack(connection, json.dumps({"type": "command", "id": 2, "op": "add", "name": "Goblin"}))
+        assert ack["status"] == "ok"
@@ -0,0 +1,287 @@
+import email.message
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+from typing import Dict, Optional
+
+import tornado.httputil
+import tornado.ioloop
+import tornado.web
+
+from metrics import UPLOAD_BYTES, UPLOAD_SECONDS
+from utility import STATIC_DIR
+
+IMAGE_DIR = STATIC_DIR / "images"
+MAX_UPLOAD_BYTES = 50 * 1024 * 1024
+MAX_FIELD_BYTES = 64 * 1024
+# Leading bytes of the formats browsers can show; anything else would only break the
+# portrait variants and the display.
+IMAGE_SIGNATURES = (b"\x89PNG", b"\xff\xd8\xff", b"GIF87a", b"GIF89a", b"BM")
+
+
+def _header_param(value: str, header: str, param: str) -> Optional[str]:
+    message = email.message.Message()
+    message[header] = value
+    return message.get_param(param, header=header)
+
+
+class StreamedFile:
+    def __init__(self, directory: Path, filename: str) -> None:
+        self._directory = directory
+        self._filename = filename
+        self._hash = hashlib.sha256()
+        self._size = 0
+        self._head = b""
+        self._temp_path: Optional[str] = None
+        self._file = None
+        self._url: Optional[str] = None
+
+    @property
+    def filename(self) -> str:
+        return self._filename
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def url(self) -> Optional[str]:
+        return self._url
+
+    @property
+    def is_image(self) -> bool:
+        if self._head.startswith(b"RIFF") and self._head[8:12] == b"WEBP":
+            return True
+        return self._head.startswith(IMAGE_SIGNATURES)
+
+    def _open(self) -> None:
+        self._directory.mkdir(parents=True, exist_ok=True)
+        fd, self._temp_path = tempfile.mkstemp(dir=self._directory, suffix=".part")
+        self._file = os.fdopen(fd, "wb")
+
+    def _write(self, data: bytes) -> None:
+        self._hash.update(data)
+        self._file.write(data)
+
+    def _commit(self) -> str:
+        self._file.close()
+        # mkstemp creates the file readable by its owner only.
+        os.chmod(self._temp_path, 0o644)
+        # Content-addressed names make identical images share one file on disk.
+        final_path = self._directory / f"{self._hash.hexdigest()}{Path(self._filename).suffix.lower()}"
+        if final_path.exists():
+            os.remove(self._temp_path)
+        else:
+            os.replace(self._temp_path, final_path)
+        return final_path.name
+
+    def _discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self._temp_path is not None and os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+    async def open(self) -> None:
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self._open)
+
+    async def write(self, data: bytes) -> None:
+        if len(self._head) < 12:
+            self._head = (self._head + data)[:12]
+        self._size += len(data)
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self._write, data)
+
+    async def commit(self) -> str:
+        name = await tornado.ioloop.IOLoop.current().run_in_executor(None, self._commit)
+        self._url = f"/static/{self._directory.relative_to(STATIC_DIR).as_posix()}/{name}"
+        return self._url
+
+    async def discard(self) -> None:
+        await tornado.ioloop.IOLoop.current().run_in_executor(None, self._discard)
+
+
+class MultipartStreamParser:
+    def __init__(self, boundary: bytes, directory: Path) -> None:
+        self._delimiter = b"--" + boundary
+        self._part_end = b"\r\n" + self._delimiter
+        self._directory = directory
+        self._buffer = b""
+        self._state = "preamble"
+        self._part_name: Optional[str] = None
+        self._part_file: Optional[StreamedFile] = None
+        self._part_value = bytearray()
+        self._fields: Dict[str, str] = {}
+        self._files: Dict[str, StreamedFile] = {}
+        self._error: Optional[str] = None
+
+    @property
+    def fields(self) -> Dict[str, str]:
+        return self._fields
+
+    @property
+    def files(self) -> Dict[str, StreamedFile]:
+        return self._files
+
+    @property
+    def complete(self) -> bool:
+        return self._state == "done"
+
+    @property
+    def error(self) -> Optional[str]:
+        return self._error
+
+    async def feed(self, chunk: bytes) -> None:
+        if self._state in ("done", "failed"):
+            return
+        self._buffer += chunk
+        while await self._step():
+            pass
+
+    async def _step(self) -> bool:
+        if self._state == "preamble":
+            index = self._buffer.find(self._delimiter)
+            if index == -1:
+                self._buffer = self._buffer[-len(self._delimiter):]
+                return False
+            self._buffer = self._buffer[index + len(self._delimiter):]
+            self._state = "boundary"
+            return True
+
+        if self._state == "boundary":
+            if len(self._buffer) < 2:
+                return False
+            if self._buffer.startswith(b"--"):
+                self._state = "done"
+                return False
+            self._buffer = self._buffer[2:]
+            self._state = "headers"
+            return True
+
+        if self._state == "headers":
+            index = self._buffer.find(b"\r\n\r\n")
+            if index == -1:
+                if len(self._buffer) > MAX_FIELD_BYTES:
+                    return await self._fail("Multipart headers too large")
+                return False
+            try:
+                headers = tornado.httputil.HTTPHeaders.parse(self._buffer[:index].decode("utf-8"))
+            except (UnicodeDecodeError, tornado.httputil.HTTPInputError):
+                return await self._fail("Malformed multipart headers")
+            self._buffer = self._buffer[index + 4:]
+            await self._start_part(headers.get("Content-Disposition", ""))
+            self._state = "body"
+            return True
+
+        if self._state == "body":
+            index = self._buffer.find(self._part_end)
+            if index == -1:
+                # Keep enough of the tail to recognise a delimiter split across chunks.
+                keep = len(self._part_end) - 1
+                if len(self._buffer) > keep:
+                    if not await self._part_data(self._buffer[:-keep]):
+                        return False
+                    self._buffer = self._buffer[-keep:]
+                return False
+            if not await self._part_data(self._buffer[:index]):
+                return False
+            self._buffer = self._buffer[index + len(self._part_end):]
+            if not await self._finish_part():
+                return False
+            self._state = "boundary"
+            return True
+
+        return False
+
+    async def _fail(self, error: str) -> bool:
+        # Raising from data_received would drop the connection without a response, so
+        # the error is kept for the handler to report once the body has been read.
+        self._error = error
+        self._state = "failed"
+        self._buffer = b""
+        await self.abort()
+        return False
+
+    async def _start_part(self, disposition: str) -> None:
+        self._part_name = _header_param(disposition, "Content-Disposition", "name")
+        filename = _header_param(disposition, "Content-Disposition", "filename")
+        self._part_value = bytearray()
+        self._part_file = None
+        # Browsers send an empty, nameless file part when no file was picked.
+        if filename:
+            self._part_file = StreamedFile(self._directory, os.path.basename(filename))
+            await self._part_file.open()
+
+    async def _part_data(self, data: bytes) -> bool:
+        if not data:
+            return True
+        if self._part_file is not None:
+            await self._part_file.write(data)
+        else:
+            if len(self._part_value) + len(data) > MAX_FIELD_BYTES:
+                return await self._fail("Form field too large")
+            self._part_value += data
+        return True
+
+    async def _finish_part(self) -> bool:
+        if self._part_file is not None:
+            if not self._part_file.is_image:
+                return await self._fail("Upload is not an image")
+            await self._part_file.commit()
+            if self._part_name:
+                self._files[self._part_name] = self._part_file
+            self._part_file = None
+        elif self._part_name:
+            try:
+                self._fields[self._part_name] = self._part_value.decode("utf-8")
+            except UnicodeDecodeError:
+                return await self._fail("Form field is not UTF-8")
+        return True
+
+    async def abort(self) -> None:
+        if self._part_file is not None:
+            await self._part_file.discard()
+            self._part_file = None
+
+
+@tornado.web.stream_request_body
+class StreamingFormHandler(tornado.web.RequestHandler):
+    def prepare(self):
+        max_size = self.settings.get("max_upload_size", MAX_UPLOAD_BYTES)
+        if int(self.request.headers.get("Content-Length", 0)) > max_size:
+            raise tornado.web.HTTPError(413, "Upload exceeds %d bytes", max_size)
+        # Bodies without a Content-Length (chunked) are cut off by tornado at this size.
+        self.request.connection.set_max_body_size(max_size)
+
+        content_type = self.request.headers.get("Content-Type", "")
+        boundary = _header_param(content_type, "Content-Type", "boundary")
+        if not content_type.startswith("multipart/form-data") or not boundary:
+            raise tornado.web.HTTPError(400, "Expected multipart/form-data")
+        self.form = MultipartStreamParser(boundary.encode("latin-1"), IMAGE_DIR)
+
+    async def data_received(self, chunk: bytes) -> None:
+        UPLOAD_BYTES.inc(len(chunk))
+        await self.form.feed(chunk)
+
+    def on_finish(self):
+        if hasattr(self, "form") and self.form.complete:
+            UPLOAD_SECONDS.observe(self.request.request_time())
+
+    def on_connection_close(self):
+        if hasattr(self, "form") and not self.form.complete:
+            tornado.ioloop.IOLoop.current().add_callback(self.form.abort)
+
+    async def require_complete_form(self) -> None:
+        if self.form.error is not None:
+            raise tornado.web.HTTPError(400, self.form.error)
+        # A body that ends before the closing boundary still completes the request, so
+        # on_connection_close never runs for it.
+        if not self.form.complete:
+            await self.form.abort()
+            raise tornado.web.HTTPError(400, "Incomplete multipart body")
+
+    def get_form_field(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self.form.fields.get(name, default)
+
+    def get_uploaded_url(self, name: str) -> Optional[str]:
+        streamed = self.form.files.get(name)
+        return streamed.url if streamed is not None else None
@@ -1,33 +1,61 @@
 import os
-import re
+import time
 from enum import Enum
 from pathlib import Path
-from typing import List, Union
+from typing import Any, Dict, List, Optional, Union
 
 STATIC_DIR = Path(os.path.join(os.path.dirname(__file__), "static"))
 BG_DIR = STATIC_DIR / "backgrounds"
+OPTIONS_REFRESH_SECONDS = 5.0
 
 
-def remove_numbers(string: str) -> str:
-    return re.sub(r'\d+', '', string)
+class OptionCatalog:
+    def __init__(self, bg_dir: Path, refresh_seconds: float = OPTIONS_REFRESH_SECONDS) -> None:
+        self._bg_dir = bg_dir
+        self._refresh_seconds = refresh_seconds
+        self._checked_at = float("-inf")
+        self._mtime: Optional[int] = None
+        self._version = 0
+        self._options: Dict[str, List[str]] = {"weatherOptions": [], "backgroundOptions": []}
 
+    @property
+    def version(self) -> int:
+        return self._version
 
-def get_unique_name(name: str, name_list: List[str]) -> str:
-    count_dict = {}
+    def refresh(self, force: bool = False) -> bool:
+        now = time.monotonic()
+        if not force and now - self._checked_at < self._refresh_seconds:
+            return False
+        self._checked_at = now
 
-    for s in [remove_numbers(x) for x in name_list]:
-        if s in count_dict:
-            count_dict[s] += 1
-        else:
-            count_dict[s] = 0
+        # A directory's mtime changes whenever an entry is added, removed or renamed,
+        # so a single stat is enough to know whether the listing is stale.
+        mtime = os.stat(self._bg_dir).st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
 
-    if name in count_dict:
-        return name + str(count_dict[name] + 1)
+        options = {
+            "weatherOptions": [str(weather.name.lower()) for weather in Weather],
+            "backgroundOptions": sorted(os.listdir(self._bg_dir)),
+        }
+        if options == self._options:
+            return False
+        self._options = options
+        self._version += 1
+        return True
 
-    return name
+    def get_options(self) -> Dict[str, Any]:
+        self.refresh()
+        return self._options | {"optionsVersion": self._version}
+
+
+option_catalog = OptionCatalog(BG_DIR)
+
+
+def get_options() -> dict[str, Union[int, List[str]]]:
+    return option_catalog.get_options()
 
-def get_options() -> dict[str, List[Union[str]]]:
-    return {"weatherOptions": [str(weather.name.lower()) for weather in Weather], "backgroundOptions": os.listdir(BG_DIR)}
 
 class Weather(Enum):
     CLEAR = "clear"